@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# Benchmarks for gitlab_ci_helper on large generated CI configs
+# Usage: benchmark.py [-j 100,1000,10000] [-o results.json] [--compare-loaders] [--memory]
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+from gitlab_ci_helper import (
+    CompactConfig,
+    JobGraph,
+    PipeDumper,
+    PipeLoader,
+    PurePipeLoader,
+    Tagged,
+    UTF_8,
+    FastFullLoader,
+    cleanMatrix,
+    getAllConfig,
+    getDependencies,
+    getListOfYamlFiles,
+    getTargetsDic,
+    getUnRemoveableJobs,
+    renderWriteBack,
+    selectWriteBack,
+)
+
+DEFAULTSIZES = "100,1000,10000"
+
+
+# generateConfig: build a synthetic CI config shaped like a large monorepo
+# INPUT:
+#   numJobs: number of real jobs
+#   numFiles: files the jobs are spread over
+#   extendsDepth: length of each `extends` chain of hidden templates
+#   fanIn: jobs of the previous layer every job `needs` (fan-out follows from fanIn and layers)
+#   layers: number of needs layers (stages)
+#   matrixSize: values of the PACKAGE matrix variable, every matrixEvery-th job has a matrix
+#   referenceEvery: every n-th job uses `!reference` to its template's before_script
+# OUTPUT: {file name: blocks}
+def generateConfig(
+    numJobs,
+    numFiles=10,
+    extendsDepth=3,
+    fanIn=2,
+    layers=5,
+    matrixSize=8,
+    matrixEvery=5,
+    referenceEvery=3,
+    seed=0,
+):
+    rnd = random.Random(seed)
+    files = {}
+    for f in range(numFiles):
+        files["ci-" + str(f) + ".yml"] = {}
+    stages = ["stage-" + str(layer) for layer in range(layers)]
+    files["ci-0.yml"]["stages"] = stages
+    files["ci-0.yml"]["variables"] = {"GIT_DEPTH": "10"}
+    # template families, each an extends chain of extendsDepth hidden jobs
+    families = []
+    for family in range(5):
+        parent = None
+        for depth in range(extendsDepth):
+            name = ".tpl-" + str(family) + "-" + str(depth)
+            block = {
+                "before_script": ["echo setup " + name],
+                "variables": {"LEVEL_" + str(depth): name},
+            }
+            if parent is None:
+                block["image"] = "python:3.11"
+            else:
+                block["extends"] = parent
+            files["ci-" + str(family % numFiles) + ".yml"][name] = block
+            parent = name
+        families.append(parent)
+    layerJobs = [[] for layer in range(layers)]
+    for i in range(numJobs):
+        layer = i * layers // max(numJobs, 1)
+        name = "test:job-" + str(i)
+        template = families[i % len(families)]
+        script = ["echo running " + name, "make test TARGET=" + str(i)]
+        if referenceEvery and i % referenceEvery == 0:
+            script.insert(0, Tagged("!reference", [template, "before_script"]))
+        block = {
+            "extends": template,
+            "stage": stages[layer],
+            "script": script,
+            "variables": {"JOB_INDEX": str(i)},
+        }
+        if layer > 0 and layerJobs[layer - 1]:
+            previous = layerJobs[layer - 1]
+            block["needs"] = sorted(
+                set(rnd.choice(previous) for n in range(fanIn))
+            )
+        if matrixEvery and i % matrixEvery == 0:
+            block["parallel"] = {
+                "matrix": [
+                    {"PACKAGE": ["pkg-" + str(p) for p in range(matrixSize)]}
+                ]
+            }
+        layerJobs[layer].append(name)
+        files["ci-" + str(i % numFiles) + ".yml"][name] = block
+    return files
+
+
+# writeConfig: dump generated blocks into dirToYaml, one file per key
+def writeConfig(files, dirToYaml):
+    for fn in files:
+        with open(os.path.join(dirToYaml, fn), "w") as f:
+            yaml.dump(
+                files[fn],
+                f,
+                sort_keys=False,
+                allow_unicode=True,
+                encoding=UTF_8,
+                Dumper=PipeDumper,
+            )
+
+
+# pickTargets: last-layer jobs as targets (deepest closures), matrix jobs get one subjob
+def pickTargets(jobs, count=20):
+    names = [j for j in jobs if j.startswith("test:job-")]
+    targets = []
+    for name in names[-count:]:
+        block = jobs[name]
+        if "parallel" in block:
+            targets.append(name + ":[" + block["parallel"]["matrix"][0]["PACKAGE"][1] + "]")
+        else:
+            targets.append(name)
+    return targets
+
+
+# timeIt: best wall clock time of fn over rounds, setup runs before every round and is not timed
+def timeIt(fn, rounds, setup=None):
+    best = None
+    result = None
+    for r in range(rounds):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        result = fn(arg) if setup else fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# benchmarkPhases: time every phase of a run on one generated config
+# OUTPUT: list of {"jobs", "phase", "seconds"}
+def benchmarkPhases(numJobs, rounds, genArgs):
+    results = []
+
+    def record(phase, seconds):
+        results.append({"jobs": numJobs, "phase": phase, "seconds": round(seconds, 6)})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dirToYaml = tmp + "/"
+        writeConfig(generateConfig(numJobs, **genArgs), dirToYaml)
+
+        def load():
+            yamlFiles = getListOfYamlFiles(dirToYaml)
+            fileIndex = {}
+            return getAllConfig(yamlFiles, dirToYaml, fileIndex), yamlFiles, fileIndex
+
+        seconds, (jobs, yamlFiles, fileIndex) = timeIt(load, rounds)
+        record("getAllConfig", seconds)
+        targets = pickTargets(jobs)
+        targetNames = [t.split(":[")[0] for t in targets]
+
+        seconds, unused = timeIt(
+            lambda: [getDependencies(t, jobs) for t in targetNames], rounds
+        )
+        record("getDependencies", seconds)
+        seconds, graph = timeIt(lambda: JobGraph(jobs), rounds)
+        record("JobGraph", seconds)
+        seconds, unused = timeIt(
+            lambda g: g.resolve(targetNames), rounds, lambda: JobGraph(jobs)
+        )
+        record("JobGraph.resolve", seconds)
+        targetsDic, titles = getTargetsDic(targets, jobs)
+        seconds, unused = timeIt(
+            lambda pair: cleanMatrix(pair[0], pair[1]),
+            rounds,
+            lambda: load()[0:1] + (targetsDic,),
+        )
+        record("cleanMatrix", seconds)
+
+        miniJobs = graph.resolve(targetNames) | getUnRemoveableJobs(jobs, graph)
+        # written to another directory, a fresh copy of the full config every round: the kept blocks are
+        # spliced from the original text found there
+        outDir = tmp + "/out/"
+
+        def copyAndLoad():
+            shutil.copytree(dirToYaml, outDir, ignore=shutil.ignore_patterns("out"), dirs_exist_ok=True)
+            return load()
+
+        seconds, unused = timeIt(
+            lambda state: selectWriteBack(
+                outDir, miniJobs, state[0], state[1], list(targetsDic), 2, state[2]
+            ),
+            rounds,
+            copyAndLoad,
+        )
+        record("selectWriteBack", seconds)
+
+        def resolveAll():
+            jobs, yamlFiles, fileIndex = load()
+            graph = JobGraph(jobs)
+            targetsDic, titles = getTargetsDic(targets, jobs)
+            miniJobs = set(getUnRemoveableJobs(jobs, graph))
+            for name in targetsDic:
+                miniJobs.update(graph.closure(name))
+            cleanedJobs = cleanMatrix(jobs, targetsDic)
+            return renderWriteBack(
+                dirToYaml, miniJobs, cleanedJobs, yamlFiles, list(targetsDic), 2, fileIndex
+            )
+
+        seconds, unused = timeIt(resolveAll, rounds)
+        record("fullResolution", seconds)
+    return results
+
+
+# benchmarkMemory: traced memory of a full resolution with every block in memory and with --compact
+# OUTPUT: list of {"jobs", "mode", "loadedMB", "peakMB"}, loaded: after loading, peak: over load, resolution and rendering
+def benchmarkMemory(numJobs, genArgs):
+    import tracemalloc
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        dirToYaml = tmp + "/"
+        writeConfig(generateConfig(numJobs, **genArgs), dirToYaml)
+        for mode in ("full", "compact"):
+            tracemalloc.start()
+            yamlFiles = getListOfYamlFiles(dirToYaml)
+            if mode == "compact":
+                fileIndex = CompactConfig(dirToYaml)
+                jobs = fileIndex.load(yamlFiles, 1)
+                graph = JobGraph(jobs, fileIndex.records)
+            else:
+                fileIndex = {}
+                jobs = getAllConfig(yamlFiles, dirToYaml, fileIndex, workers=1)
+                graph = JobGraph(jobs)
+            loaded = tracemalloc.get_traced_memory()[0]
+            targetsDic, titles = getTargetsDic(pickTargets(jobs), jobs)
+            miniJobs = set(getUnRemoveableJobs(jobs, graph))
+            for name in targetsDic:
+                miniJobs.update(graph.closure(name))
+            renderWriteBack(
+                dirToYaml,
+                miniJobs,
+                cleanMatrix(dict(jobs), targetsDic),
+                yamlFiles,
+                list(targetsDic),
+                2,
+                fileIndex,
+            )
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del jobs, graph, fileIndex
+            results.append(
+                {
+                    "jobs": numJobs,
+                    "mode": mode,
+                    "loadedMB": round(loaded / 1e6, 1),
+                    "peakMB": round(peak / 1e6, 1),
+                }
+            )
+    return results
+
+
+# time parsing every file of dirToYaml with one loader, returns seconds and the parsed data
+def timeLoad(dirToYaml, loader):
+    texts = []
+    for fn in sorted(getListOfYamlFiles(dirToYaml)):
+        with open(os.path.join(dirToYaml, fn), "r") as f:
+            texts.append(f.read())
+    start = time.perf_counter()
+    data = [yaml.load(text, Loader=loader) for text in texts]
+    return time.perf_counter() - start, data
+
+
+# benchmarkYamlLoad: compare the pure-Python loader with PipeLoader on generated configs
+def benchmarkYamlLoad(sizes, numFiles):
+    print("libyaml loader available: " + str(FastFullLoader is not yaml.FullLoader))
+    print("%8s %12s %12s %8s" % ("jobs", "pure (s)", "fast (s)", "speedup"))
+    for numJobs in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            writeConfig(generateConfig(numJobs, numFiles), tmp)
+            pureTime, pureData = timeLoad(tmp, PurePipeLoader)
+            fastTime, fastData = timeLoad(tmp, PipeLoader)
+        if pureData != fastData:
+            raise SystemExit("fast loader result differs at " + str(numJobs) + " jobs")
+        print(
+            "%8d %12.3f %12.3f %7.1fx"
+            % (numJobs, pureTime, fastTime, pureTime / max(fastTime, 1e-9))
+        )
+
+
+# environment recorded with the results, timings are only comparable on the same machine
+def getEnvironment():
+    return {
+        "python": platform.python_version(),
+        "pyyaml": yaml.__version__,
+        "libyaml": FastFullLoader is not yaml.FullLoader,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark gitlab_ci_helper")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=DEFAULTSIZES,
+        help="comma separated job counts to generate",
+    )
+    parser.add_argument(
+        "-f", "--files", default=10, type=int, help="number of files per config"
+    )
+    parser.add_argument("--extends-depth", default=3, type=int, dest="extendsDepth")
+    parser.add_argument("--fan-in", default=2, type=int, dest="fanIn")
+    parser.add_argument("--layers", default=5, type=int)
+    parser.add_argument("--matrix-size", default=8, type=int, dest="matrixSize")
+    parser.add_argument("--matrix-every", default=5, type=int, dest="matrixEvery")
+    parser.add_argument("--reference-every", default=3, type=int, dest="referenceEvery")
+    parser.add_argument("-r", "--rounds", default=3, type=int, help="best of n rounds")
+    parser.add_argument(
+        "-o", "--output", default="", help="write machine-readable results to this json file"
+    )
+    parser.add_argument(
+        "--compare-loaders",
+        action="store_true",
+        help="only compare the pure-Python and libyaml loaders",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="only compare the traced memory of a full and a --compact resolution",
+    )
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.jobs.split(",")]
+    if args.compare_loaders:
+        benchmarkYamlLoad(sizes, args.files)
+        sys.exit(0)
+    genArgs = {
+        "numFiles": args.files,
+        "extendsDepth": args.extendsDepth,
+        "fanIn": args.fanIn,
+        "layers": args.layers,
+        "matrixSize": args.matrixSize,
+        "matrixEvery": args.matrixEvery,
+        "referenceEvery": args.referenceEvery,
+    }
+    results = []
+    if args.memory:
+        print("%8s %-10s %12s %12s" % ("jobs", "mode", "loaded MB", "peak MB"))
+        for numJobs in sizes:
+            for result in benchmarkMemory(numJobs, genArgs):
+                results.append(result)
+                print(
+                    "%8d %-10s %12.1f %12.1f"
+                    % (result["jobs"], result["mode"], result["loadedMB"], result["peakMB"])
+                )
+    else:
+        print("%8s %-20s %12s" % ("jobs", "phase", "seconds"))
+        for numJobs in sizes:
+            for result in benchmarkPhases(numJobs, args.rounds, genArgs):
+                results.append(result)
+                print("%8d %-20s %12.4f" % (result["jobs"], result["phase"], result["seconds"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "environment": getEnvironment(),
+                    "generator": genArgs,
+                    "rounds": args.rounds,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Child pipelines: the minimum pipeline of gitlab_ci_helper written as one file (--emit-child) for a parent job to
+# trigger, instead of committing and pushing it, and checked offline against the config (--verify-child)
+# CHILDMETA in the file records the targets, the repeat number and a digest of the config it was rendered from
+import hashlib
+import os
+import sys
+
+from gitlab_ci_helper import (
+    INCLUDE,
+    UTF_8,
+    Bcolors,
+    IncludeResolver,
+    JobGraph,
+    isJob,
+    loadFileBlocks,
+    parseYamlBytes,
+    planWriteBack,
+    scanTopLevelKeys,
+    selectFileBlocks,
+    yamlDump,
+    yamlLoad,
+)
+from phase_timer import timed
+
+CHILDMETA = ".gitlab-ci-helper"  # hidden key of an --emit-child file: targets, repeat and digest of the config it came from
+
+
+# isLocalInclude: include entry loading a file of this repository (`local:` or a plain path)
+def isLocalInclude(entry):
+    if isinstance(entry, str):
+        return not entry.startswith(("http://", "https://"))
+    return type(entry) is dict and "local" in entry
+
+
+# getRepoRoot: directory local includes are relative to, the nearest parent of dirToYaml holding .git (else dirToYaml)
+def getRepoRoot(dirToYaml):
+    path = os.path.abspath(dirToYaml)
+    while not os.path.exists(os.path.join(path, ".git")):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return os.path.join(os.path.abspath(dirToYaml), "")
+        path = parent
+    return os.path.join(path, "")
+
+
+# getIncludePaths: existing files one include entry loads, local ones from the repository, the others from the mirror
+def getIncludePaths(entry, repoRoot, mirrorDir=None):
+    resolver = IncludeResolver(repoRoot, mirrorDir=mirrorDir)
+    return [path for path, root in resolver.resolveEntry(entry, repoRoot) if os.path.isfile(path)]
+
+
+# getConfigDigest: sha256 over the names and contents of the config files, tells whether a child pipeline file is stale
+def getConfigDigest(dirToYaml, yamlFiles):
+    digest = hashlib.sha256()
+    for fn in sorted(yamlFiles):
+        digest.update(fn.encode(UTF_8) + b"\0")
+        try:
+            with open(dirToYaml + fn, "rb") as f:
+                digest.update(f.read())
+        except OSError:
+            pass
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+# renderChildPipeline: the minimum pipeline as one self-contained config for a `trigger: include: artifact` child pipeline
+# INPUT: as renderWriteBack, plus the target jobs as given (-j format) and whether include: files were merged (--root)
+# OUTPUT: blocks: CHILDMETA, include: and then the blocks renderWriteBack would write, merged in file order
+# Note : with --root every include was merged, mirrored files included, so none is kept. Otherwise only a local include
+#        whose files are all among yamlFiles is dropped (its jobs are merged in already), the other entries are kept
+@timed()
+def renderChildPipeline(
+    dirToYaml,
+    minimumJobs,
+    cleanedJobs,
+    yamlFiles,
+    targetsDic,
+    targetJobs,
+    repeatNum,
+    fileIndex=None,
+    mergedIncludes=False,
+):
+    kept = {}
+    includes = []
+    loaded = {os.path.abspath(dirToYaml + fn) for fn in yamlFiles}
+    repoRoot = getRepoRoot(dirToYaml)
+    plan = planWriteBack(cleanedJobs, list(targetsDic), repeatNum)
+    for fn in yamlFiles:
+        blocks, original = loadFileBlocks(dirToYaml, fn, minimumJobs, fileIndex)
+        newBlocks, parts = selectFileBlocks(blocks, minimumJobs, cleanedJobs, fileIndex, plan)
+        for key in newBlocks:
+            if key != INCLUDE:
+                kept[key] = newBlocks[key]
+                continue
+            entries = newBlocks[key] if isinstance(newBlocks[key], list) else [newBlocks[key]]
+            for entry in entries:
+                if mergedIncludes or entry in includes:
+                    continue
+                if isLocalInclude(entry):
+                    paths = getIncludePaths(entry, repoRoot)
+                    if paths and all(path in loaded for path in paths):
+                        continue
+                includes.append(entry)
+    if mergedIncludes:
+        # jobs of included files from outside the repository (mirror) are not in any of yamlFiles
+        rest = {key: cleanedJobs[key] for key in cleanedJobs if key in minimumJobs and key not in kept}
+        kept.update(selectFileBlocks(rest, minimumJobs, cleanedJobs, fileIndex, plan)[0])
+    child = {
+        CHILDMETA: {
+            "targets": [target.strip() for target in targetJobs],
+            "repeat": repeatNum,
+            "config": getConfigDigest(dirToYaml, yamlFiles),
+        }
+    }
+    if includes:
+        child[INCLUDE] = includes
+    child.update(kept)
+    return child
+
+
+# readChildPipeline: parse a file written by --emit-child, exit when it is not one
+def readChildPipeline(path):
+    try:
+        with open(path, "rb") as f:
+            child = parseYamlBytes(f.read())
+    except OSError as e:
+        sys.exit(f"{Bcolors.FAIL}[Input Error] " + str(e) + f"{Bcolors.ENDC}")
+    meta = child.get(CHILDMETA) if type(child) is dict else None
+    if (
+        type(meta) is not dict
+        or not isinstance(meta.get("targets"), list)
+        or not isinstance(meta.get("repeat"), int)
+    ):
+        sys.exit(
+            f"{Bcolors.FAIL}[Input Error] "
+            + path
+            + " has no "
+            + CHILDMETA
+            + " section, it was not written by --emit-child"
+            + f"{Bcolors.ENDC}"
+        )
+    return child
+
+
+# verifyChildPipeline: compare a child pipeline file with the one rendered again from the config, offline
+# INPUT: parsed child file, renderChildPipeline output, repository root and mirror its include: entries are read from
+# OUTPUT: list of problems, empty when the file holds what the config gives for its targets and every job it points to
+#         is in the file or in a file it includes
+def verifyChildPipeline(child, expected, repoRoot, mirrorDir=None):
+    problems = []
+    # compared as written, so both sides went through the same dump
+    expected = parseYamlBytes(yamlDump(expected))
+    for key in expected:
+        if key == CHILDMETA:
+            continue
+        if key not in child:
+            problems.append(key + " is missing")
+        elif child[key] != expected[key]:
+            problems.append(key + " differs from the config")
+    for key in child:
+        if key not in expected:
+            problems.append(key + " is not part of the minimum pipeline")
+    included = set()
+    entries = child.get(INCLUDE, [])
+    for entry in entries if isinstance(entries, list) else [entries]:
+        paths = getIncludePaths(entry, repoRoot, mirrorDir)
+        if not paths and isLocalInclude(entry):
+            problems.append("include of a local file which does not exist: " + str(entry))
+        for path in paths:
+            with open(path, "r", encoding=UTF_8) as f:
+                text = f.read()
+            keys = scanTopLevelKeys(text)
+            included.update(keys if keys is not None else yamlLoad(text) or {})
+    graph = JobGraph({key: child[key] for key in child if key != CHILDMETA})
+    for name in sorted(graph.missing):
+        missing = [str(dep) for dep in graph.missing[name] if dep not in included]
+        if missing:
+            problems.append(name + " points to " + ", ".join(missing) + ", not in the file or its includes")
+    return problems
+
+
+# emitChildPipeline: write the child pipeline file (--emit-child)
+def emitChildPipeline(path, child):
+    workflow = child.get("workflow")
+    if type(workflow) is dict and "rules" in workflow:
+        print(
+            f"{Bcolors.WARNING}[Warning] workflow:rules are kept, they must let the child pipeline run "
+            + "($CI_PIPELINE_SOURCE is parent_pipeline)"
+            + f"{Bcolors.ENDC}"
+        )
+    with open(path, "wb") as f:
+        f.write(b"# minimum pipeline written by gitlab_ci_helper --emit-child\n")
+        f.write(yamlDump(child))
+    jobsNum = len([key for key in child if isJob(child[key], key)])
+    print("Wrote child pipeline " + path + " with " + str(jobsNum) + " jobs")
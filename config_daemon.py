@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# Daemon of gitlab_ci_helper (--serve): keeps the parsed config and dependency graph of one CI directory in memory,
+# reparses only the files that changed and answers target sets over a unix socket, so a run skips parsing altogether
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+
+from gitlab_ci_helper import (
+    UTF_8,
+    Bcolors,
+    JobGraph,
+    getCacheDir,
+    getListOfYamlFiles,
+    getTargetsDic,
+    getUnRemoveableJobs,
+    getYaml,
+    parseFiles,
+    renderTargetSet,
+    reportGraphProblems,
+)
+
+
+# ConfigWatcher: parsed config and dependency graph of one CI directory kept in memory by the daemon
+# refresh() polls the files (mtime and size), parses only the changed ones and updates the graph edges of the changed jobs
+# while a file does not parse, error holds the parse error and the last good config is kept
+class ConfigWatcher:
+    def __init__(self, dirToYaml, debug=False):
+        self.dirToYaml = dirToYaml
+        self.debug = debug
+        self.stamps = {}
+        self.fileIndex = {}
+        self.yamlFiles = []
+        self.jobs = {}
+        self.graph = None
+        self.unRemoveableJobs = set()
+        self.parsed = 0
+        self.error = None
+
+    # refresh: bring the config up to date with the files
+    # OUTPUT: names of the jobs which were added, changed or removed
+    # Note : when a changed file does not parse nothing is updated and the stamps stay, so the next refresh retries it
+    def refresh(self):
+        yamlFiles = getListOfYamlFiles(self.dirToYaml)
+        changedFiles = []
+        stamps = {}
+        for fn in yamlFiles:
+            try:
+                st = os.stat(self.dirToYaml + fn)
+            except OSError:
+                continue
+            stamps[fn] = (st.st_mtime_ns, st.st_size)
+            if self.stamps.get(fn) != stamps[fn]:
+                changedFiles.append(fn)
+        removedFiles = [fn for fn in self.stamps if fn not in yamlFiles]
+        if self.graph is not None and not changedFiles and not removedFiles:
+            return set()
+        # the first refresh parses every file, in parallel when the config is large
+        try:
+            parsed = parseFiles([self.dirToYaml + fn for fn in changedFiles])
+        except (getYaml().YAMLError, OSError) as e:
+            if self.debug and self.error != str(e):
+                print("Parse error, keeping the last good config: " + str(e))
+            self.error = str(e)
+            return set()
+        self.error = None
+        for fn in changedFiles:
+            self.stamps[fn] = stamps[fn]
+        for fn in removedFiles:
+            del self.stamps[fn]
+            self.fileIndex.pop(fn, None)
+        for fn, y in zip(changedFiles, parsed):
+            self.parsed += 1
+            if y is None:
+                self.fileIndex.pop(fn, None)
+            else:
+                self.fileIndex[fn] = y
+        if self.debug:
+            print("Reparsed: " + str(changedFiles) + ", removed: " + str(removedFiles))
+        self.yamlFiles = [fn for fn in yamlFiles if fn in self.fileIndex]
+        jobs = {}
+        for fn in self.yamlFiles:
+            for j in self.fileIndex[fn]:
+                jobs[j] = self.fileIndex[fn][j]
+        changed = set()
+        for name in set(jobs) | set(self.jobs):
+            old = self.jobs.get(name)
+            new = jobs.get(name)
+            if old is not new and (name not in jobs or name not in self.jobs or old != new):
+                changed.add(name)
+        self.jobs = jobs
+        if self.graph is None:
+            self.graph = JobGraph(jobs)
+        elif changed:
+            self.graph.update(jobs, changed)
+        if self.graph is not None and (changed or not self.unRemoveableJobs):
+            self.unRemoveableJobs = getUnRemoveableJobs(jobs, self.graph)
+        return changed
+
+    # render: minimum config for the target jobs, the parsed config is not modified
+    # OUTPUT: list of (file name, content as utf-8 bytes)
+    def render(self, targetJobs, repeatNum):
+        targetsDic, targetJobTitles = getTargetsDic(targetJobs, self.jobs)
+        print(
+            "This program will generate Gitlab configuration files for these target jobs:"
+        )
+        print(set(targetJobTitles))
+        reportGraphProblems(self.graph, self.debug)
+        return renderTargetSet(
+            targetsDic,
+            repeatNum,
+            self.jobs,
+            self.graph,
+            self.unRemoveableJobs,
+            self.dirToYaml,
+            self.yamlFiles,
+            self.fileIndex,
+        )
+
+
+# getDaemonSocket: default socket of the daemon serving one CI directory
+def getDaemonSocket(dirToYaml):
+    digest = hashlib.sha1(os.path.abspath(dirToYaml).encode(UTF_8)).hexdigest()[:16]
+    return os.path.join(getCacheDir(), "daemon-" + digest + ".sock")
+
+
+# DaemonHandler: one request per connection, a json line {dir, targets, repeat} answered by a json line
+# {contents: [[file name, content]], yamlFiles, output} or {error, output}; output is what a local run would have printed
+# while a file does not parse the answer is {parseError, output} and the client resolves locally
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        watcher = self.server.watcher
+        reply = {}
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out):
+                if os.path.abspath(request["dir"]) != os.path.abspath(watcher.dirToYaml):
+                    sys.exit(
+                        f"{Bcolors.FAIL}[Error] The daemon serves "
+                        + watcher.dirToYaml
+                        + f"{Bcolors.ENDC}"
+                    )
+                watcher.refresh()
+                if watcher.error is None:
+                    contents = watcher.render(request["targets"], request["repeat"])
+            if watcher.error is not None:
+                reply["parseError"] = watcher.error
+            else:
+                reply["contents"] = [[fn, content.decode(UTF_8)] for fn, content in contents]
+                reply["yamlFiles"] = watcher.yamlFiles
+        except SystemExit as e:
+            reply["error"] = str(e.code)
+        reply["output"] = out.getvalue()
+        self.wfile.write(json.dumps(reply).encode(UTF_8) + b"\n")
+
+
+# DaemonServer: unix socket server, between requests the files are polled every poll interval
+# so a changed file is usually parsed before the next request arrives
+class DaemonServer(socketserver.UnixStreamServer):
+    def __init__(self, socketPath, watcher):
+        self.watcher = watcher
+        super().__init__(socketPath, DaemonHandler)
+
+    def service_actions(self):
+        self.watcher.refresh()
+
+
+# serveDaemon: run the daemon in the foreground until interrupted
+def serveDaemon(dirToYaml, socketPath, interval=0.5, debug=False):
+    if requestFromDaemon(socketPath, None) is not None:
+        sys.exit(
+            f"{Bcolors.FAIL}[Error] A daemon is already listening on "
+            + socketPath
+            + f"{Bcolors.ENDC}"
+        )
+    os.makedirs(os.path.dirname(socketPath) or ".", exist_ok=True)
+    if os.path.exists(socketPath):
+        # left behind by a daemon which did not stop cleanly
+        os.unlink(socketPath)
+    watcher = ConfigWatcher(dirToYaml, debug)
+    watcher.refresh()
+    server = DaemonServer(socketPath, watcher)
+    print(
+        "Serving "
+        + f"{Bcolors.OKCYAN}"
+        + dirToYaml
+        + f"{Bcolors.ENDC}"
+        + " on "
+        + socketPath
+        + " ("
+        + str(len(watcher.jobs))
+        + " jobs)"
+    )
+    try:
+        server.serve_forever(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socketPath)
+
+
+# requestFromDaemon: ask a running daemon, None when there is no daemon (the caller resolves locally)
+# INPUT: socket path, request dict (None only checks that the daemon answers)
+def requestFromDaemon(socketPath, request, timeout=30):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socketPath)
+            if request is None:
+                return {}
+            s.sendall(json.dumps(request).encode(UTF_8) + b"\n")
+            with s.makefile("rb") as f:
+                line = f.readline()
+    except OSError:
+        return None
+    if not line:
+        return None
+    return json.loads(line)
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# In-process GitLab REST client used by gitlab_ci_helper instead of one `glab` process per request
+# RestBackend keeps a pool of keep-alive HTTPS connections and fetches independent resources and pages concurrently,
+# GlabBackend serves the same requests through `glab api` when there is no token for the REST backend
+import os
+import json
+import queue
+import re
+import time
+import urllib.parse
+
+from phase_timer import TRACER, runCommand
+
+# http.client and concurrent.futures are imported on first request, most of the import time of this module otherwise
+
+UTF_8 = "utf-8"
+DEFAULTHOST = "gitlab.com"
+PERPAGE = 100
+POOLSIZE = 8
+TIMEOUT = 30
+WAITTIMEOUT = 300  # seconds to wait for GitLab to create a pipeline
+TRACECHUNK = 256 * 1024  # most log bytes fetched by one request
+
+
+class GitLabApiError(Exception):
+    pass
+
+
+# getRemoteProject: host and project path ("group/project") of a git remote, None if it is not readable
+def getRemoteProject(remote="origin"):
+    result = runCommand(
+        ["git", "remote", "get-url", remote], capture_output=True
+    )
+    if result.returncode != 0:
+        return None
+    return parseRemoteUrl(result.stdout.decode(UTF_8).strip())
+
+
+# parseRemoteUrl: 'git@host:group/project.git' or 'https://host/group/project.git' -> (host, 'group/project')
+def parseRemoteUrl(url):
+    if "://" in url:
+        parsed = urllib.parse.urlparse(url)
+        host = parsed.hostname
+        path = parsed.path
+    elif ":" in url:
+        host, path = url.split(":", 1)
+        host = host.split("@")[-1]
+    else:
+        return None
+    path = path.strip("/")
+    if path.endswith(".git"):
+        path = path[:-4]
+    if not host or not path:
+        return None
+    return host, path
+
+
+# getToken: API token from the environment, or from glab's configuration for the host
+def getToken(host):
+    for name in ["GITLAB_TOKEN", "GITLAB_PRIVATE_TOKEN", "GITLAB_ACCESS_TOKEN"]:
+        if os.environ.get(name):
+            return os.environ[name]
+    try:
+        result = runCommand(
+            ["glab", "config", "get", "token", "--host", host], capture_output=True
+        )
+    except OSError:
+        return ""
+    return result.stdout.decode(UTF_8).strip()
+
+
+# GitLabApi: requests the helper needs, built on get()/getAll() of a backend
+class GitLabApi:
+    # the latest pipeline of a ref (branch name or commit sha), None if there is none
+    def getLatestPipeline(self, ref):
+        key = "sha" if isSha(ref) else "ref"
+        pipelines = self.get(
+            self.projectPath("pipelines"),
+            {key: ref, "per_page": 1, "order_by": "id", "sort": "desc"},
+        )
+        return pipelines[0] if pipelines else None
+
+    def getPipelines(self, **params):
+        params.setdefault("order_by", "id")
+        params.setdefault("sort", "desc")
+        return self.get(self.projectPath("pipelines"), params)
+
+    def getPipeline(self, pipelineId):
+        return self.get(self.projectPath("pipelines/" + str(pipelineId)))
+
+    # every job of a pipeline (latest attempts, with includeRetried the retried ones too), all pages
+    def getPipelineJobs(self, pipelineId, includeRetried=False):
+        return self.getAll(
+            self.projectPath("pipelines/" + str(pipelineId) + "/jobs"),
+            {"include_retried": "true"} if includeRetried else None,
+        )
+
+    def getMergeRequests(self, sourceBranch):
+        return self.get(
+            self.projectPath("merge_requests"),
+            {"source_branch": sourceBranch, "state": "opened"},
+        )
+
+    # getJobTrace: log bytes of a job from offset on, at most limit bytes, b"" when there is nothing new
+    def getJobTrace(self, jobId, offset=0, limit=TRACECHUNK):
+        return self.getRange(
+            self.projectPath("jobs/" + str(jobId) + "/trace"), offset, limit
+        )
+
+    def createPipeline(self, ref):
+        return self.post(self.projectPath("pipeline"), {"ref": ref})
+
+    # getPipelineState: latest pipeline of the ref with its jobs, and the open MRs of the branch, fetched concurrently
+    # OUTPUT: {"pipeline": pipeline or None, "jobs": [...], "mergeRequests": [...]}
+    def getPipelineState(self, ref):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            mrs = pool.submit(self.getMergeRequests, ref) if not isSha(ref) else None
+            pipeline = self.getLatestPipeline(ref)
+            jobs = self.getPipelineJobs(pipeline["id"]) if pipeline else []
+            return {
+                "pipeline": pipeline,
+                "jobs": jobs,
+                "mergeRequests": mrs.result() if mrs else [],
+            }
+
+    def projectPath(self, path):
+        return "projects/" + self.project + "/" + path
+
+
+# apiSpanName: request as a timing span name, ids replaced so calls of one endpoint add up
+def apiSpanName(method, path):
+    path = re.sub(r"^projects/[^/]+", "projects/:id", path)
+    return method + " " + re.sub(r"/\d+", "/:n", path)
+
+
+def isSha(ref):
+    return len(ref) >= 7 and all(c in "0123456789abcdef" for c in ref)
+
+
+# waitForPipeline: poll until the pipeline for a commit exists, with exponential backoff
+# returns as soon as GitLab created it, so there is no fixed sleep after a push and no guessing which pipeline is ours
+# INPUT: api backend, full commit sha, ref to narrow the search (optional), timeout in seconds
+# OUTPUT: the newest pipeline of the commit, raise GitLabApiError on timeout
+def waitForPipeline(
+    api, sha, ref=None, timeout=WAITTIMEOUT, delay=0.5, maxDelay=8, sleepFn=time.sleep
+):
+    deadline = time.monotonic() + timeout
+    params = {"sha": sha, "per_page": 1}
+    if ref:
+        params["ref"] = ref
+    while True:
+        pipelines = api.getPipelines(**params)
+        if pipelines:
+            return pipelines[0]
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise GitLabApiError(
+                "no pipeline was created for commit " + sha + " within " + str(timeout) + "s"
+            )
+        with TRACER.span("sleep", "wait"):
+            sleepFn(min(delay, remaining))
+        delay = min(delay * 2, maxDelay)
+
+
+# RestBackend: GitLab REST v4 over a pool of keep-alive connections
+class RestBackend(GitLabApi):
+    name = "rest"
+
+    def __init__(self, host, token, projectPath, https=True, poolSize=POOLSIZE):
+        self.host = host
+        self.token = token
+        self.project = urllib.parse.quote(projectPath, safe="")
+        self.https = https
+        self.poolSize = poolSize
+        self._pool = queue.LifoQueue()
+        self.connectionsOpened = 0
+
+    def _connection(self):
+        import http.client
+
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            self.connectionsOpened += 1
+            if self.https:
+                return http.client.HTTPSConnection(self.host, timeout=TIMEOUT)
+            return http.client.HTTPConnection(self.host, timeout=TIMEOUT)
+
+    # close every pooled connection
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _release(self, conn):
+        if self._pool.qsize() < self.poolSize:
+            self._pool.put(conn)
+        else:
+            conn.close()
+
+    # request: one API call, retried once on a connection the server has closed meanwhile
+    # OUTPUT: decoded json body (the bytes with raw=True), response headers
+    # Note : a POST is not retried, the server may have acted on it (a second pipeline) before the connection dropped;
+    #        network errors (DNS, timeouts, refused or reset connections) raise GitLabApiError
+    def request(self, method, path, params=None, body=None, headers=None, raw=False):
+        import http.client
+
+        url = "/api/v4/" + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        sendHeaders = {"PRIVATE-TOKEN": self.token, "Accept": "application/json"}
+        if body is not None:
+            body = json.dumps(body).encode(UTF_8)
+            sendHeaders["Content-Type"] = "application/json"
+        if headers:
+            sendHeaders.update(headers)
+        with TRACER.span(apiSpanName(method, path), "api"):
+            for attempt in range(2):
+                conn = self._connection()
+                try:
+                    conn.request(method, url, body=body, headers=sendHeaders)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    conn.close()
+                    if attempt == 1 or method == "POST":
+                        raise GitLabApiError(method + " " + url + " failed: " + repr(e)) from e
+                    continue
+                if response.getheader("Connection", "").lower() == "close":
+                    conn.close()
+                else:
+                    self._release(conn)
+                if raw and response.status == 416:
+                    # range starts at the end of the body
+                    return b"", response
+                if response.status >= 400:
+                    raise GitLabApiError(
+                        method
+                        + " "
+                        + url
+                        + " failed: "
+                        + str(response.status)
+                        + " "
+                        + data.decode(UTF_8, "replace")[:200]
+                    )
+                if raw:
+                    return data, response
+                return (json.loads(data) if data else None), response
+        return None, None
+
+    def get(self, path, params=None):
+        return self.request("GET", path, params)[0]
+
+    def post(self, path, body=None):
+        return self.request("POST", path, body=body)[0]
+
+    # getRange: bytes [offset, offset + limit) of a raw endpoint, sliced here when the server ignores Range
+    def getRange(self, path, offset, limit):
+        data, response = self.request(
+            "GET",
+            path,
+            headers={"Range": "bytes=" + str(offset) + "-" + str(offset + limit - 1)},
+            raw=True,
+        )
+        if response.status == 206:
+            return data
+        return data[offset : offset + limit]
+
+    # getAll: every page of a list endpoint, pages after the first are fetched concurrently
+    def getAll(self, path, params=None):
+        params = dict(params or {})
+        params["per_page"] = PERPAGE
+        params["page"] = 1
+        first, response = self.request("GET", path, params)
+        result = list(first or [])
+        totalPages = response.getheader("X-Total-Pages")
+        if totalPages:
+            from concurrent.futures import ThreadPoolExecutor
+
+            pages = list(range(2, int(totalPages) + 1))
+            with ThreadPoolExecutor(max_workers=self.poolSize) as pool:
+                for items in pool.map(
+                    lambda page: self.get(path, dict(params, page=page)), pages
+                ):
+                    result.extend(items or [])
+            return result
+        # very large lists have no total, follow X-Next-Page
+        nextPage = response.getheader("X-Next-Page")
+        while nextPage:
+            items, response = self.request("GET", path, dict(params, page=nextPage))
+            result.extend(items or [])
+            nextPage = response.getheader("X-Next-Page")
+        return result
+
+
+# GlabBackend: same requests through `glab api`, glab resolves host, project (:id) and authentication itself
+class GlabBackend(GitLabApi):
+    name = "glab"
+
+    def __init__(self):
+        self.project = ":id"
+
+    def _runRaw(self, args):
+        try:
+            result = runCommand(["glab", "api"] + args, capture_output=True)
+        except OSError as e:
+            raise GitLabApiError("glab is not available: " + str(e))
+        if result.returncode != 0:
+            raise GitLabApiError(
+                "glab api " + " ".join(args) + " failed: " + result.stderr.decode(UTF_8)
+            )
+        return result.stdout
+
+    def _run(self, args):
+        output = self._runRaw(args).decode(UTF_8).strip()
+        return json.loads(output) if output else None
+
+    def _url(self, path, params):
+        if params:
+            path += "?" + urllib.parse.urlencode(params)
+        return path
+
+    def get(self, path, params=None):
+        return self._run([self._url(path, params)])
+
+    def post(self, path, body=None):
+        args = ["-X", "POST", path]
+        for key in body or {}:
+            args.extend(["-f", key + "=" + str(body[key])])
+        return self._run(args)
+
+    # getRange: like RestBackend.getRange, --include prints the status line to tell 206 from a full body
+    def getRange(self, path, offset, limit):
+        rangeHeader = "Range: bytes=" + str(offset) + "-" + str(offset + limit - 1)
+        try:
+            output = self._runRaw(["--include", "-H", rangeHeader, path])
+        except GitLabApiError as e:
+            if "416" in str(e):
+                return b""
+            raise
+        head, sep, data = output.partition(b"\r\n\r\n")
+        if not sep:
+            head, sep, data = output.partition(b"\n\n")
+        if b" 206" in head.split(b"\n", 1)[0]:
+            return data
+        return data[offset : offset + limit]
+
+    def getAll(self, path, params=None):
+        params = dict(params or {})
+        params["per_page"] = PERPAGE
+        # --paginate prints one json array per page
+        output = self._runRaw(["--paginate", self._url(path, params)])
+        result = []
+        decoder = json.JSONDecoder()
+        text = output.decode(UTF_8).strip()
+        pos = 0
+        while pos < len(text):
+            items, pos = decoder.raw_decode(text, pos)
+            result.extend(items)
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+        return result
+
+
+# getApiBackend: REST backend when a token is available ("auto"), glab otherwise
+# INPUT: "auto", "rest" or "glab"
+def getApiBackend(kind="auto", remote="origin"):
+    if kind == "glab":
+        return GlabBackend()
+    remoteProject = getRemoteProject(remote)
+    host = os.environ.get("GITLAB_HOST", "")
+    if host.startswith(("http://", "https://")):
+        host = urllib.parse.urlparse(host).netloc
+    if remoteProject is not None:
+        host = host or remoteProject[0]
+    host = host or DEFAULTHOST
+    token = getToken(host)
+    if remoteProject is None or token == "":
+        if kind == "rest":
+            raise GitLabApiError(
+                "REST backend needs a GitLab remote and a token (GITLAB_TOKEN or `glab auth login`)"
+            )
+        return GlabBackend()
+    return RestBackend(host, token, remoteProject[1])
@@ -1,37 +1,29 @@
 #!/usr/bin/env python3
 import os
 import sys
-import subprocess
-import typing
+import hashlib
+import collections
+import copy
+import glob
+import json
+import pickle
+import shlex
+import time
 import re
-import traceback
-import unittest
-
-try:
-    import yaml
-except ImportError:
-    sys.exit("PyYAML dependency is missing!")
 
 import argparse
-from time import sleep
-
-# paths
-# dirToYaml = os.getcwd() + "/gitlab/"
+import atexit
 
-# Reference: https://death.andgravity.com/any-yaml
-# add new type to customize Loader and Dumber for Yaml File reading and writing
-class PipeLoader(yaml.FullLoader):
-    pass
+from phase_timer import TRACER, runCommand, timed
 
+# heavy modules are imported where they are used: yaml (getYaml), gitlab_api (talking to GitLab),
+# tempfile (git plumbing) and traceback (error report), so `--help` and daemon clients start fast
 
-class PipeDumper(yaml.Dumper):
-    pass
-
+# paths
+# dirToYaml = os.getcwd() + "/gitlab/"
 
 # new type for tag
-class Tagged(typing.NamedTuple):
-    tag: str
-    value: object
+Tagged = collections.namedtuple("Tagged", ["tag", "value"])
 
 
 # construct function for tag Loading
@@ -55,6 +47,70 @@ def represent_tagged(self, data):
     return node
 
 
+# getYaml: import yaml and build the customized loaders and dumper on first use
+# Reference: https://death.andgravity.com/any-yaml
+# add new type to customize Loader and Dumber for Yaml File reading and writing
+# PipeLoader is based on libyaml (CFullLoader) when PyYAML is built with it, and on the pure-Python FullLoader otherwise
+# PipeDumper stays pure-Python: libyaml's emitter picks different quoting/key styles for some scalars and the written files must not change
+# OUTPUT: the yaml module; yaml, FastFullLoader, PipeLoader, PurePipeLoader and PipeDumper are module globals afterwards
+LAZYYAML = ("yaml", "FastFullLoader", "PipeLoader", "PurePipeLoader", "PipeDumper")
+
+
+def getYaml():
+    global yaml, FastFullLoader, PipeLoader, PurePipeLoader, PipeDumper
+    if "PipeDumper" in globals():
+        return yaml
+    try:
+        import yaml
+    except ImportError:
+        sys.exit("PyYAML dependency is missing!")
+    try:
+        from yaml import CFullLoader as FastFullLoader
+    except ImportError:
+        FastFullLoader = yaml.FullLoader
+
+    class PipeLoader(FastFullLoader):
+        pass
+
+    class PurePipeLoader(yaml.FullLoader):
+        pass
+
+    class PipeDumper(yaml.Dumper):
+        pass
+
+    # customize yaml loaders and dumper for '!'
+    PipeDumper.add_multi_representer(Tagged, represent_tagged)
+    PipeLoader.add_multi_constructor("!", construct_undefined)
+    PurePipeLoader.add_multi_constructor("!", construct_undefined)
+    return yaml
+
+
+# yaml names are resolved on first access from outside, e.g. `from gitlab_ci_helper import PipeLoader`
+def __getattr__(name):
+    if name in LAZYYAML:
+        getYaml()
+        return globals()[name]
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+
+# yamlLoad: parse yaml text with PipeLoader
+def yamlLoad(text):
+    getYaml()
+    return yaml.load(text, Loader=PipeLoader)
+
+
+# yamlDump: dump blocks the way they are written back, keys in order, utf-8 bytes
+def yamlDump(blocks):
+    getYaml()
+    return yaml.dump(
+        blocks,
+        sort_keys=False,
+        allow_unicode=True,
+        encoding=UTF_8,
+        Dumper=PipeDumper,
+    )
+
+
 # colors used present nice message
 class Bcolors:
     HEADER = "\033[95m"
@@ -80,115 +136,1601 @@ FAILED = "failed"
 MANUAL = "manual"
 UTF_8 = "utf-8"
 ENDTOENDPARALLEL = 4
-
-
-def isRemoveableJob(block, key):
-    return type(block) is dict and ((SCRIPT in block or ":" in key)) and key[0] != "."
-
-
-def getListOfYamlFiles(dirToYaml):
+INCLUDE = "include"
+REFERENCE = "!reference"
+ROOTCONFIG = ".gitlab-ci.yml"
+# top level keys which configure the pipeline instead of defining a job
+GLOBALKEYWORDS = {
+    "default",
+    "include",
+    "stages",
+    "variables",
+    "workflow",
+    "image",
+    "services",
+    "cache",
+    "before_script",
+    "after_script",
+}
+MINIBRANCHPREFIX = "mini-pipeline/"  # throwaway branch used by --plumbing
+# ConfigCache format, bumped whenever parsing or the dependency edges change (optional needs skipped, !reference
+# edges) so closures cached by an older version are never seeded
+CACHEVERSION = 2
+CACHEMAXAGE = 30 * 24 * 3600  # seconds an unused cache file is kept
+MAXPARALLEL = 200  # GitLab limit of jobs one definition may expand to (parallel / parallel:matrix)
+REPEAT = "REPEAT"
+SHARDSUFFIX = "-shard-"
+DEFAULTSTAGES = [".pre", "build", "test", "deploy", ".post"]
+DEFAULTSTAGE = "test"
+DEFAULTDURATION = 300.0  # seconds assumed for a job without any recorded duration
+DURATIONHISTORY = 20  # recorded durations kept per job
+PARSEPARALLELBYTES = 1024 * 1024  # less yaml than this is parsed serially, starting a process pool would cost more
+# keys of a job the resolution reads (graph, matrices, stages, pruning warnings), the only ones --compact keeps in memory
+GRAPHKEYS = (NEEDS, DEPEN, EXTENDS, PARALLEL, "stage", "when", "rules", "only", "except")
+
+
+# isJob: top level key GitLab turns into jobs (not a global keyword, not a hidden template)
+def isJob(block, key):
+    return type(block) is dict and key[0] != "." and key not in GLOBALKEYWORDS
+
+
+# list *.yml/*.yaml files of dirToYaml, with recursive=True also of its sub directories (paths relative to dirToYaml)
+def getListOfYamlFiles(dirToYaml, recursive=False):
     fileList = []
+    if recursive:
+        for root, dirs, files in os.walk(dirToYaml):
+            dirs.sort()
+            rel = os.path.relpath(root, dirToYaml)
+            for fn in sorted(files):
+                if fn.endswith((".yml", ".yaml")):
+                    fileList.append(fn if rel == "." else os.path.join(rel, fn))
+        return fileList
     for fn in os.listdir(dirToYaml):
-        if fn.endswith(".yml"):
+        if fn.endswith((".yml", ".yaml")):
             fileList.append(fn)
     return fileList
 
 
+# directory for persistent caches: $XDG_CACHE_HOME/gitlab_ci_helper, default ~/.cache/gitlab_ci_helper
+def getCacheDir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "gitlab_ci_helper")
+
+
+# ConfigCache: on-disk cache of parsed yaml files and dependency closures for one CI directory
+# a file entry is reused when mtime and size match, or when the content hash still matches (e.g. after git checkout touched the file)
+# closures are only reused while every file of the directory is unchanged
+class ConfigCache:
+    def __init__(self, dirToYaml, cacheDir=None):
+        self.cacheDir = cacheDir or getCacheDir()
+        key = hashlib.sha1(os.path.abspath(dirToYaml).encode(UTF_8)).hexdigest()
+        self.path = os.path.join(self.cacheDir, key + ".pickle")
+        self.files = {}
+        self.closureKey = None
+        self.closures = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+            if data.get("version") == CACHEVERSION:
+                self.files = data["files"]
+                self.closureKey = data["closureKey"]
+                self.closures = data["closures"]
+        except Exception:
+            # missing or unreadable cache, start empty
+            pass
+
+    # loadFile: parsed content of one yaml file, from cache if the file did not change
+    def loadFile(self, path, fn):
+        y, miss = self.lookup(path, fn)
+        if miss is None:
+            return y
+        y = yamlLoad(miss[1].decode(UTF_8))
+        self.store(fn, miss, y)
+        return y
+
+    # lookup: cached blocks of a file, or (None, miss) where miss holds what store() needs and the file content to parse
+    def lookup(self, path, fn):
+        st = os.stat(path)
+        entry = self.files.get(fn)
+        if entry and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            y = self._unpickle(entry)
+            if y is not self:
+                self.hits += 1
+                return y, None
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if entry and entry["sha"] == digest:
+            y = self._unpickle(entry)
+            if y is not self:
+                entry["mtime"] = st.st_mtime_ns
+                entry["size"] = st.st_size
+                self.dirty = True
+                self.hits += 1
+                return y, None
+        return None, (st, content, digest)
+
+    # store: parsed blocks of a file lookup() missed
+    def store(self, fn, miss, y):
+        st, content, digest = miss
+        self.misses += 1
+        # store pickled now, so the cache holds the file as parsed whatever happens to the blocks later
+        self.files[fn] = {
+            "mtime": st.st_mtime_ns,
+            "size": st.st_size,
+            "sha": digest,
+            "data": pickle.dumps(y, pickle.HIGHEST_PROTOCOL),
+        }
+        self.dirty = True
+
+    # returns self when the cached entry cannot be read back
+    def _unpickle(self, entry):
+        try:
+            return pickle.loads(entry["data"])
+        except Exception:
+            return self
+
+    # key identifying the whole directory content, closures are valid only for this key
+    def getClosureKey(self, yamlFiles):
+        h = hashlib.sha256()
+        for fn in yamlFiles:
+            h.update(fn.encode(UTF_8) + b"\0" + self.files[fn]["sha"].encode(UTF_8))
+        return h.hexdigest()
+
+    def getClosures(self, yamlFiles):
+        if self.closureKey == self.getClosureKey(yamlFiles):
+            return self.closures
+        return {}
+
+    def storeClosures(self, yamlFiles, closures):
+        key = self.getClosureKey(yamlFiles)
+        if key != self.closureKey or len(closures) != len(self.closures):
+            self.closureKey = key
+            self.closures = dict(closures)
+            self.dirty = True
+
+    # prune: evict entries of files which are gone from the directory
+    def prune(self, yamlFiles):
+        for fn in list(self.files):
+            if fn not in yamlFiles:
+                del self.files[fn]
+                self.dirty = True
+
+    # save: write the cache atomically, and remove cache files of other directories unused for CACHEMAXAGE
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.cacheDir, exist_ok=True)
+        tmpPath = self.path + "." + str(os.getpid())
+        with open(tmpPath, "wb") as f:
+            pickle.dump(
+                {
+                    "version": CACHEVERSION,
+                    "files": self.files,
+                    "closureKey": self.closureKey,
+                    "closures": self.closures,
+                },
+                f,
+                pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmpPath, self.path)
+        self.dirty = False
+        now = time.time()
+        for fn in os.listdir(self.cacheDir):
+            other = os.path.join(self.cacheDir, fn)
+            if other != self.path and fn.endswith(".pickle"):
+                try:
+                    if now - os.stat(other).st_mtime > CACHEMAXAGE:
+                        os.remove(other)
+                except OSError:
+                    pass
+
+
+# DurationCache: recent durations of every job, recorded from pipelines fetched through the GitLab API
+# matrix/parallel instances ("job: [a]", "job 1/4") are recorded under their job name, the estimate uses the median
+class DurationCache:
+    def __init__(self, dirToYaml, cacheDir=None):
+        self.cacheDir = cacheDir or getCacheDir()
+        key = hashlib.sha1(os.path.abspath(dirToYaml).encode(UTF_8)).hexdigest()
+        self.path = os.path.join(self.cacheDir, "durations-" + key + ".json")
+        self.durations = {}
+        self.seen = set()
+        self.dirty = False
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.durations = data["durations"]
+            self.seen = set(data["seen"])
+        except Exception:
+            # missing or unreadable cache, start empty
+            pass
+
+    # record: durations of finished jobs from the API, every job id is recorded once
+    def record(self, apiJobs):
+        for job in apiJobs:
+            duration = job.get("duration")
+            if not duration or job.get("id") in self.seen:
+                continue
+            if job.get("id") is not None:
+                self.seen.add(job["id"])
+            name = splitArgument(job["name"])[0]
+            history = self.durations.setdefault(name, [])
+            history.append(float(duration))
+            del history[:-DURATIONHISTORY]
+            self.dirty = True
+
+    # get: median recorded duration in seconds, None without history
+    def get(self, name):
+        history = sorted(self.durations.get(name, []))
+        if not history:
+            return None
+        mid = len(history) // 2
+        if len(history) % 2:
+            return history[mid]
+        return (history[mid - 1] + history[mid]) / 2
+
+    # typical: median over the known jobs, used for jobs without history
+    def typical(self):
+        known = sorted(self.get(name) for name in self.durations if self.durations[name])
+        if not known:
+            return DEFAULTDURATION
+        return known[len(known) // 2]
+
+    # save: write the cache atomically
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.cacheDir, exist_ok=True)
+        tmpPath = self.path + "." + str(os.getpid())
+        with open(tmpPath, "w") as f:
+            # job ids only matter for recent pipelines, keep the newest
+            json.dump({"durations": self.durations, "seen": sorted(self.seen)[-10000:]}, f)
+        os.replace(tmpPath, self.path)
+        self.dirty = False
+
+
+# openJobHistory: SQLite history of job results for dirToYaml, next to the duration cache
+def openJobHistory(dirToYaml, cacheDir=None):
+    from job_history import JobHistory
+
+    cacheDir = cacheDir or getCacheDir()
+    os.makedirs(cacheDir, exist_ok=True)
+    key = hashlib.sha1(os.path.abspath(dirToYaml).encode(UTF_8)).hexdigest()
+    return JobHistory(os.path.join(cacheDir, "history-" + key + ".sqlite"))
+
+
+# printJobStats: failure rate and flakiness table of job/matrix cells
+def printJobStats(stats):
+    from job_history import failureRate, flakiness, formatTarget
+
+    print("%-50s %6s %8s %8s" % ("job", "runs", "failed", "flaky"))
+    for s in stats:
+        print(
+            "%-50s %6d %7.0f%% %7.0f%%"
+            % (formatTarget(s.name, s.cell), s.runs, failureRate(s) * 100, flakiness(s) * 100)
+        )
+
+
+# pickFlakyTargets: the n flakiest recently run jobs of the history as target jobs
+# OUTPUT: target jobs, repeat number that shows the failure of the least failing one with 95% confidence
+def pickFlakyTargets(history, n):
+    from job_history import failureRate, formatTarget, suggestRepeat
+
+    stats = history.topFlaky(n)
+    if not stats:
+        sys.exit(
+            f"{Bcolors.FAIL}[Error] No flaky job in the history, record pipelines with --ingest-history first{Bcolors.ENDC}"
+        )
+    printJobStats(stats)
+    repeatNum = max(suggestRepeat(failureRate(s)) for s in stats)
+    print("Suggested repeat number: " + str(repeatNum))
+    return [formatTarget(s.name, s.cell) for s in stats], repeatNum
+
+
+# getStages: stage order of the pipeline, GitLab's default when `stages` is not set
+def getStages(jobs):
+    stages = jobs.get("stages")
+    if isinstance(stages, list) and stages:
+        stages = [str(stage) for stage in stages]
+        # .pre and .post always exist, first and last
+        return [".pre"] + [st for st in stages if st not in (".pre", ".post")] + [".post"]
+    return list(DEFAULTSTAGES)
+
+
+# getJobStage: stage of a job, from the job itself or the templates it extends
+def getJobStage(jobs, name, resolver=None):
+    block = (resolver or ExtendsResolver(jobs)).effective(name)
+    if type(block) is dict and "stage" in block:
+        return str(block["stage"])
+    return DEFAULTSTAGE
+
+
+# getNeedNames: jobs of the pipeline a job needs, None when the job has no `needs` (it waits for the earlier stages)
+def getNeedNames(block, pipelineJobs):
+    if type(block) is not dict or not isinstance(block.get(NEEDS), list):
+        return None
+    names = []
+    for need in block[NEEDS]:
+        if type(need) is dict:
+            if "project" in need or "pipeline" in need:
+                continue
+            need = need.get("job")
+        if isinstance(need, str) and need in pipelineJobs and need not in names:
+            names.append(need)
+    return names
+
+
+# estimatePipeline: critical path and runner time of a pipeline, assuming enough runners for every instance
+# a job with `needs` starts when the jobs it needs finish, a job without starts when every job of the earlier stages finished
+# INPUT: jobs, {job name: number of instances} of the pipeline, {job name: duration in seconds}
+# OUTPUT: {"wall": seconds, "runner": runner seconds, "path": job names of the critical path in order}
+def estimatePipeline(jobs, counts, durations):
+    stages = getStages(jobs)
+    stageIndex = {stage: i for i, stage in enumerate(stages)}
+    resolver = ExtendsResolver(jobs)
+    byStage = {}
+    for name in counts:
+        i = stageIndex.get(getJobStage(jobs, name, resolver), len(stages))
+        byStage.setdefault(i, []).append(name)
+    finish = {}
+    via = {}
+    barrier = (0.0, None)
+    latest = (0.0, None)
+    for i in sorted(byStage):
+        barrier = latest
+        for root in byStage[i]:
+            # post-order over the needs, iterative so long chains cannot overflow the stack
+            stack = [root]
+            visiting = set()
+            while stack:
+                name = stack[-1]
+                if name in finish:
+                    stack.pop()
+                    continue
+                needs = getNeedNames(resolver.effective(name), counts)
+                if name not in visiting:
+                    visiting.add(name)
+                    pending = [n for n in needs or [] if n not in finish and n not in visiting]
+                    if pending:
+                        stack.extend(pending)
+                        continue
+                stack.pop()
+                if needs is None:
+                    start, by = barrier
+                else:
+                    start, by = max(
+                        [(finish[n], n) for n in needs if n in finish], default=(0.0, None)
+                    )
+                finish[name] = start + durations[name]
+                via[name] = by
+                if latest[1] is None or finish[name] > latest[0]:
+                    latest = (finish[name], name)
+    path = []
+    name = latest[1]
+    while name is not None:
+        path.append(name)
+        name = via[name]
+    return {
+        "wall": latest[0],
+        "runner": sum(durations[name] * counts[name] for name in counts),
+        "path": path[::-1],
+    }
+
+
+# getJobCounts: instances of every job of a minimum pipeline, repeated targets multiplied by the repeat number
+def getJobCounts(cleanedJobs, miniJobsNames, targetJobs, repeatNum):
+    resolver = ExtendsResolver(cleanedJobs)
+    counts = {}
+    for name in sorted(miniJobsNames):
+        if name in cleanedJobs and isJob(cleanedJobs[name], name):
+            counts[name] = max(countJobInstances(resolver.effective(name)), 1)
+            if name in targetJobs and repeatNum > 0:
+                counts[name] *= repeatNum
+    return counts
+
+
+# printEstimate: critical path and runner minutes of the full pipeline against the minimum one,
+# and the non-target jobs on the minimum critical path which cost the most wall time
+def printEstimate(jobs, cleanedJobs, miniJobsNames, targetJobs, repeatNum, durationCache):
+    resolver = ExtendsResolver(jobs)
+    fullCounts = {
+        name: max(countJobInstances(resolver.effective(name)), 1)
+        for name in jobs
+        if isJob(jobs[name], name)
+    }
+    miniCounts = getJobCounts(cleanedJobs, miniJobsNames, targetJobs, repeatNum)
+    typical = durationCache.typical()
+    durations = {}
+    unknown = 0
+    for name in fullCounts:
+        durations[name] = durationCache.get(name)
+        if durations[name] is None:
+            durations[name] = typical
+            unknown += 1
+    full = estimatePipeline(jobs, fullCounts, durations)
+    mini = estimatePipeline(cleanedJobs, miniCounts, durations)
+    print(
+        f"{Bcolors.HEADER}Estimate{Bcolors.ENDC} (history for "
+        + str(len(fullCounts) - unknown)
+        + "/"
+        + str(len(fullCounts))
+        + " jobs, others assumed "
+        + format(typical / 60, ".1f")
+        + " min, enough runners assumed):"
+    )
+    for title, counts, result in [("full", fullCounts, full), ("minimum", miniCounts, mini)]:
+        print(
+            "  "
+            + title.ljust(8)
+            + " critical path "
+            + format(result["wall"] / 60, ".1f").rjust(7)
+            + " min, "
+            + format(result["runner"] / 60, ".1f").rjust(8)
+            + " runner min, "
+            + str(sum(counts.values()))
+            + " jobs"
+        )
+    print(
+        "  Critical path: "
+        + " -> ".join(n + " (" + format(durations[n] / 60, ".1f") + ")" for n in mini["path"])
+    )
+    # what the minimum pipeline would gain without each non-target job of its critical path
+    savings = []
+    for name in mini["path"]:
+        if name in targetJobs:
+            continue
+        without = dict(durations)
+        without[name] = 0.0
+        saved = mini["wall"] - estimatePipeline(cleanedJobs, miniCounts, without)["wall"]
+        if saved > 0:
+            savings.append((saved, name))
+    for saved, name in sorted(savings, reverse=True)[:5]:
+        print(
+            f"  {Bcolors.WARNING}"
+            + name
+            + f"{Bcolors.ENDC} is needed on the critical path, "
+            + format(saved / 60, ".1f")
+            + " min of the wait"
+        )
+    return full, mini
+
+
+# parseYamlBytes: parse one file content, also the worker function of the process pool
+def parseYamlBytes(content):
+    return yamlLoad(content.decode(UTF_8))
+
+
+# getParseWorkers: cores this process may use
+def getParseWorkers():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# parseContents: parsed blocks of every file content, in input order
+# spread over a process pool when there are several workers and at least PARSEPARALLELBYTES of yaml, serial otherwise.
+# Results come back pickled by the pool, Tagged is a module level class so !reference values survive it
+@timed()
+def parseContents(contents, workers=0):
+    workers = min(workers or getParseWorkers(), len(contents))
+    if workers < 2 or sum(len(c) for c in contents) < PARSEPARALLELBYTES:
+        return [parseYamlBytes(c) for c in contents]
+    from concurrent.futures import ProcessPoolExecutor
+
+    with TRACER.span("process pool", workers=workers):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # a few chunks per worker: fewer round trips, still balanced when file sizes differ
+            chunksize = max(1, len(contents) // (workers * 4))
+            return list(pool.map(parseYamlBytes, contents, chunksize=chunksize))
+
+
+# parseFiles: parsed blocks of every file, in the given order
+# with a cache, unchanged files come from the ConfigCache (cacheKeys: its key of every path), the others are parsed by parseContents
+def parseFiles(paths, cacheKeys=None, cache=None, workers=0):
+    parsed = [None] * len(paths)
+    misses = {}
+    contents = {}
+    for i, path in enumerate(paths):
+        if cache is not None:
+            y, miss = cache.lookup(path, cacheKeys[i])
+            if miss is None:
+                parsed[i] = y
+                continue
+            misses[i] = miss
+            contents[i] = miss[1]
+        else:
+            with open(path, "rb") as f:
+                contents[i] = f.read()
+    order = list(contents)
+    for i, y in zip(order, parseContents([contents[i] for i in order], workers)):
+        parsed[i] = y
+        if i in misses:
+            cache.store(cacheKeys[i], misses[i], y)
+    return parsed
+
+
 # get all from yamlfiles as object to process
-def getAllConfig(yamlFiles, dirToYaml):
+# if fileIndex is given, it is filled with file -> parsed blocks (job keys keep the file order) so later phases never re-read the files
+# if cache is given, unchanged files are taken from the ConfigCache instead of being parsed
+# workers: processes parsing the files (0 for every core, 1 for serial), merged in yamlFiles order either way
+@timed()
+def getAllConfig(yamlFiles, dirToYaml, fileIndex=None, cache=None, workers=0):
+    parsed = parseFiles([dirToYaml + fn for fn in yamlFiles], yamlFiles, cache, workers)
     jobs = {}
     validFileList = []
-    for fn in yamlFiles:
-        with open(dirToYaml + fn, "r") as o:
-            y = yaml.load(o.read(), Loader=PipeLoader)
-            if y != None:
-                validFileList.append(fn)
-                for j in y:
-                    jobs[j] = y[j]
-
+    for fn, y in zip(yamlFiles, parsed):
+        if y != None:
+            validFileList.append(fn)
+            if fileIndex is not None:
+                fileIndex[fn] = y
+            for j in y:
+                jobs[j] = y[j]
+
+    if cache is not None:
+        cache.prune(yamlFiles)
     yamlFiles[:] = validFileList
     return jobs
 
 
+# internStrings: copy of a parsed value with every string interned, so the job names, stages and matrix values
+# repeated over thousands of jobs are stored once
+def internStrings(value):
+    if type(value) is str:
+        return sys.intern(value)
+    if type(value) is list:
+        return [internStrings(v) for v in value]
+    if type(value) is dict:
+        return {internStrings(k): internStrings(value[k]) for k in value}
+    return value
+
+
+# JobRecord: what the resolution keeps of one top level key of a CompactConfig
+# block: only the GRAPHKEYS of a job or template, the whole block of a global keyword (never removed, so written as is)
+# deps: getDirectDependencies of the full block, !reference in scripts included, so the graph never needs the rest
+class JobRecord:
+    __slots__ = ("name", "file", "block", "deps", "removable")
+
+    def __init__(self, name, fn, block):
+        self.name = sys.intern(name)
+        self.file = fn
+        self.removable = name not in GLOBALKEYWORDS
+        self.deps = tuple(
+            sys.intern(d) if isinstance(d, str) else d for d in getDirectDependencies(block)
+        )
+        if self.removable and type(block) is dict:
+            self.block = {
+                key: internStrings(block[key]) for key in block if key in GRAPHKEYS
+            }
+        else:
+            self.block = block
+
+
+# CompactConfig: config of huge pipelines with only a JobRecord per top level key in memory (--compact)
+# files are parsed in batches and their full blocks dropped; at write-back only the files holding
+# kept keys are parsed again, so scripts, variables, artifacts, ... are loaded for the minimum pipeline only.
+# Passed to renderWriteBack in place of the fileIndex of getAllConfig
+class CompactConfig:
+    def __init__(self, dirToYaml, cache=None):
+        self.dirToYaml = dirToYaml
+        self.cache = cache
+        self.records = {}
+        self.fileKeys = {}
+
+    # load: all jobs like getAllConfig returns them, with the graph part of every block only
+    @timed("CompactConfig.load")
+    def load(self, yamlFiles, workers=0):
+        jobs = {}
+        validFileList = []
+        batch = []
+        size = 0
+        # serial parsing goes file by file, a pool gets about PARSEPARALLELBYTES per worker
+        workers = workers or getParseWorkers()
+        limit = PARSEPARALLELBYTES * workers if workers > 1 else 0
+        for i, fn in enumerate(yamlFiles):
+            batch.append(fn)
+            size += os.path.getsize(self.dirToYaml + fn)
+            if size < limit and i + 1 < len(yamlFiles):
+                continue
+            parsed = parseFiles(
+                [self.dirToYaml + f for f in batch], batch, self.cache, workers
+            )
+            for f, y in zip(batch, parsed):
+                if y != None:
+                    validFileList.append(f)
+                    keys = []
+                    for key in y:
+                        record = JobRecord(key, f, y[key])
+                        self.records[record.name] = record
+                        jobs[record.name] = record.block
+                        keys.append(record.name)
+                    self.fileKeys[f] = keys
+            batch = []
+            size = 0
+        if self.cache is not None:
+            self.cache.prune(yamlFiles)
+        yamlFiles[:] = validFileList
+        return jobs
+
+    # blocks: full blocks of one file, parsed again, or {} when none of its keys is kept
+    def blocks(self, fn, minimumJobs):
+        if not any(key in minimumJobs for key in self.fileKeys.get(fn, ())):
+            return {}
+        return parseFiles([self.dirToYaml + fn], [fn], self.cache, 1)[0] or {}
+
+    # restore: full block of a kept key with the parallel section cleanMatrix gave its graph part
+    @staticmethod
+    def restore(block, cleaned):
+        if (
+            type(block) is dict
+            and type(cleaned) is dict
+            and PARALLEL in cleaned
+            and cleaned[PARALLEL] != block.get(PARALLEL)
+        ):
+            block = dict(block)
+            block[PARALLEL] = cleaned[PARALLEL]
+        return block
+
+
+# getDirectDependencies: get the job names one block points to by needs, dependencies, extends and !reference
+# INPUT: single job block
+# OUTPUT: a list of job names in the order they are declared (may contain duplicates)
+# Note : `optional: true` needs are left out, GitLab ignores them when the job is not in the pipeline
+def getDirectDependencies(block):
+    names = []
+    if type(block) is not dict:
+        return getReferencedNames(block)
+    needs = block.get(NEEDS)
+    if isinstance(needs, list):
+        for need in needs:
+            # check job section
+            if type(need) is dict:
+                if need.get("optional") is True:
+                    continue
+                need = need.get("job")
+            if isinstance(need, str):
+                names.append(need)
+    depens = block.get(DEPEN)
+    if isinstance(depens, list):
+        for d in depens:
+            if isinstance(d, str):
+                names.append(d)
+    extends = block.get(EXTENDS)
+    if isinstance(extends, str):  # if the extend is referencing other jobs
+        names.append(extends)
+    elif isinstance(extends, list):
+        for extend in extends:
+            if isinstance(extend, str):
+                names.append(extend)
+    names.extend(getReferencedNames(block))
+    return names
+
+
+# getReferencedNames: job/template names used by `!reference [name, ...]` tags anywhere inside a block
+def getReferencedNames(block):
+    names = []
+    stack = [block]
+    while stack:
+        cur = stack.pop()
+        if isinstance(cur, Tagged):
+            if cur.tag == REFERENCE and isinstance(cur.value, list) and cur.value:
+                names.append(cur.value[0])
+            else:
+                stack.append(cur.value)
+        elif type(cur) is dict:
+            stack.extend(cur.values())
+        elif type(cur) is list:
+            stack.extend(cur)
+    return names
+
+
+# mergeBlocks: merge two definitions of the same key like GitLab merges included files
+# hashes are merged deeply, any other value of override replaces the one of base
+def mergeBlocks(base, override):
+    if type(base) is dict and type(override) is dict:
+        merged = dict(base)
+        for k in override:
+            if k in base:
+                merged[k] = mergeBlocks(base[k], override[k])
+            else:
+                merged[k] = override[k]
+        return merged
+    return override
+
+
+# getExtends: template names a block extends, in merge order
+def getExtends(block):
+    if type(block) is not dict:
+        return []
+    extends = block.get(EXTENDS)
+    if isinstance(extends, str):
+        return [extends]
+    if isinstance(extends, list):
+        return [e for e in extends if isinstance(e, str)]
+    return []
+
+
+# ExtendsResolver: effective definition of a job with its `extends` templates merged in, the way GitLab does it
+# templates are merged in order, then the job itself; hashes are merged deeply, other values (lists too) replace, a null key of the job removes it
+# every template is merged once and shared by the jobs extending it. Merged blocks share the unchanged values of
+# their templates (copy-on-write), so they must not be modified in place: copy the block and the hash being changed
+class ExtendsResolver:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._effective = {}
+
+    # effective: merged definition of name, the block itself when it extends nothing (None for unknown names)
+    # iterative post-order over the extends chain; a template on a cycle or missing is skipped
+    def effective(self, name):
+        if name in self._effective:
+            return self._effective[name]
+        stack = [(name, False)]
+        visiting = set()
+        while stack:
+            cur, expanded = stack.pop()
+            if cur in self._effective or (not expanded and cur in visiting):
+                continue
+            block = self.jobs.get(cur)
+            parents = [p for p in getExtends(block) if p in self.jobs]
+            if not expanded:
+                visiting.add(cur)
+                stack.append((cur, True))
+                for parent in reversed(parents):
+                    if parent not in self._effective and parent not in visiting:
+                        stack.append((parent, False))
+                continue
+            visiting.discard(cur)
+            if not parents:
+                self._effective[cur] = block
+                continue
+            merged = {}
+            for parent in parents:
+                if type(self._effective.get(parent)) is dict:
+                    merged = mergeBlocks(merged, self._effective[parent])
+            for key in block:
+                if key == EXTENDS:
+                    continue
+                if block[key] is None:
+                    merged.pop(key, None)
+                else:
+                    merged[key] = mergeBlocks(merged.get(key), block[key])
+            self._effective[cur] = merged
+        return self._effective[name]
+
+
 # getDependencies: get all dependency jobs for the target job
 # INPUT: single target name, all jobs
-# OUTPUT: a list of minimum dependency jobs's name
+# OUTPUT: a list of minimum dependency jobs's name, dependencies first and the target last, no duplicates
+# Note : walk is iterative and every job is visited once, so cycles and deep chains are safe. Unknown names are skipped
+@timed()
 def getDependencies(target, yObject):
     list = []
-    if NEEDS in yObject[target]:
-        for need in yObject[target][NEEDS]:
-            # check job section
-            if type(need) is dict:
-                list.extend(getDependencies(need["job"], yObject))
-            else:
-                list.extend(getDependencies(need, yObject))
-    if DEPEN in yObject[target]:
-        for d in yObject[target][DEPEN]:
-            list.extend(getDependencies(d, yObject))
-    if EXTENDS in yObject[target]:
-        if isinstance(
-            yObject[target][EXTENDS], str
-        ):  # if the extend is referencing other jobs
-            list.extend(getDependencies(yObject[target][EXTENDS], yObject))
+    seen = {target}
+    stack = [(target, iter(getDirectDependencies(yObject[target])))]
+    while stack:
+        name, deps = stack[-1]
+        for dep in deps:
+            if dep not in seen and dep in yObject:
+                seen.add(dep)
+                stack.append((dep, iter(getDirectDependencies(yObject[dep]))))
+                break
         else:
-            for extend in yObject[target][EXTENDS]:
-                list.extend(getDependencies(extend, yObject))
-    list.append(target)
+            stack.pop()
+            list.append(name)
     return list
 
 
+# JobGraph: dependency graph built once from the output of getAllConfig
+# adjacency: job -> direct dependencies (needs, dependencies, extends, !reference), reverse: job -> jobs depending on it
+# cycles and references to unknown jobs are collected instead of crashing the resolution
+class JobGraph:
+    # records: JobRecords of a CompactConfig, their deps are used instead of reading the blocks
+    @timed("JobGraph")
+    def __init__(self, jobs, records=None):
+        self.records = records
+        self.adjacency = {}
+        self._reverse = None
+        self.missing = {}
+        for name in jobs:
+            self._addEdges(name, jobs)
+        self._closures = {}
+        self._findComponents()
+
+    # reverse: built from the adjacency on first use, only update needs it (a set per job is most of the graph's memory)
+    @property
+    def reverse(self):
+        if self._reverse is None:
+            self._reverse = {name: set() for name in self.adjacency}
+            for name in self.adjacency:
+                for dep in self.adjacency[name]:
+                    self._reverse[dep].add(name)
+        return self._reverse
+
+    # _addEdges: edges of one job, once reverse is built every other job must already have its entry there
+    def _addEdges(self, name, jobs):
+        deps = []
+        if self.records is not None:
+            direct = self.records[name].deps
+        else:
+            direct = getDirectDependencies(jobs[name])
+        for dep in direct:
+            if dep not in jobs:
+                self.missing.setdefault(name, []).append(dep)
+            elif dep not in deps:
+                deps.append(dep)
+                if self._reverse is not None:
+                    self._reverse[dep].add(name)
+        self.adjacency[name] = tuple(deps)
+
+    # update: apply added, changed or removed job definitions without building the graph again
+    # INPUT: all jobs after the change, names of the jobs which were added, changed or removed
+    # OUTPUT: names whose closure was dropped
+    # Note : only the edges of the changed jobs (and of jobs pointing at added/removed names) are rebuilt,
+    #        closures are dropped for them and every job depending on them, found by walking the reverse edges
+    def update(self, jobs, changed):
+        changed = set(changed)
+        for name in list(changed):
+            if name in jobs and name not in self.adjacency:
+                # jobs which referenced the new name as unknown get the edge now
+                changed.update(n for n in self.missing if name in self.missing[n])
+            elif name not in jobs and name in self.reverse:
+                changed.update(self.reverse[name])
+        stale = set()
+        stack = [name for name in changed if name in self.reverse]
+        while stack:
+            name = stack.pop()
+            if name in stale:
+                continue
+            stale.add(name)
+            stack.extend(self.reverse[name])
+        for name in changed:
+            for dep in self.adjacency.pop(name, ()):
+                if dep in self.reverse:
+                    self.reverse[dep].discard(name)
+            self.missing.pop(name, None)
+            if name in jobs:
+                self.reverse.setdefault(name, set())
+        for name in changed:
+            if name in jobs:
+                self._addEdges(name, jobs)
+            else:
+                self.reverse.pop(name, None)
+        for name in stale:
+            self._closures.pop(name, None)
+        self._findComponents()
+        return stale
+
+    # memoizedClosures: closures computed so far, job -> frozenset
+    def memoizedClosures(self):
+        return self._closures
+
+    # seedClosures: reuse closures computed by an earlier run over the same config (see ConfigCache)
+    def seedClosures(self, closures):
+        for name in closures:
+            if name in self.adjacency:
+                self._closures[name] = frozenset(closures[name])
+
+    # Tarjan's strongly connected components, iterative so deep chains cannot overflow the stack
+    # any component with more than one job (or a self edge) is a cycle, only those are kept
+    def _findComponents(self):
+        self.cycles = []
+        index = {}
+        lowLink = {}
+        onStack = set()
+        sccStack = []
+        counter = 0
+        for root in self.adjacency:
+            if root in index:
+                continue
+            index[root] = lowLink[root] = counter
+            counter += 1
+            sccStack.append(root)
+            onStack.add(root)
+            work = [(root, iter(self.adjacency[root]))]
+            while work:
+                name, deps = work[-1]
+                for dep in deps:
+                    if dep not in index:
+                        index[dep] = lowLink[dep] = counter
+                        counter += 1
+                        sccStack.append(dep)
+                        onStack.add(dep)
+                        work.append((dep, iter(self.adjacency[dep])))
+                        break
+                    elif dep in onStack:
+                        lowLink[name] = min(lowLink[name], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowLink[parent] = min(lowLink[parent], lowLink[name])
+                    if lowLink[name] == index[name]:
+                        members = []
+                        while True:
+                            member = sccStack.pop()
+                            onStack.discard(member)
+                            members.append(member)
+                            if member == name:
+                                break
+                        if len(members) > 1 or name in self.adjacency[name]:
+                            self.cycles.append(members[::-1])
+
+    # closure: memoized transitive closure of one job, the job itself included
+    # closures already computed for other jobs are merged instead of walked again
+    def closure(self, name):
+        if name in self._closures:
+            return self._closures[name]
+        result = {name}
+        stack = [name]
+        while stack:
+            cur = stack.pop()
+            for dep in self.adjacency[cur]:
+                if dep in result:
+                    continue
+                known = self._closures.get(dep)
+                if known is not None:
+                    result.update(known)
+                else:
+                    result.add(dep)
+                    stack.append(dep)
+        self._closures[name] = frozenset(result)
+        return self._closures[name]
+
+    # resolve: minimum job set for many targets with one linear traversal
+    # INPUT: iterable of job names
+    # OUTPUT: set of the targets and everything they depend on
+    # Note : jobs with a memoized closure are merged instead of walked
+    def resolve(self, targets):
+        result = set()
+        stack = []
+        for target in targets:
+            if target in self.adjacency and target not in result:
+                known = self._closures.get(target)
+                if known is not None:
+                    result.update(known)
+                else:
+                    result.add(target)
+                    stack.append(target)
+        while stack:
+            name = stack.pop()
+            for dep in self.adjacency[name]:
+                if dep not in result:
+                    known = self._closures.get(dep)
+                    if known is not None:
+                        result.update(known)
+                    else:
+                        result.add(dep)
+                        stack.append(dep)
+        return result
+
+
+# print cycles and unknown job references found while building the graph
+def reportGraphProblems(graph, debug):
+    for cycle in graph.cycles:
+        print(
+            f"{Bcolors.WARNING}[Warning] Dependency cycle found: "
+            + " -> ".join(cycle + [cycle[0]])
+            + f"{Bcolors.ENDC}"
+        )
+    if debug:
+        for name in graph.missing:
+            print(
+                f"{Bcolors.WARNING}[Warning] "
+                + name
+                + " references unknown jobs: "
+                + ", ".join(graph.missing[name])
+                + f"{Bcolors.ENDC}"
+            )
+
+
 # add REPEAT in matrix. if parallel is number then make the number = repeatNum * 4 (which is end-to-end job parallel number)
-def addRepeat(blocks, key, repeatNum):
-    repeatList = list(range(0, repeatNum))
-    parallelDic = {"matrix": [{"REPEAT": repeatList}]}
-    if "parallel" not in blocks[key]:
-        blocks[key]["parallel"] = parallelDic
+# every matrix entry gets REPEAT values repeatStart .. repeatStart + repeatNum - 1
+# blocks[key] is replaced by a changed copy, the job it held (parsed or cleaned) is not modified
+def addRepeat(blocks, key, repeatNum, repeatStart=0, parallel=None):
+    repeatList = list(range(repeatStart, repeatStart + repeatNum))
+    block = dict(blocks[key])
+    if parallel is None:
+        parallel = block.get("parallel")
+    if parallel is None:
+        block["parallel"] = {"matrix": [{REPEAT: repeatList}]}
+    elif isinstance(parallel, int):
+        block["parallel"] = repeatNum * parallel
     else:
-        if isinstance(blocks[key]["parallel"], int):
-            blocks[key]["parallel"] = repeatNum * blocks[key]["parallel"]
-        else:
-            blocks[key]["parallel"]["matrix"][0]["REPEAT"] = repeatList
+        parallel = dict(parallel)
+        matrix = []
+        for m in parallel["matrix"]:
+            m = dict(m)
+            m[REPEAT] = list(repeatList)
+            matrix.append(m)
+        parallel["matrix"] = matrix
+        block["parallel"] = parallel
+    blocks[key] = block
+
+
+# countJobInstances: number of jobs GitLab creates from one job definition
+def countJobInstances(block):
+    if type(block) is not dict or PARALLEL not in block:
+        return 1
+    parallel = block[PARALLEL]
+    if isinstance(parallel, int):
+        return parallel
+    if type(parallel) is not dict or not isinstance(parallel.get(MATRIX), list):
+        return 1
+    count = 0
+    for m in parallel[MATRIX]:
+        size = 1
+        if type(m) is dict:
+            for var in m:
+                if isinstance(m[var], list):
+                    size *= len(m[var])
+        count += size
+    return count
+
+
+# planRepeat: split repeatNum repeats of a job into shards which stay under GitLab's MAXPARALLEL jobs each
+# OUTPUT: list of (first REPEAT value, repeats in the shard), one item when no sharding is needed
+def planRepeat(block, repeatNum, name=""):
+    perRepeat = max(countJobInstances(block), 1)
+    if perRepeat > MAXPARALLEL:
+        sys.exit(
+            f"{Bcolors.FAIL}[Input Error] "
+            + name
+            + " already expands to "
+            + str(perRepeat)
+            + " jobs, GitLab allows "
+            + str(MAXPARALLEL)
+            + f", please select subjobs{Bcolors.ENDC}"
+        )
+    perShard = MAXPARALLEL // perRepeat
+    return [
+        (start, min(perShard, repeatNum - start))
+        for start in range(0, repeatNum, perShard)
+    ]
+
+
+# planShards: repeat plan of every target job, from their effective (extends merged) definitions
+# OUTPUT: {job name: [(first REPEAT value, repeats in the shard)]}, empty when nothing is repeated
+def planShards(jobs, targetJobs, repeatNum, resolver=None):
+    resolver = resolver or ExtendsResolver(jobs)
+    plan = {}
+    if repeatNum > 0:
+        for name in targetJobs:
+            plan[name] = planRepeat(resolver.effective(name), repeatNum, name)
+    return plan
+
+
+# getShardNames: job names of the shards, the job keeps its name when it is not sharded
+def getShardNames(name, shards):
+    if len(shards) == 1:
+        return [name]
+    return [name + SHARDSUFFIX + str(i) for i in range(1, len(shards) + 1)]
+
+
+# rewireNeeds: point needs/dependencies on sharded jobs to all of their shards
+# INPUT: job block, {job name: shard names} of the sharded jobs
+# OUTPUT: the block, or a copy with new needs/dependencies lists when something was rewired
+def rewireNeeds(block, shardNames):
+    if type(block) is not dict:
+        return block
+    newBlock = block
+    for key in [NEEDS, DEPEN]:
+        if not isinstance(block.get(key), list):
+            continue
+        items = []
+        changed = False
+        for item in block[key]:
+            if isinstance(item, str) and item in shardNames:
+                items.extend(shardNames[item])
+                changed = True
+            elif (
+                type(item) is dict
+                and item.get("job") in shardNames
+                and "project" not in item
+                and "pipeline" not in item
+            ):
+                for shard in shardNames[item["job"]]:
+                    items.append(dict(item, job=shard))
+                changed = True
+            else:
+                items.append(item)
+        if changed:
+            if newBlock is block:
+                newBlock = dict(block)
+            newBlock[key] = items
+    return newBlock
+
+
+# rewireTemplates: point extends and !reference on sharded jobs to the hidden templates holding their definitions
+# INPUT: job block, {job name: template name} of the sharded jobs
+# OUTPUT: the block, or a copy with the extends/!reference values rewired
+def rewireTemplates(block, templates):
+    newBlock = rewireReferences(block, templates)
+    if type(newBlock) is not dict:
+        return newBlock
+    extends = newBlock.get(EXTENDS)
+    if isinstance(extends, str) and extends in templates:
+        newBlock = dict(newBlock)
+        newBlock[EXTENDS] = templates[extends]
+    elif isinstance(extends, list) and any(e in templates for e in extends if isinstance(e, str)):
+        newBlock = dict(newBlock)
+        newBlock[EXTENDS] = [templates.get(e, e) if isinstance(e, str) else e for e in extends]
+    return newBlock
+
+
+# rewireReferences: value with `!reference [name, ...]` tags on sharded jobs pointing to their templates instead
+# OUTPUT: the value itself when nothing is rewired, else a copy of the changed path only
+def rewireReferences(value, templates):
+    if isinstance(value, Tagged):
+        ref = value.value
+        if value.tag == REFERENCE and isinstance(ref, list) and ref and ref[0] in templates:
+            return Tagged(value.tag, [templates[ref[0]]] + ref[1:])
+        inner = rewireReferences(ref, templates)
+        return value if inner is ref else Tagged(value.tag, inner)
+    if type(value) is dict:
+        items = {k: rewireReferences(value[k], templates) for k in value}
+        return value if all(items[k] is value[k] for k in value) else items
+    if type(value) is list:
+        items = [rewireReferences(v, templates) for v in value]
+        return value if all(a is b for a, b in zip(items, value)) else items
+    return value
+
+
+# printShardPlan: tell which target jobs are split to stay under GitLab's job limit
+def printShardPlan(jobs, plan, resolver=None):
+    resolver = resolver or ExtendsResolver(jobs)
+    for name in plan:
+        if len(plan[name]) > 1:
+            total = sum(count for _, count in plan[name])
+            print(
+                "Sharding "
+                + f"{Bcolors.OKCYAN}"
+                + name
+                + f"{Bcolors.ENDC}: "
+                + str(total * max(countJobInstances(resolver.effective(name)), 1))
+                + " jobs in "
+                + str(len(plan[name]))
+                + " shards ("
+                + ", ".join(getShardNames(name, plan[name]))
+                + ")"
+            )
+
+
+# scanTopLevelKeys: top level keys of a yaml file found by looking at unindented lines only, without parsing
+# OUTPUT: list of keys, None if the file uses syntax the scan cannot be sure about (then it has to be parsed)
+TOPLEVELKEY = re.compile(r"""^(?:"([^"]*)"|'([^']*)'|([^\s#][^#]*?))\s*:(?:\s|$)""")
+# anchors and aliases in yaml text, also matches inside strings and comments (then a file is just dumped again)
+ANCHOR = re.compile(rb"(?:^|[\s\[{,])&([^\s,\[\]{}]+)")
+ALIAS = re.compile(rb"(?:^|[\s\[{,])\*([^\s,\[\]{}]+)")
 
 
-# selectWriteBack: read files again, then write back with: first skip unnecessary jobs, and for the rest jobs, select from cleaned matrix jobs and repeat target jobs
-# INPUT: jobs in minimum path, all jobs with reduced/cleaned matrix, yaml files list
-def selectWriteBack(dirToYaml, minimumJobs, cleanedJobs, yamlFiles, targetJobs, repeatNum):
+def scanTopLevelKeys(text):
+    spans = scanTopLevelSpans(text.encode(UTF_8))
+    if spans is None:
+        return None
+    return [key for key, start, end in spans]
+
+
+# scanTopLevelSpans: byte span of every top level key of a yaml file, same scan as scanTopLevelKeys
+# OUTPUT: list of (key, start, end), a span runs from the key line to the next key line (comments and blank lines
+#         after a block belong to it), None if the file uses syntax the scan cannot be sure about
+def scanTopLevelSpans(content):
+    spans = []
+    pos = 0
+    for line in content.splitlines(keepends=True):
+        start = pos
+        pos += len(line)
+        if line[:1] in (b"", b" ", b"\t", b"#", b"\r", b"\n") or line.startswith((b"---", b"...", b"%")):
+            continue
+        # a sequence may start at column 0 under its key (`stages:` then `- build`)
+        if spans and line[:2] in (b"- ", b"-\n", b"-\r"):
+            continue
+        if line[:1] in (b"?", b"{", b"[", b"&", b"*", b"!", b"|", b">", b"-") or line.startswith(b"<<"):
+            return None
+        m = TOPLEVELKEY.match(line.decode(UTF_8, "replace").rstrip("\r\n"))
+        if m is None:
+            return None
+        key = m.group(3)
+        if key is None:
+            key = m.group(1) if m.group(1) is not None else m.group(2)
+        if spans:
+            spans[-1][2] = start
+        spans.append([key, start, len(content)])
+    return [tuple(span) for span in spans]
+
+
+# IncludeResolver: build the job set from a root .gitlab-ci.yml by following `include:`
+# local includes are read from the repository, the other kinds from a local mirror directory so it works offline:
+#   template: name              -> <mirror>/templates/<name>
+#   project: p, file: f         -> <mirror>/projects/<p>/<f>
+#   remote: https://host/path   -> <mirror>/remote/<host>/<path>
+# every included file is only scanned for its top level keys, and only parsed when it defines a job reachable from the targets,
+# a global keyword or further includes. Files included several times are loaded once.
+class IncludeResolver:
+    def __init__(self, repoDir, rootFile=ROOTCONFIG, mirrorDir=None, cache=None):
+        self.repoDir = os.path.join(os.path.abspath(repoDir), "")
+        self.rootPath = os.path.join(self.repoDir, rootFile)
+        self.mirrorDir = os.path.join(
+            os.path.abspath(
+                mirrorDir
+                or os.environ.get(
+                    "GITLAB_CI_MIRROR", os.path.join(self.repoDir, ".gitlab-ci-mirror")
+                )
+            ),
+            "",
+        )
+        self.cache = cache
+        self.order = []  # files in GitLab merge order, included files before the file including them
+        self.owners = {}  # key -> files defining it, in merge order
+        self.parsed = {}  # file -> parsed blocks, only files which had to be loaded
+        self.entryPaths = {}  # (file, include entry position) -> files the entry resolved to
+        self.keyIndex = {}  # file -> scanned top level keys
+        self.missingIncludes = []
+        self._discovered = False
+
+    # files of the repository itself, the only ones written back
+    def isLocal(self, path):
+        return path.startswith(self.repoDir) and not path.startswith(self.mirrorDir)
+
+    # cache/index key of a file: relative for files of the repository, absolute for mirror files
+    def fileKey(self, path):
+        if self.isLocal(path):
+            return path[len(self.repoDir) :]
+        return path
+
+    def _parse(self, path):
+        if path not in self.parsed:
+            if self.cache is not None:
+                y = self.cache.loadFile(path, self.fileKey(path))
+            else:
+                with open(path, "r") as f:
+                    y = yamlLoad(f.read())
+            self.parsed[path] = y if type(y) is dict else {}
+        return self.parsed[path]
+
+    # resolveEntry: files one include entry points to
+    # INPUT: include entry (string or hash), root directory local paths are relative to (None if local includes are not allowed)
+    # OUTPUT: list of (absolute path, root directory for its own local includes)
+    def resolveEntry(self, entry, localRoot):
+        if isinstance(entry, str):
+            if entry.startswith(("http://", "https://")):
+                entry = {"remote": entry}
+            else:
+                entry = {"local": entry}
+        if type(entry) is not dict:
+            return []
+        if "local" in entry:
+            if localRoot is None:
+                return []
+            pattern = os.path.join(localRoot, entry["local"].lstrip("/"))
+            if "*" in pattern:
+                pattern = pattern.replace("**", "**/*").replace("**/**/*", "**/*")
+                paths = sorted(glob.glob(pattern, recursive=True))
+            else:
+                paths = [pattern]
+            return [(p, localRoot) for p in paths]
+        if "template" in entry:
+            return [(os.path.join(self.mirrorDir, "templates", entry["template"]), None)]
+        if "project" in entry:
+            projectRoot = os.path.join(self.mirrorDir, "projects", entry["project"])
+            files = entry.get("file", [])
+            if isinstance(files, str):
+                files = [files]
+            return [(os.path.join(projectRoot, f.lstrip("/")), projectRoot) for f in files]
+        if "remote" in entry:
+            url = entry["remote"].split("://", 1)[-1]
+            return [(os.path.join(self.mirrorDir, "remote", url), None)]
+        return []
+
+    # _discover: walk the include tree from the root file, scanning keys and parsing only files with includes
+    def _discover(self):
+        if self._discovered:
+            return
+        self._discovered = True
+        visited = set()
+        stack = [(self.rootPath, self.repoDir, False)]
+        while stack:
+            path, localRoot, expanded = stack.pop()
+            if expanded:
+                # all includes of the file are merged, now the file itself
+                self.order.append(path)
+                keys = list(self.parsed[path]) if path in self.parsed else self.keyIndex[path]
+                for key in keys:
+                    if key != INCLUDE:
+                        self.owners.setdefault(key, []).append(path)
+                continue
+            if path in visited:
+                continue
+            visited.add(path)
+            if not os.path.isfile(path):
+                self.missingIncludes.append(path)
+                continue
+            with open(path, "r") as f:
+                keys = scanTopLevelKeys(f.read())
+            self.keyIndex[path] = keys
+            blocks = {}
+            if keys is None or INCLUDE in keys:
+                blocks = self._parse(path)
+            stack.append((path, localRoot, True))
+            entries = blocks.get(INCLUDE, [])
+            if not isinstance(entries, list):
+                entries = [entries]
+            pending = []
+            for pos, entry in enumerate(entries):
+                resolved = self.resolveEntry(entry, localRoot)
+                self.entryPaths[(path, pos)] = [p for p, _ in resolved]
+                pending.extend(resolved)
+            # first include is merged first, so it has to be on top of the stack
+            for included, includedRoot in reversed(pending):
+                stack.append((included, includedRoot, False))
+
+    # mergedBlock: the definition of one key over every loaded file
+    def mergedBlock(self, key):
+        block = None
+        for path in self.owners.get(key, []):
+            blocks = self._parse(path)
+            if key in blocks:
+                block = blocks[key] if block is None else mergeBlocks(block, blocks[key])
+        return block
+
+    # loadFor: load every file defining the targets, their dependencies (needs, dependencies, extends, !reference) and global keywords
+    # OUTPUT: jobs (like getAllConfig), yaml files of the repository to write back (relative to repoDir), file index
+    @timed("IncludeResolver.loadFor")
+    def loadFor(self, targets):
+        self._discover()
+        pending = [key for key in self.owners if key in GLOBALKEYWORDS]
+        pending.extend(targets)
+        seen = set()
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            block = self.mergedBlock(name)
+            pending.extend(getDirectDependencies(block))
+        return self._assemble()
+
+    # loadAll: load every included file, those not parsed during discovery together (in parallel when they are large)
+    def loadAll(self):
+        self._discover()
+        pending = [path for path in self.order if path not in self.parsed]
+        keys = [self.fileKey(path) for path in pending]
+        for path, y in zip(pending, parseFiles(pending, keys, self.cache)):
+            self.parsed[path] = y if type(y) is dict else {}
+        return self._assemble()
+
+    def _assemble(self):
+        jobs = {}
+        yamlFiles = []
+        fileIndex = {}
+        for path in self.order:
+            if path not in self.parsed:
+                continue
+            blocks = self.parsed[path]
+            for j in blocks:
+                if j == INCLUDE:
+                    continue
+                jobs[j] = mergeBlocks(jobs[j], blocks[j]) if j in jobs else blocks[j]
+            if self.isLocal(path):
+                fn = self.fileKey(path)
+                yamlFiles.append(fn)
+                fileIndex[fn] = blocks
+        self._pruneIncludes(fileIndex)
+        return jobs, yamlFiles, fileIndex
+
+    # _pruneIncludes: drop include entries of which no file had to be loaded, the minimum pipeline does not need them
+    # Note : files a kept entry loads are written back pruned, a glob matching files which were not loaded would still
+    #        bring those in unpruned, so it is replaced by one `local:` entry per loaded file
+    def _pruneIncludes(self, fileIndex):
+        for fn in fileIndex:
+            blocks = fileIndex[fn]
+            if INCLUDE not in blocks:
+                continue
+            path = os.path.join(self.repoDir, fn)
+            entries = blocks[INCLUDE]
+            single = not isinstance(entries, list)
+            if single:
+                entries = [entries]
+            kept = []
+            for pos, entry in enumerate(entries):
+                paths = self.entryPaths.get((path, pos), [])
+                loaded = [p for p in paths if p in self.parsed]
+                if len(loaded) == len(paths):
+                    if loaded:
+                        kept.append(entry)
+                    continue
+                for p in loaded:
+                    local = "/" + self.fileKey(p)
+                    kept.append(dict(entry, local=local) if type(entry) is dict else local)
+            if kept:
+                blocks[INCLUDE] = kept[0] if single else kept
+            else:
+                del blocks[INCLUDE]
+
+    # cacheKeys: ConfigCache keys of every file loaded, used to key the dependency closures
+    def cacheKeys(self):
+        return [self.fileKey(p) for p in self.order if p in self.parsed]
+
+
+# planWriteBack: how the target jobs are repeated, shared by every file rendered for one target set
+# OUTPUT: ExtendsResolver of cleanedJobs, shard plan from planShards, job -> shard names of the jobs split in several shards,
+#         job -> hidden template keeping the definition of a sharded job (the shards extend it)
+def planWriteBack(cleanedJobs, targetJobs, repeatNum):
+    # repeats go into the effective parallel section, it may be inherited through extends
+    resolver = ExtendsResolver(cleanedJobs)
+    # repeated jobs over GitLab's job limit are split into job-shard-1..N, jobs needing them need every shard
+    shardPlan = planShards(cleanedJobs, targetJobs, repeatNum, resolver)
+    printShardPlan(cleanedJobs, shardPlan, resolver)
+    shardNames = {}
+    templates = {}
+    for name in shardPlan:
+        if len(shardPlan[name]) > 1:
+            shardNames[name] = getShardNames(name, shardPlan[name])
+            # jobs extending or referencing the sharded job point to the template instead
+            templates[name] = "." + name
+            if templates[name] in cleanedJobs:
+                sys.exit(
+                    f"{Bcolors.FAIL}[Input Error] "
+                    + name
+                    + " has to be sharded, but its template name "
+                    + templates[name]
+                    + f" is taken by another key{Bcolors.ENDC}"
+                )
+    return resolver, shardPlan, shardNames, templates
+
+
+# loadFileBlocks: parsed blocks of one file and its original bytes (None when the blocks come from memory)
+# see renderWriteBack for the kinds of fileIndex
+def loadFileBlocks(dirToYaml, fn, minimumJobs, fileIndex):
+    if isinstance(fileIndex, CompactConfig):
+        return fileIndex.blocks(fn, minimumJobs), None
+    if fileIndex is not None and fn in fileIndex:
+        return fileIndex[fn], None
+    with open(dirToYaml + fn, "rb") as f:
+        original = f.read()
+    return parseYamlBytes(original), original
+
+
+# selectFileBlocks: kept blocks of one file, the cleaned matrix and repeats applied
+# OUTPUT: new blocks in file order, parts: (key, None when its block is the parsed one, else the blocks replacing it)
+def selectFileBlocks(blocks, minimumJobs, cleanedJobs, fileIndex, plan):
+    resolver, shardPlan, shardNames, templates = plan
+    compact = isinstance(fileIndex, CompactConfig)
+    newBlocks = {}
+    parts = []
+    for bKey in blocks:
+        if bKey in minimumJobs:
+            if compact:
+                block = fileIndex.restore(blocks[bKey], cleanedJobs.get(bKey))
+            elif bKey in cleanedJobs:
+                block = cleanedJobs[bKey]
+            else:
+                block = blocks[bKey]
+            if shardNames:
+                block = rewireTemplates(rewireNeeds(block, shardNames), templates)
+            if bKey not in shardPlan:
+                newBlocks[bKey] = block
+                parts.append((bKey, None if block is blocks[bKey] else {bKey: block}))
+                continue
+            names = getShardNames(bKey, shardPlan[bKey])
+            effective = resolver.effective(bKey)
+            if bKey in templates:
+                # the definition is kept once as a hidden template, each shard extends it with its own parallel section
+                newBlocks[templates[bKey]] = block
+                parallel = effective.get(PARALLEL)
+                for name, (start, count) in zip(names, shardPlan[bKey]):
+                    newBlocks[name] = {EXTENDS: templates[bKey]}
+                    addRepeat(newBlocks, name, count, start, copy.deepcopy(parallel))
+                names = [templates[bKey]] + names
+            else:
+                start, count = shardPlan[bKey][0]
+                newBlocks[bKey] = block
+                addRepeat(newBlocks, bKey, count, start, effective.get(PARALLEL))
+            parts.append((bKey, {name: newBlocks[name] for name in names}))
+    return newBlocks, parts
+
+
+# renderWriteBack: build the new content of every file: first skip unnecessary jobs, and for the rest jobs, select from cleaned matrix jobs and repeat target jobs
+# INPUT: jobs in minimum path, all jobs with reduced/cleaned matrix, yaml files list, file index from getAllConfig
+# OUTPUT: list of (file name, new content as utf-8 bytes) of the files which change, nothing is written
+# Note : without fileIndex every file is read and parsed again to learn which keys it holds.
+#        With a CompactConfig as fileIndex, cleanedJobs only hold the graph part of the jobs: the full blocks come from
+#        the files parsed again, with the cleaned parallel sections put back, and files without kept keys are not parsed.
+#        Kept blocks are copied from the original text by spliceWriteBack, only changed ones are dumped again
+@timed()
+def renderWriteBack(
+    dirToYaml, minimumJobs, cleanedJobs, yamlFiles, targetJobs, repeatNum, fileIndex=None
+):
+    contents = []
+    plan = planWriteBack(cleanedJobs, targetJobs, repeatNum)
     for fn in yamlFiles:
         # filter to get mini blocks for the file
-        newBlocks = {}
-        with open(dirToYaml + fn, "r") as f:
-            blocks = yaml.load(f.read(), Loader=PipeLoader)
-            for bKey in blocks:
-                if bKey in minimumJobs:
-                    if bKey in cleanedJobs:
-                        newBlocks[bKey] = cleanedJobs[bKey]
-                        if bKey in targetJobs and repeatNum > 0:
-                            addRepeat(newBlocks, bKey, repeatNum)
-                    else:
-                        newBlocks[bKey] = blocks[bKey]
-                        if bKey in targetJobs and repeatNum > 0:
-                            addRepeat(newBlocks, bKey, repeatNum)
+        blocks, original = loadFileBlocks(dirToYaml, fn, minimumJobs, fileIndex)
+        newBlocks, parts = selectFileBlocks(blocks, minimumJobs, cleanedJobs, fileIndex, plan)
 
         # put a place holder for the file, if we removed all origin content of the file
         if newBlocks == {}:
             newBlocks[".emptyPlaceHolder"] = {}
             newBlocks[".emptyPlaceHolder"]["variables"] = []
+            contents.append((fn, yamlDump(newBlocks)))
+            continue
+
+        if original is None:
+            try:
+                with open(dirToYaml + fn, "rb") as f:
+                    original = f.read()
+            except OSError:
+                original = b""
+        content = spliceWriteBack(original, blocks, parts)
+        if content is None:
+            content = yamlDump(newBlocks)
+        # nothing was dropped or changed, the file is not written
+        if content != original:
+            contents.append((fn, content))
+    return contents
+
+
+# spliceWriteBack: new content of one file built from its original bytes, kept blocks which did not change are copied
+# with their comments, anchors and formatting, the others (pruned matrix, REPEAT, shards, rewired needs) are dumped again
+# INPUT: original file content, its parsed blocks, parts from renderWriteBack
+# OUTPUT: utf-8 bytes, None when the text cannot be split safely: the scan fails, its keys are not the parsed ones, or
+#         a copied block uses an anchor (`*name`, `<<: *name`) of a block which is dropped or dumped again
+def spliceWriteBack(original, blocks, parts):
+    spans = scanTopLevelSpans(original)
+    if not spans:
+        return None
+    # IncludeResolver drops an include: whose files are all pruned, the other keys must be the parsed ones in order
+    keys = [key for key, start, end in spans if key != INCLUDE or key in blocks]
+    if keys != list(blocks):
+        return None
+    spanOf = {key: (start, end) for key, start, end in spans}
+    pieces = [original[: spans[0][1]]]
+    anchors = set()
+    for bKey, dumped in parts:
+        start, end = spanOf[bKey]
+        text = original[start:end]
+        # include: is pruned in place, its text may still list files which are not needed
+        if dumped is None and bKey == INCLUDE and yamlLoad(text.decode(UTF_8)) != {bKey: blocks[bKey]}:
+            dumped = {bKey: blocks[bKey]}
+        if dumped is not None:
+            pieces.append(yamlDump(dumped))
+            continue
+        defined = set(ANCHOR.findall(text))
+        if b"*" in text and not set(ALIAS.findall(text)) <= anchors | defined:
+            return None
+        anchors.update(defined)
+        pieces.append(text if text.endswith(b"\n") else text + b"\n")
+    return b"".join(pieces)
+
+
+# selectWriteBack: write the files rendered by renderWriteBack back in place
+@timed()
+def selectWriteBack(
+    dirToYaml, minimumJobs, cleanedJobs, yamlFiles, targetJobs, repeatNum, fileIndex=None
+):
+    writeContents(
+        dirToYaml,
+        renderWriteBack(
+            dirToYaml, minimumJobs, cleanedJobs, yamlFiles, targetJobs, repeatNum, fileIndex
+        ),
+    )
 
+
+# writeContents: write rendered (file name, content) pairs in place
+@timed()
+def writeContents(dirToYaml, contents):
+    for fn, content in contents:
         # write new back
-        with open(dirToYaml + fn, "w") as f:
-            yaml.dump(
-                newBlocks,
-                f,
-                sort_keys=False,
-                allow_unicode=True,
-                encoding=UTF_8,
-                Dumper=PipeDumper,
-            )
+        with open(dirToYaml + fn, "wb") as f:
+            f.write(content)
 
 
 # splitArgument: split the targetName and subjob out of input
-# INPUT: 'targetName:[subjob]' or 'targetName parallel-part'
-# OUTPUT: targetName, subjob
+# INPUT: 'targetName:[subjob]', 'targetName:[value1, value2]' or 'targetName parallel-part'
+# OUTPUT: targetName, subjob ("" for all subjobs, a tuple of values for a multi-variable combination)
 def splitArgument(input):
     if "[" in input or "]" in input:
         input = input.replace(" ", "")
@@ -201,8 +1743,8 @@ def splitArgument(input):
             )
         elif len(result) == 2:
             if "," in result[1]:
-                subjobs = result[1].split(",")
-                return result[0], subjobs[0]
+                # 'job: [a, b]' is one combination of a multi-variable matrix entry
+                return result[0], tuple(result[1].split(","))
             elif result[1].isnumeric():
                 return result[0], ""
             else:
@@ -214,41 +1756,161 @@ def splitArgument(input):
     return input, ""
 
 
+# formatSubjob: subjob as shown in messages
+def formatSubjob(subjob):
+    if isinstance(subjob, tuple):
+        return "[" + ", ".join(subjob) + "]"
+    return subjob
+
+
+# matrix variable values as strings, a scalar value is a list of one
+def getMatrixValues(values):
+    if not isinstance(values, list):
+        values = [values]
+    return [str(v) for v in values]
+
+
+# MatrixIndex: precomputed lookup of parallel:matrix values, built once per job on first use
+# job -> (entry position, variable) -> value set, and job -> value -> [(entry position, variable)]
+# so validating and filtering subjobs are hash lookups instead of scans over every entry
+class MatrixIndex:
+    def __init__(self, jobs, resolver=None):
+        self.jobs = jobs
+        self.resolver = resolver or ExtendsResolver(jobs)
+        self._entries = {}
+        self._values = {}
+
+    # block: effective definition of the job, its matrix may come from a template
+    def block(self, job):
+        return self.resolver.effective(job)
+
+    # hasMatrix: job has a parallel:matrix section
+    def hasMatrix(self, job):
+        block = self.block(job)
+        return (
+            type(block) is dict
+            and type(block.get(PARALLEL)) is dict
+            and isinstance(block[PARALLEL].get(MATRIX), list)
+        )
+
+    # entries: {(entry position, variable): value set}
+    def entries(self, job):
+        if job not in self._entries:
+            entries = {}
+            values = {}
+            if self.hasMatrix(job):
+                for pos, m in enumerate(self.block(job)[PARALLEL][MATRIX]):
+                    if type(m) is not dict:
+                        continue
+                    for var in m:
+                        entries[(pos, var)] = set(getMatrixValues(m[var]))
+                        for value in entries[(pos, var)]:
+                            values.setdefault(value, []).append((pos, var))
+            self._entries[job] = entries
+            self._values[job] = values
+        return self._entries[job]
+
+    # find: (entry position, variable) pairs holding the value
+    def find(self, job, value):
+        self.entries(job)
+        return self._values[job].get(value, [])
+
+    # findCombination: entry positions whose variables, in order, hold the values of the combination
+    def findCombination(self, job, combination):
+        entries = self.entries(job)
+        found = []
+        for pos, m in enumerate(self.block(job)[PARALLEL][MATRIX]):
+            if type(m) is not dict or len(m) != len(combination):
+                continue
+            if all(value in entries[(pos, var)] for var, value in zip(m, combination)):
+                found.append(pos)
+        return found
+
+    # hasWidth: some entry of the job's matrix has that many variables
+    def hasWidth(self, job, width):
+        return any(
+            type(m) is dict and len(m) == width for m in self.block(job)[PARALLEL][MATRIX]
+        )
+
+    # hasSubjob: single value or combination exists in the job's matrix
+    def hasSubjob(self, job, subjob):
+        if isinstance(subjob, tuple):
+            return len(self.findCombination(job, subjob)) > 0
+        return len(self.find(job, subjob)) > 0
+
+
 #  cleanMatrix: if there are jobs(keys of TargetDic) mentioned in TargetDic then only keep subjobs (values of TargetDic) mentioned in TargetsDic
-#  INPUT: all the jobs, the dic of targets and their subjobs
+#  INPUT: all the jobs, the dic of targets and their subjobs, MatrixIndex of the jobs (optional)
 #  OUTPUT: all the jobs after remove unnecessary subjobs
 #  Note : subjob for the target job may empty which means needs all subjobs, even the target job show up with subjob again, we still need to keep all of them
-def cleanMatrix(jobs, TargetsDic):
+#         single values keep only those values of the variables holding them, combinations become their own one-value entries,
+#         entries without any requested subjob are dropped. The parsed matrix is not modified, the job gets a new parallel section
+#         built from its effective one, which overrides a matrix inherited through extends
+@timed()
+def cleanMatrix(jobs, TargetsDic, matrixIndex=None):
+    if matrixIndex is None:
+        matrixIndex = MatrixIndex(jobs)
     for jobName in TargetsDic:
         subjobs = TargetsDic[jobName]
-        if "" in subjobs:
+        if "" in subjobs or not matrixIndex.hasMatrix(jobName):
             continue
-        block = jobs[jobName]
-        for m in block[PARALLEL][MATRIX]:
-            # find correct section
-            for mk in m:
-                if list(subjobs)[0] in list(m[mk]):
-                    # create new matrix
-                    newm = []
-                    for pkg in list(m[mk]):
-                        if pkg in subjobs:
-                            newm.append(pkg)
-                    # replace matrix
-                    m[mk] = newm
+        effective = matrixIndex.block(jobName)
+        matrix = effective[PARALLEL][MATRIX]
+        # entry position -> variable -> kept values
+        keep = {}
+        combinations = []
+        for subjob in subjobs:
+            if isinstance(subjob, tuple):
+                for pos in matrixIndex.findCombination(jobName, subjob):
+                    combinations.append(
+                        {var: [value] for var, value in zip(matrix[pos], subjob)}
+                    )
+            else:
+                for pos, var in matrixIndex.find(jobName, subjob):
+                    keep.setdefault(pos, {}).setdefault(var, set()).add(subjob)
+        newMatrix = []
+        for pos in sorted(keep):
+            newm = {}
+            for var in matrix[pos]:
+                values = matrix[pos][var]
+                if var in keep[pos] and isinstance(values, list):
+                    # keep the original values (and order) of the requested subjobs
+                    values = [v for v in values if str(v) in keep[pos][var]]
+                newm[var] = values
+            newMatrix.append(newm)
+        for combination in combinations:
+            if combination not in newMatrix:
+                newMatrix.append(combination)
+        parallel = dict(effective[PARALLEL])
+        parallel[MATRIX] = newMatrix
+        jobs[jobName] = dict(jobs[jobName])
+        jobs[jobName][PARALLEL] = parallel
     return jobs
 
 
-# get failed list from glab-cli by branch or commit
-def getFailedListFromGlab(branch=""):
+# get failed list by branch or commit from the GitLab API (REST client, or `glab api` as fallback)
+def getFailedListFromGlab(branch="", api=None, durations=None):
+    from gitlab_api import GitLabApiError, getApiBackend
+
     print(
         "Getting failed jobs from: " + f"{Bcolors.OKCYAN}" + branch + f"{Bcolors.ENDC}"
     )
-    branchFlag = "--branch=" + branch
-    result = subprocess.run(
-        "glab ci status " + branchFlag, shell=True, capture_output=True
-    )
+    if api is None:
+        api = getApiBackend()
+    try:
+        state = api.getPipelineState(branch)
+    except GitLabApiError as e:
+        sys.exit(f"{Bcolors.FAIL}[Error] " + str(e) + f"{Bcolors.ENDC}")
+    pipeline = state["pipeline"]
+    if pipeline is None:
+        sys.exit(
+            f"{Bcolors.FAIL}[Error] There is no pipeline for branch/commit: "
+            + branch
+            + f"{Bcolors.ENDC}"
+        )
+    jobs = state["jobs"]
     # check if pipeline state is running
-    if "Pipeline State: running" in result.stdout.decode("utf-8"):
+    if pipeline["status"] == "running":
         while True:
             inputMsg = (
                 "Pipeline is still running for branch/commit: "
@@ -266,32 +1928,27 @@ def getFailedListFromGlab(branch=""):
                 print(
                     f"{Bcolors.WARNING} Invalid input, answer y/yes, n/no{Bcolors.ENDC}"
                 )
-    result = subprocess.run(
-        "glab ci status " + branchFlag + '| grep "(' + FAILED + ')"',
-        shell=True,
-        capture_output=True,
-    )
-    failStr = result.stdout.decode(UTF_8)
-    if failStr == "":
+        # jobs may have failed while waiting for the answer
+        jobs = api.getPipelineJobs(pipeline["id"])
+    if durations is not None:
+        durations.record(jobs)
+        durations.save()
+    failedNames = []
+    for job in jobs:
+        if job["status"] == FAILED and job["name"] not in failedNames:
+            failedNames.append(job["name"])
+    if len(failedNames) == 0:
         sys.exit(
             f"{Bcolors.FAIL}[Error] There is no failed job in branch/commit: "
             + branch
             + f"{Bcolors.ENDC}"
         )
-    failList = failStr.split("\n")
-    failedNames = []
-    for failedJob in failList:
-        # filter un-useful jobs
-        if "\t\t" not in failedJob:
-            continue
-        arr = failedJob.split("\t\t")
-        failedNames.append(arr[1].strip())
     return failedNames
 
 
 # validate gitlab-cli is installed and verify user is authenticated
 def validateGlab():
-    result = subprocess.run("glab auth status", shell=True, capture_output=True)
+    result = runCommand("glab auth status", shell=True, capture_output=True)
     output = result.stderr.decode(UTF_8)
     if "No such file or directory" in output or "not found" in output:
         sys.exit(
@@ -306,7 +1963,7 @@ def validateGlab():
 
 
 # validate target job is exist, exit if anything wrong
-def validateTargetJobs(targetName, subJobName, jobs):
+def validateTargetJobs(targetName, subJobName, jobs, matrixIndex=None):
     # validate jobs exist
     if targetName not in jobs:
         sys.exit(
@@ -315,30 +1972,28 @@ def validateTargetJobs(targetName, subJobName, jobs):
             + f"] not found!  Please check, if you are using make, add arguments like this: args='job:[subjob], ...'{Bcolors.ENDC}"
         )
     if subJobName != "":
-        block = jobs[targetName]
-        if PARALLEL not in block:
+        if matrixIndex is None:
+            matrixIndex = MatrixIndex(jobs)
+        # the parallel section may be inherited through extends
+        block = matrixIndex.block(targetName)
+        if type(block) is not dict or PARALLEL not in block:
             sys.exit(
                 f"{Bcolors.FAIL}[Input Error] There is no Parallel section in "
                 + targetName
                 + f"{Bcolors.ENDC}"
             )
-        if MATRIX not in block[PARALLEL]:
+        if type(block[PARALLEL]) is not dict or MATRIX not in block[PARALLEL]:
             sys.exit(
                 f"{Bcolors.FAIL}[Input Error] There is no Matrix in "
                 + targetName
-                + +f"{Bcolors.ENDC}"
+                + f"{Bcolors.ENDC}"
             )
-        found = False
-        for m in block[PARALLEL][MATRIX]:
-            for mm in list(m.values()):
-                if subJobName in mm:
-                    found = True
-        if found == False:
+        if not matrixIndex.hasSubjob(targetName, subJobName):
             sys.exit(
                 f"{Bcolors.FAIL}"
                 + "[Input Error] Subjob: "
-                + subJobName
-                + "not found in "
+                + formatSubjob(subJobName)
+                + " not found in "
                 + targetName
                 + f"{Bcolors.ENDC}"
             )
@@ -347,7 +2002,7 @@ def validateTargetJobs(targetName, subJobName, jobs):
 def gitAdd(dirToYaml, debug):
     if debug:
         print(f"{Bcolors.WARNING}" + "Running git add" + f"{Bcolors.ENDC}")
-    result = subprocess.run("git add " + dirToYaml, shell=True)
+    result = runCommand("git add " + dirToYaml, shell=True)
     if result.returncode != 0:
         sys.exit(
             f"{Bcolors.FAIL}"
@@ -366,15 +2021,11 @@ def gitCommit(targetJobs, debug, noVerify):
     # will take no commit to seccess
     if debug:
         print(f"{Bcolors.WARNING}" + "Running git commit" + f"{Bcolors.ENDC}")
-    commitMsg = "[Don't merge this commit!] minimum pipeline for: " + ",".join(
-        targetJobs
-    )
+    commitMsg = getCommitMessage(targetJobs)
     nv = ""
     if noVerify:
         nv = " --no-verify"
-    if len(commitMsg) > 80:
-        commitMsg = commitMsg[:75] + " ..."
-    result = subprocess.run(
+    result = runCommand(
         'git commit -m "' + commitMsg + '"' + nv, shell=True, capture_output=True
     )
     if debug:
@@ -391,19 +2042,130 @@ def gitCommit(targetJobs, debug, noVerify):
         )
 
 
+# commit message for the minimum pipeline commit
+def getCommitMessage(targetJobs):
+    commitMsg = "[Don't merge this commit!] minimum pipeline for: " + ",".join(
+        targetJobs
+    )
+    if len(commitMsg) > 80:
+        commitMsg = commitMsg[:75] + " ..."
+    return commitMsg
+
+
+# runGitPlumbing: run one git plumbing command, exit with its error output if it fails
+# OUTPUT: stdout as string
+def runGitPlumbing(args, env=None, input=None, debug=False):
+    if debug:
+        print(f"{Bcolors.WARNING}" + "Running git " + " ".join(args) + f"{Bcolors.ENDC}")
+    result = runCommand(
+        ["git"] + args,
+        capture_output=True,
+        env=env,
+        input=input.encode(UTF_8) if input is not None else None,
+    )
+    if result.returncode != 0:
+        sys.exit(
+            f"{Bcolors.FAIL}"
+            + "[Git Error] git "
+            + args[0]
+            + " failed:\n"
+            + result.stderr.decode(UTF_8)
+            + f"{Bcolors.ENDC}"
+        )
+    return result.stdout.decode(UTF_8)
+
+
+# getHeadChanges: yaml files whose working tree content is not the one of HEAD (edited, staged or untracked)
+# renderWriteBack leaves out files it keeps whole, but both push flows build the commit on HEAD, so these
+# files have to be written even then or HEAD's version would be pushed in place of the local work
+# OUTPUT: list of (file name, working tree content as bytes)
+def getHeadChanges(dirToYaml, yamlFiles):
+    if not yamlFiles:
+        return []
+    repoTop = runGitPlumbing(["rev-parse", "--show-toplevel"]).strip()
+    names = {}
+    for fn in yamlFiles:
+        rel = os.path.relpath(os.path.abspath(dirToYaml + fn), repoTop)
+        names[rel.replace(os.sep, "/")] = fn
+    status = runGitPlumbing(
+        ["status", "--porcelain", "-z", "--untracked-files=all", "--"]
+        + [os.path.abspath(dirToYaml + fn) for fn in yamlFiles]
+    )
+    changes = []
+    entries = iter(status.split("\0"))
+    for entry in entries:
+        if entry[:1] in ("R", "C"):
+            # the source of a rename or copy follows as its own entry
+            next(entries, None)
+        fn = names.get(entry[3:])
+        if fn is not None:
+            with open(dirToYaml + fn, "rb") as f:
+                changes.append((fn, f.read()))
+    return changes
+
+
+# getCommitContents: files of the commit built on HEAD, the rendered ones and those kept whole which differ from HEAD
+# INPUT: contents from renderWriteBack, every yaml file of the config, yaml directory
+def getCommitContents(contents, yamlFiles, dirToYaml):
+    rendered = {fn for fn, content in contents}
+    return contents + getHeadChanges(dirToYaml, [fn for fn in yamlFiles if fn not in rendered])
+
+
+# gitCommitTree: commit new file contents on top of a commit with git plumbing only
+# a temporary index file is used, so the working tree, the real index and the stash are never touched
+# INPUT: list of (file path, content bytes), commit message, parent commit
+# OUTPUT: sha of the new commit, it is not on any branch until pushed
+@timed()
+def gitCommitTree(contents, commitMsg, debug, parent="HEAD"):
+    import tempfile
+
+    repoTop = runGitPlumbing(["rev-parse", "--show-toplevel"]).strip()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, "index"))
+        runGitPlumbing(["read-tree", parent], env, debug=debug)
+        blobPaths = []
+        for i, (path, content) in enumerate(contents):
+            blobPath = os.path.join(tmp, "blob" + str(i))
+            with open(blobPath, "wb") as f:
+                f.write(content)
+            blobPaths.append(blobPath)
+        # one process writes every blob
+        shas = runGitPlumbing(
+            ["hash-object", "-w", "--stdin-paths"], input="\n".join(blobPaths) + "\n"
+        ).split()
+        indexInfo = ""
+        for (path, content), sha in zip(contents, shas):
+            rel = os.path.relpath(os.path.abspath(path), repoTop)
+            indexInfo += "100644 " + sha + "\t" + rel.replace(os.sep, "/") + "\n"
+        runGitPlumbing(["update-index", "--index-info"], env, indexInfo, debug)
+        tree = runGitPlumbing(["write-tree"], env, debug=debug).strip()
+        commit = runGitPlumbing(
+            ["commit-tree", tree, "-p", parent, "-m", commitMsg], debug=debug
+        ).strip()
+    if debug:
+        print("Created commit " + commit + " with tree " + tree)
+    return commit
+
+
 # gitPush: handle git push with different cases
 # case after run command:
 # 	everything up to date => return code 0
 # 	push successful => return code 0
 # 	push failed => return code 1
-def gitPush(debug):
+# 	returns the pipeline GitLab created for the pushed commit
+# with commit and branch given (plumbing mode), that commit is pushed to the branch instead of the current branch
+def gitPush(debug, api=None, waitTimeout=300, commit="", branch=""):
     capture = True
     if debug:
         print(f"{Bcolors.WARNING}" + "Running git push" + f"{Bcolors.ENDC}")
         capture = False
     curBranch = gitGetBranch()
-    result = subprocess.run(
-        ["git", "push", "-f", "origin", curBranch], capture_output=capture
+    refspec = curBranch
+    if commit != "":
+        curBranch = branch or curBranch
+        refspec = commit + ":refs/heads/" + curBranch
+    result = runCommand(
+        ["git", "push", "-f", "origin", refspec], capture_output=capture
     )
     if result.returncode != 0:
         sys.exit(
@@ -416,38 +2178,67 @@ def gitPush(debug):
     else:
         # check if there is MR in gitlab to run pipeline
         print(f"{Bcolors.OKGREEN}" + "Push success!" + f"{Bcolors.ENDC}")
-        sleep(10)  # wait for gitlab update
-        runPipeline(curBranch, debug)
-        print("Recovering ...")
+        pipeline = runPipeline(
+            curBranch, debug, api, commit or getCurCommit(), waitTimeout
+        )
+        if commit == "":
+            print("Recovering ...")
+        return pipeline
 
 
-# after push to gitlab, need a short time let gitlab start pipeline. Then we can get correct pipeline URL
-def printPipelineURL(branch):
-    getUrl = subprocess.run(
-        "glab ci status -b " + branch + " | grep 'https://gitlab.com/'",
-        shell=True,
-        capture_output=True,
+# gitPushBatch: push several (commit, branch) pairs with one `git push`, then get the pipeline of each
+def gitPushBatch(commits, debug, api=None, waitTimeout=300):
+    capture = True
+    if debug:
+        print(f"{Bcolors.WARNING}" + "Running git push" + f"{Bcolors.ENDC}")
+        capture = False
+    refspecs = [commit + ":refs/heads/" + branch for commit, branch in commits]
+    result = runCommand(
+        ["git", "push", "-f", "origin"] + refspecs, capture_output=capture
     )
-    if getUrl.returncode != 0:
+    if result.returncode != 0:
+        sys.exit(
+            f"{Bcolors.FAIL}"
+            + "[Git Push Error] There is an error during git push of: "
+            + " ".join(refspecs)
+            + f"{Bcolors.ENDC}"
+        )
+    print(f"{Bcolors.OKGREEN}" + "Push success!" + f"{Bcolors.ENDC}")
+    pipelines = []
+    for commit, branch in commits:
+        pipelines.append(runPipeline(branch, debug, api, commit, waitTimeout))
+    return pipelines
+
+
+# after push to gitlab, need a short time let gitlab start pipeline. Then we can get correct pipeline URL
+def printPipelineURL(branch, api=None):
+    from gitlab_api import GitLabApiError, getApiBackend
+
+    if api is None:
+        api = getApiBackend()
+    try:
+        pipeline = api.getLatestPipeline(branch)
+    except GitLabApiError as e:
+        pipeline = None
         print(
             f"{Bcolors.FAIL}"
             + "[Error] error at [getPipelineURL]\n"
             + "Error Output:\n"
-            + getUrl.stderr.decode(UTF_8)
+            + str(e)
             + f"{Bcolors.ENDC}"
         )
-    else:
+    if pipeline is not None:
         print(
             f"Pipeline URL {Bcolors.WARNING}(double check if the pipeline url is correct!){Bcolors.ENDC}: "
             + f"{Bcolors.UNDERLINE}"
-            + getUrl.stdout.decode(UTF_8).strip("\n")
+            + pipeline["web_url"]
             + f"{Bcolors.ENDC}"
         )
 
 
 # get branch name as string by git
 def gitGetBranch():
-    branchObject = subprocess.run(
+    branchObject = runCommand(
         ["git", "rev-parse", "--abbrev-ref", "HEAD"], capture_output=True
     )
     if branchObject.returncode != 0:
@@ -463,37 +2254,83 @@ def gitGetBranch():
 
 
 # check if there is a MR for current Branch, if not then run a pipeline for it
-def runPipeline(curBranch, debug):
+# with the pushed commit sha, wait for the MR pipeline of exactly that commit and return it
+def runPipeline(curBranch, debug, api=None, sha="", waitTimeout=300):
+    from gitlab_api import GitLabApiError, getApiBackend, waitForPipeline
+
     if debug:
         print(f"{Bcolors.WARNING}" + "Checking MR exist" + f"{Bcolors.ENDC}")
-    result = subprocess.run(
-        ["glab", "mr", "list", "--source-branch=" + curBranch], capture_output=True
-    )
+    if api is None:
+        api = getApiBackend()
+    try:
+        mergeRequests = api.getMergeRequests(curBranch)
+    except GitLabApiError as e:
+        sys.exit(f"{Bcolors.FAIL}[Error] " + str(e) + f"{Bcolors.ENDC}")
     # if MR not exists then we need run pipeline, else MR exists gitlab should run MR automatically
-    if "No open merge requests match your search" in result.stdout.decode("utf-8"):
+    if len(mergeRequests) == 0:
         if debug:
             print(
                 f"{Bcolors.WARNING}"
                 + "[Warning] Do not find matching MR for this branch, this script is trying to create/run pipeline"
                 + f"{Bcolors.ENDC}"
             )
-        runpipe = subprocess.run(
-            ["glab", "ci", "run", "-b", curBranch], capture_output=True
-        )
-        if debug:
-            print(
-                f"{Bcolors.UNDERLINE}"
-                + runpipe.stdout.decode(UTF_8).strip()
-                + f"{Bcolors.ENDC}"
-            )
-        if runpipe.returncode != 0:
+        try:
+            pipeline = api.createPipeline(curBranch)
+        except GitLabApiError as e:
             sys.exit(
                 f"{Bcolors.FAIL}"
                 + "[Error] Cannot automatically run pipeline for this branch, please run it manually!!\n"
                 + "Error Output:\n"
-                + runpipe.stderr.decode(UTF_8).strip("\n")
+                + str(e)
                 + f"{Bcolors.ENDC}"
             )
+        if debug:
+            print(f"{Bcolors.UNDERLINE}" + pipeline["web_url"] + f"{Bcolors.ENDC}")
+        return pipeline
+    if sha == "":
+        return None
+    if debug:
+        print(
+            f"{Bcolors.WARNING}" + "Waiting for the pipeline of " + sha + f"{Bcolors.ENDC}"
+        )
+    try:
+        with TRACER.span("waitForPipeline", "wait"):
+            return waitForPipeline(api, sha, timeout=waitTimeout)
+    except GitLabApiError as e:
+        print(f"{Bcolors.FAIL}[Error] " + str(e) + f"{Bcolors.ENDC}")
+        return None
+
+
+# print the URL of the pipeline created for the pushed commit
+def printPipeline(pipeline):
+    print(
+        "Pipeline "
+        + str(pipeline["id"])
+        + " URL: "
+        + f"{Bcolors.UNDERLINE}"
+        + pipeline["web_url"]
+        + f"{Bcolors.ENDC}"
+    )
+
+
+# followTargets: stream the logs of the target jobs in the pipeline, then print their failures grouped by error
+def followTargets(api, pipeline, targetJobs):
+    from gitlab_api import GitLabApiError
+    from log_follow import PipelineFollower
+
+    print("Following target jobs of pipeline " + str(pipeline["id"]) + " (Ctrl-C to stop)")
+    follower = PipelineFollower(
+        api, pipeline["id"], [splitArgument(target.strip())[0] for target in targetJobs]
+    )
+    try:
+        follower.follow()
+    except KeyboardInterrupt:
+        print(f"{Bcolors.WARNING}Stopped following{Bcolors.ENDC}")
+    except GitLabApiError as e:
+        print(f"{Bcolors.FAIL}[Error] " + str(e) + f"{Bcolors.ENDC}")
+    if follower.failures:
+        print(f"{Bcolors.FAIL}Failures by error:{Bcolors.ENDC}")
+        follower.printFailures()
 
 
 # run git stash, if nothing to stash then return false
@@ -502,7 +2339,7 @@ def gitStash(debug):
         print(
             f"{Bcolors.WARNING}Running git stash to save current uncommit work{Bcolors.ENDC}"
         )
-    runStash = subprocess.run(["git", "stash"], capture_output=True)
+    runStash = runCommand(["git", "stash"], capture_output=True)
     if "No local changes to save" in runStash.stdout.decode("utf-8"):
         return False
     print(runStash.stdout.decode("utf-8").strip("\n"))
@@ -510,7 +2347,7 @@ def gitStash(debug):
 
 
 def getCurCommit():
-    run = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True)
+    run = runCommand(["git", "rev-parse", "HEAD"], capture_output=True)
     return run.stdout.decode("utf-8").strip("\n")
 
 
@@ -520,11 +2357,11 @@ def resetBack(popStash, commit, debug):
     if debug:
         print(f"{Bcolors.WARNING}" + "Running git reset" + f"{Bcolors.ENDC}")
         capture = False
-    subprocess.run(["git", "reset", "--hard", commit], capture_output=capture)
+    runCommand(["git", "reset", "--hard", commit], capture_output=capture)
     if popStash:
         if debug:
             print(f"{Bcolors.WARNING}" + "Running git stash pop" + f"{Bcolors.ENDC}")
-        subprocess.run(["git", "stash", "pop"], capture_output=capture)
+        runCommand(["git", "stash", "pop"], capture_output=capture)
     print(
         f"{Bcolors.OKBLUE}"
         + "Recovered. Everything should be same with before you run this script even it has failed \nYour current commit might behind with gitlab, if so, push with `-f` after test finishes"
@@ -532,13 +2369,407 @@ def resetBack(popStash, commit, debug):
     )
 
 
-def gitlabCiHelper(dirToYaml):
-    # customize yaml dumper for '!'
-    PipeDumper.add_multi_representer(Tagged, represent_tagged)
-    PipeLoader.add_multi_constructor("!", construct_undefined)
+# splitJobsArgument: split a `-j` value into job names, commas inside [...] belong to the subjob list
+def splitJobsArgument(jobs):
+    jobs = jobs.replace("'", "")
+    return re.split(r",(?![^[]*\])", jobs)
 
-    targetJobs = []
-    # command argument configuration
+
+# getTargetsDic: validate target jobs and organize them as job -> subjobs
+# OUTPUT: {job name: set of subjobs}, titles used for messages
+def getTargetsDic(targetJobs, jobs):
+    targetsDic = {}
+    targetJobTitles = []
+    matrixIndex = MatrixIndex(jobs)
+    for target in targetJobs:
+        # split job names
+        target = target.strip()
+        targetName, subjob = splitArgument(target)
+        # used for message
+        targetJobTitles.append(targetName + ": " + formatSubjob(subjob))
+
+        subjobs = [subjob]
+        if (
+            isinstance(subjob, tuple)
+            and targetName in jobs
+            and matrixIndex.hasMatrix(targetName)
+            and not matrixIndex.hasWidth(targetName, len(subjob))
+        ):
+            # no entry has that many variables, then it is a list of values: 'job:[f2, f3]'
+            subjobs = list(subjob)
+        for subjob in subjobs:
+            validateTargetJobs(targetName, subjob, jobs, matrixIndex)
+        # get organized job:subjobs map
+        if targetName not in targetsDic:
+            targetsDic[targetName] = set()
+        targetsDic[targetName].update(subjobs)
+    return targetsDic, targetJobTitles
+
+
+# getUnRemoveableJobs: what every minimum pipeline keeps besides the target closures: the global keywords
+# (stages, variables, default, workflow, ...) and what they reference, e.g. `default: before_script: !reference [.setup, script]`
+# other jobs and hidden templates are kept only when a kept job reaches them by needs, dependencies, extends or !reference
+@timed()
+def getUnRemoveableJobs(jobs, graph):
+    unRemoveableJobs = set()
+    for j in jobs:
+        if j in GLOBALKEYWORDS:
+            unRemoveableJobs.update(graph.closure(j))
+    return unRemoveableJobs
+
+
+# isManualJob: job which only runs when started by hand (`when: manual`, also in one of its rules)
+def isManualJob(block):
+    if type(block) is not dict:
+        return False
+    if block.get("when") == MANUAL:
+        return True
+    rules = block.get("rules")
+    return isinstance(rules, list) and any(
+        type(rule) is dict and rule.get("when") == MANUAL for rule in rules
+    )
+
+
+# reportPruningRisks: warn about kept jobs the minimum pipeline may not run as expected
+# - a job needed by another kept job is manual (the dependent job waits until it is started) or
+#   has rules/only/except (it may not be created for the pushed branch, then the needs fail)
+# - only .pre/.post jobs are left, GitLab rejects such a pipeline
+def reportPruningRisks(jobs, miniJobsNames, targetJobs):
+    resolver = ExtendsResolver(jobs)
+    needed = set()
+    for name in miniJobsNames:
+        if name in jobs and isJob(jobs[name], name):
+            needs = getNeedNames(resolver.effective(name), miniJobsNames)
+            needed.update(needs or [])
+    for name in sorted(needed):
+        if name in targetJobs or name not in jobs:
+            continue
+        block = resolver.effective(name)
+        if isManualJob(block):
+            print(
+                f"{Bcolors.WARNING}[Warning] "
+                + name
+                + " is manual, jobs needing it wait until it is started"
+                + f"{Bcolors.ENDC}"
+            )
+        elif any(key in block for key in ("rules", "only", "except")):
+            print(
+                f"{Bcolors.WARNING}[Warning] "
+                + name
+                + " has rules/only/except and may not be created on the pushed branch"
+                + f"{Bcolors.ENDC}"
+            )
+    stages = [
+        getJobStage(jobs, name, resolver)
+        for name in miniJobsNames
+        if name in jobs and isJob(jobs[name], name)
+    ]
+    if stages and all(stage in (".pre", ".post") for stage in stages):
+        print(
+            f"{Bcolors.WARNING}[Warning] Only .pre/.post jobs are left, GitLab will not create the pipeline"
+            + f"{Bcolors.ENDC}"
+        )
+
+
+# readBatchManifest: target sets for batch mode
+# manifest is yaml: name -> jobs (same format as -j, or a list), or name -> {jobs: ..., repeat: n}
+# OUTPUT: list of (name, target jobs, repeat number)
+def readBatchManifest(path, defaultRepeat=0):
+    with open(path, "r") as f:
+        manifest = yamlLoad(f.read())
+    if type(manifest) is not dict or len(manifest) == 0:
+        sys.exit(
+            f"{Bcolors.FAIL}[Input Error] Batch manifest must map set names to jobs: "
+            + path
+            + f"{Bcolors.ENDC}"
+        )
+    batch = []
+    for name in manifest:
+        entry = manifest[name]
+        repeat = defaultRepeat
+        if type(entry) is dict:
+            repeat = entry.get("repeat", defaultRepeat)
+            entry = entry.get("jobs", [])
+        if isinstance(entry, str):
+            entry = splitJobsArgument(entry)
+        if not isinstance(entry, list) or len(entry) == 0:
+            sys.exit(
+                f"{Bcolors.FAIL}[Input Error] No jobs for batch set: "
+                + str(name)
+                + f"{Bcolors.ENDC}"
+            )
+        if type(repeat) is not int or repeat < 0:
+            sys.exit(
+                f"{Bcolors.FAIL}[Input Error] Invalid repeat number for batch set: "
+                + str(name)
+                + f"{Bcolors.ENDC}"
+            )
+        batch.append((str(name), [str(job) for job in entry], repeat))
+    return batch
+
+
+# renderTargetSet: files of the minimum pipeline for one target set
+# the parsed config is not modified, so several sets can be rendered from it
+def renderTargetSet(
+    targetsDic, repeatNum, jobs, graph, unRemoveableJobs, dirToYaml, yamlFiles, fileIndex
+):
+    miniJobsNames, cleanedJobs = resolveTargetSet(targetsDic, jobs, graph, unRemoveableJobs)
+    return renderWriteBack(
+        dirToYaml,
+        miniJobsNames,
+        cleanedJobs,
+        yamlFiles,
+        list(targetsDic.keys()),
+        repeatNum,
+        fileIndex,
+    )
+
+
+# resolveTargetSet: minimum job names of one target set and those jobs with cleaned matrix
+# cleanMatrix replaces the blocks it changes, the others are shared with the parsed config
+def resolveTargetSet(targetsDic, jobs, graph, unRemoveableJobs):
+    miniJobsNames = set(unRemoveableJobs)
+    for targetName in targetsDic:
+        miniJobsNames.update(graph.closure(targetName))
+    setJobs = {}
+    for name in miniJobsNames:
+        if name in jobs:
+            setJobs[name] = jobs[name]
+    reportPruningRisks(setJobs, miniJobsNames, targetsDic)
+    return miniJobsNames, cleanMatrix(setJobs, targetsDic)
+
+
+# runBatch: one plumbing commit per target set, pushed together with a single `git push`
+def runBatch(
+    batch, jobs, graph, unRemoveableJobs, dirToYaml, yamlFiles, fileIndex, api, args, durations=None
+):
+    debug = args.debug
+    if not args.plan:
+        baseBranch = args.pushBranch or MINIBRANCHPREFIX + gitGetBranch()
+    commits = []
+    for name, setJobs, setRepeat in batch:
+        targetsDic, targetJobTitles = getTargetsDic(setJobs, jobs)
+        print(
+            "Batch set "
+            + f"{Bcolors.OKCYAN}"
+            + name
+            + f"{Bcolors.ENDC}: "
+            + str(set(targetJobTitles))
+        )
+        miniJobsNames, cleanedJobs = resolveTargetSet(
+            targetsDic, jobs, graph, unRemoveableJobs
+        )
+        contents = renderWriteBack(
+            dirToYaml,
+            miniJobsNames,
+            cleanedJobs,
+            yamlFiles,
+            list(targetsDic.keys()),
+            setRepeat,
+            fileIndex,
+        )
+        if args.estimate:
+            printEstimate(
+                jobs, cleanedJobs, miniJobsNames, targetsDic, setRepeat, durations
+            )
+        if args.plan:
+            printPlan(
+                targetsDic, miniJobsNames, cleanedJobs, setRepeat, dirToYaml, contents
+            )
+            continue
+        contents = getCommitContents(contents, yamlFiles, dirToYaml)
+        commit = gitCommitTree(
+            [(dirToYaml + fn, content) for fn, content in contents],
+            getCommitMessage(setJobs),
+            debug,
+        )
+        branch = baseBranch + "-" + re.sub(r"[^A-Za-z0-9._-]", "-", name)
+        commits.append((commit, branch))
+    if args.plan:
+        return
+    for pipeline in gitPushBatch(commits, debug, api, args.waitTimeout):
+        if pipeline is not None:
+            printPipeline(pipeline)
+
+
+# formatMatrix: one line per parallel:matrix entry, `VAR: [a, b]; VAR2: c`
+def formatMatrix(matrix):
+    lines = []
+    for m in matrix:
+        if type(m) is not dict:
+            lines.append(str(m))
+            continue
+        parts = []
+        for var in m:
+            values = m[var]
+            if isinstance(values, list):
+                values = "[" + ", ".join(str(v) for v in values) + "]"
+            parts.append(str(var) + ": " + str(values))
+        lines.append("; ".join(parts))
+    return lines
+
+
+# printPlan: what a run would commit, without any git or network call
+# the minimum job set, the pruned matrices of the targets, the repeat expansion, the estimated job count
+# and a unified diff of every yaml file against the rendered content
+# INPUT: target dic, minimum job names, jobs with cleaned matrix, repeat number, yaml directory, contents from renderWriteBack
+# OUTPUT: estimated number of jobs of the pipeline
+def printPlan(targetsDic, miniJobsNames, cleanedJobs, repeatNum, dirToYaml, contents):
+    import difflib
+
+    resolver = ExtendsResolver(cleanedJobs)
+    shardPlan = planShards(cleanedJobs, targetsDic, repeatNum, resolver)
+    jobNames = [
+        name
+        for name in sorted(miniJobsNames)
+        if name in cleanedJobs and isJob(cleanedJobs[name], name)
+    ]
+    total = 0
+    counts = {}
+    for name in jobNames:
+        counts[name] = countJobInstances(resolver.effective(name))
+        if name in shardPlan:
+            counts[name] *= repeatNum
+        total += counts[name]
+    print(f"{Bcolors.HEADER}Minimum job set{Bcolors.ENDC} (" + str(len(jobNames)) + "):")
+    for name in jobNames:
+        print("  " + name + " x" + str(counts[name]))
+    print(f"{Bcolors.HEADER}Pruned matrices{Bcolors.ENDC}:")
+    for name in targetsDic:
+        block = resolver.effective(name)
+        if type(block) is dict and type(block.get(PARALLEL)) is dict:
+            print("  " + name + ":")
+            for line in formatMatrix(block[PARALLEL].get(MATRIX, [])):
+                print("    - " + line)
+        else:
+            print("  " + name + ": no matrix")
+    if shardPlan:
+        print(f"{Bcolors.HEADER}Repeat expansion{Bcolors.ENDC}:")
+        for name in shardPlan:
+            print(
+                "  "
+                + name
+                + ": "
+                + str(repeatNum)
+                + " repeats x "
+                + str(max(countJobInstances(resolver.effective(name)), 1))
+                + " jobs -> "
+                + ", ".join(getShardNames(name, shardPlan[name]))
+            )
+    print(
+        f"{Bcolors.HEADER}Estimated job count{Bcolors.ENDC}: "
+        + str(total)
+        + " (jobs skipped by rules are counted too)"
+    )
+    color = sys.stdout.isatty()
+    for fn, content in contents:
+        try:
+            with open(dirToYaml + fn, "r", encoding=UTF_8) as f:
+                before = f.read()
+        except OSError:
+            before = ""
+        diff = difflib.unified_diff(
+            before.splitlines(keepends=True),
+            content.decode(UTF_8).splitlines(keepends=True),
+            "a/" + fn,
+            "b/" + fn,
+        )
+        for line in diff:
+            if not line.endswith("\n"):
+                line += "\n"
+            if color and line.startswith("+") and not line.startswith("+++"):
+                line = Bcolors.OKGREEN + line.rstrip("\n") + Bcolors.ENDC + "\n"
+            elif color and line.startswith("-") and not line.startswith("---"):
+                line = Bcolors.FAIL + line.rstrip("\n") + Bcolors.ENDC + "\n"
+            sys.stdout.write(line)
+    return total
+
+
+# pushMinimumConfig: commit the rendered minimum config and push it, either with git plumbing (checkout untouched)
+# or by stashing local work, writing the files in place, committing, pushing and resetting back
+def pushMinimumConfig(contents, yamlFiles, targetJobs, dirToYaml, api, args):
+    debug = args.debug
+    # files kept whole are not rendered, those with local work are committed as they are in the working tree
+    contents = getCommitContents(contents, yamlFiles, dirToYaml)
+    if args.plumbing:
+        # build the commit from memory and push it to a throwaway branch, the checkout is not touched
+        commit = gitCommitTree(
+            [(dirToYaml + fn, content) for fn, content in contents],
+            getCommitMessage(targetJobs),
+            debug,
+        )
+        pushBranch = args.pushBranch or MINIBRANCHPREFIX + gitGetBranch()
+        pipeline = gitPush(debug, api, args.waitTimeout, commit, pushBranch)
+        if pipeline is not None:
+            printPipeline(pipeline)
+            if args.follow:
+                followTargets(api, pipeline, targetJobs)
+        else:
+            printPipelineURL(pushBranch, api)
+        return
+
+    # before make change stash change before
+    curCommit = getCurCommit()
+    popStash = gitStash(debug)
+    pipeline = None
+    try:
+        # write the minimum config in place
+        writeContents(dirToYaml, contents)
+        # push to gitlab
+        if args.root:
+            gitAdd(" ".join(shlex.quote(dirToYaml + fn) for fn in yamlFiles), debug)
+        else:
+            gitAdd(dirToYaml, debug)
+        gitCommit(targetJobs, debug, args.noVerify)
+        pipeline = gitPush(debug, api, args.waitTimeout)
+    except Exception:
+        print(
+            f"{Bcolors.FAIL}"
+            + "Unexpected error happend! And cannot identify it (try re-enter nix-shell to have dependents update): \n"
+            + f"{Bcolors.ENDC}"
+        )
+        import traceback
+
+        traceback.print_exc()
+    finally:
+        try:
+            if debug:
+                print(
+                    f"{Bcolors.WARNING}"
+                    + "Recovering ci config file and stashed work ...\n"
+                    + f"{Bcolors.ENDC}"
+                )
+            resetBack(popStash, curCommit, debug)
+        except:
+            stashMsg = ""
+            if popStash:
+                stashMsg = " and apply/pop stash."
+            print(
+                f"{Bcolors.FAIL}"
+                + "[Error] error happend during recover, please make sure reset commit back to "
+                + curCommit
+                + stashMsg
+                + f"{Bcolors.ENDC}"
+            )
+    if pipeline is not None:
+        printPipeline(pipeline)
+        if args.follow:
+            followTargets(api, pipeline, targetJobs)
+    else:
+        curBranch = gitGetBranch()
+        printPipelineURL(curBranch, api)
+
+
+# finishTrace: print the phase timings and write the trace file, runs at exit so early exits are covered too
+def finishTrace(args):
+    TRACER.printSummary()
+    if args.trace:
+        TRACER.write(args.trace, args.traceFormat)
+        print("Trace written to " + args.trace)
+
+
+# getArgParser: command argument configuration
+def getArgParser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="This script runs Gitlab ci pipeline with minimum test that only test failed or user input jobs. Job format: `job:[subjob]`\n"
@@ -566,7 +2797,7 @@ def gitlabCiHelper(dirToYaml):
         "--repeat",
         default=0,
         type=int,
-        help="repeat times. `-r 2` task will runs in with [0, 1] twice. NOTE: in one job, (subjobs) * (repeatNum) MUST < 200",
+        help="repeat times. `-r 2` task will runs in with [0, 1] twice. Jobs over GitLab's limit of 200 are split into `job-shard-1..N`",
     )
     parser.add_argument(
         "-n",
@@ -575,9 +2806,173 @@ def gitlabCiHelper(dirToYaml):
         dest="noVerify",
         help="use the -n (--no-verify) flag when calling git commit",
     )
+    parser.add_argument(
+        "--api",
+        default="auto",
+        choices=["auto", "rest", "glab"],
+        help="how to talk to GitLab: in-process REST client (needs GITLAB_TOKEN or a glab login), `glab api`, or auto (REST when a token is found)",
+    )
+    parser.add_argument(
+        "--plumbing",
+        action="store_true",
+        help="build the minimum pipeline commit with git plumbing on top of HEAD and push it to a throwaway branch, without stash/reset of your checkout",
+    )
+    parser.add_argument(
+        "--batch",
+        default="",
+        type=str,
+        help="yaml manifest of target sets (name: 'job, job:[subjob]' or name: {jobs: ..., repeat: n}). Every set gets its own plumbing commit on <push branch>-<name>, all pushed at once",
+    )
+    parser.add_argument(
+        "--push-branch",
+        default="",
+        type=str,
+        dest="pushBranch",
+        help="branch the --plumbing commit is pushed to (default: " + MINIBRANCHPREFIX + "<current branch>)",
+    )
+    parser.add_argument(
+        "--wait-timeout",
+        default=300,
+        type=int,
+        dest="waitTimeout",
+        help="seconds to wait for GitLab to create the pipeline of the pushed commit",
+    )
+    parser.add_argument(
+        "--root",
+        default="",
+        type=str,
+        help="root CI config (e.g. .gitlab-ci.yml). Follow its include: (local, template, project, remote) instead of reading every file of the yaml directory",
+    )
+    parser.add_argument(
+        "--mirror",
+        default=None,
+        type=str,
+        help="local mirror of template/project/remote includes (default: $GITLAB_CI_MIRROR or .gitlab-ci-mirror next to the root config)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        dest="noCache",
+        help="do not read or write the parsed config cache ($XDG_CACHE_HOME/gitlab_ci_helper)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        default=0,
+        type=int,
+        dest="parseWorkers",
+        help="processes parsing the yaml files (default: one per core, 1 for serial). Configs under 1 MiB are always parsed serially",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="for huge configs: keep only the graph part of every job in memory (needs, dependencies, extends, parallel, stage, rules) and parse again only the files holding jobs of the minimum pipeline when writing it (not with --root)",
+    )
+    parser.add_argument(
+        "--emit-child",
+        default="",
+        type=str,
+        dest="emitChild",
+        metavar="FILE",
+        help="write the minimum pipeline as one self-contained yaml file for a `trigger: include: artifact` child pipeline instead of committing and pushing; with -j or --flaky no git or network calls",
+    )
+    parser.add_argument(
+        "--verify-child",
+        default="",
+        type=str,
+        dest="verifyChild",
+        metavar="FILE",
+        help="offline: check a file written by --emit-child against the config, for the targets and repeat recorded in it",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="only print the minimum job set, pruned matrices, repeat expansion, estimated job count and a diff of every yaml file; no git or network calls (needs -j or --batch)",
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="print the critical path and runner minutes of the full pipeline against the minimum one, from recorded job durations",
+    )
+    parser.add_argument(
+        "--durations-from",
+        default="",
+        type=str,
+        dest="durationsFrom",
+        help="only record the job durations of the latest pipeline of this branch/commit for --estimate (failed job runs record them too)",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="after the push, stream the logs of every job created for the targets (repeats and shards too), print a pass/fail summary and group failures by error",
+    )
+    parser.add_argument(
+        "--ingest-history",
+        nargs="?",
+        const="",
+        default=None,
+        dest="ingestHistory",
+        metavar="REF",
+        help="only add the finished pipelines since the last run (of every ref, or of REF) to the local job history and print the flakiest jobs",
+    )
+    parser.add_argument(
+        "--flaky",
+        default=0,
+        type=int,
+        metavar="N",
+        help="target the N flakiest jobs of the local job history, with the suggested repeat number unless -r is given",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="print how long every phase, git/glab command, API request and the pipeline wait took",
+    )
+    parser.add_argument(
+        "--trace",
+        default="",
+        type=str,
+        metavar="FILE",
+        help="write the timings of every span to FILE (implies --timings)",
+    )
+    parser.add_argument(
+        "--trace-format",
+        default="chrome",
+        choices=["chrome", "json"],
+        dest="traceFormat",
+        help="trace file format: Chrome trace events (chrome://tracing, Perfetto) or plain json with a summary",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="run as a daemon keeping the parsed config and dependency graph in memory; later runs on the same yaml directory are resolved by it",
+    )
+    parser.add_argument(
+        "--socket",
+        default="",
+        type=str,
+        help="unix socket of the daemon (default: one per yaml directory in $XDG_CACHE_HOME/gitlab_ci_helper)",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        dest="noDaemon",
+        help="resolve in this process even when a daemon is running",
+    )
+    return parser
 
+
+def gitlabCiHelper(dirToYaml):
+    targetJobs = []
     # choose actions based on arguments
+    parser = getArgParser()
     args = parser.parse_args()
+    if (args.durationsFrom or args.ingestHistory is not None) and (args.plan or args.emitChild or args.verifyChild):
+        # those only record history from GitLab, --plan and the child pipeline options work offline
+        parser.error(
+            "--durations-from and --ingest-history cannot be combined with --plan, --emit-child or --verify-child"
+        )
+    if args.timings or args.trace:
+        TRACER.enable()
+        atexit.register(finishTrace, args)
     debug = args.debug
     repeatNum = args.repeat
     if repeatNum < 0:
@@ -586,15 +2981,107 @@ def gitlabCiHelper(dirToYaml):
         )
     if debug:
         print(args)
-    if args.jobs:
+        print("libyaml loader: " + str(getYaml().FullLoader is not FastFullLoader))
+    if args.root:
+        if not os.path.isfile(args.root):
+            sys.exit(
+                f"{Bcolors.FAIL}[Input Error] Root CI config not found: "
+                + args.root
+                + f"{Bcolors.ENDC}"
+            )
+        dirToYaml = os.path.join(os.path.dirname(os.path.abspath(args.root)), "")
+    from child_pipeline import (
+        CHILDMETA,
+        emitChildPipeline,
+        getRepoRoot,
+        readChildPipeline,
+        renderChildPipeline,
+        verifyChildPipeline,
+    )
+    from config_daemon import getDaemonSocket, requestFromDaemon, serveDaemon
+
+    socketPath = args.socket or getDaemonSocket(dirToYaml)
+    if args.serve:
+        serveDaemon(dirToYaml, socketPath, debug=debug)
+        return
+    if (args.emitChild or args.verifyChild) and args.batch:
+        sys.exit(
+            f"{Bcolors.FAIL}[Input Error] --emit-child and --verify-child take one target set, not --batch{Bcolors.ENDC}"
+        )
+    child = None
+    if args.verifyChild:
+        # the targets and repeat come from the file, nothing is asked from GitLab
+        child = readChildPipeline(args.verifyChild)
+        api = None
+    elif args.plan:
+        # offline: the failed jobs would come from GitLab, and the API backend looks at the git remote
+        if not args.jobs and not args.batch and not args.flaky:
+            sys.exit(
+                f"{Bcolors.FAIL}[Input Error] --plan needs target jobs from -j, --batch or --flaky{Bcolors.ENDC}"
+            )
+        api = None
+    elif args.emitChild and (args.jobs or args.flaky):
+        api = None
+    else:
+        from gitlab_api import GitLabApiError, getApiBackend
+
+        try:
+            api = getApiBackend(args.api)
+        except GitLabApiError as e:
+            sys.exit(f"{Bcolors.FAIL}[Pre-Require Error] " + str(e) + f"{Bcolors.ENDC}")
+        if debug:
+            print("GitLab API backend: " + api.name)
+    durations = DurationCache(dirToYaml)
+    if args.durationsFrom:
+        # only fill the duration history used by --estimate
+        try:
+            state = api.getPipelineState(args.durationsFrom)
+        except GitLabApiError as e:
+            sys.exit(f"{Bcolors.FAIL}[Error] " + str(e) + f"{Bcolors.ENDC}")
+        durations.record(state["jobs"])
+        durations.save()
+        print(
+            "Recorded durations of "
+            + str(len(state["jobs"]))
+            + " jobs, history for "
+            + str(len(durations.durations))
+            + " jobs"
+        )
+        return
+    if args.ingestHistory is not None:
+        # only fill the job history used by --flaky
+        history = openJobHistory(dirToYaml)
+        try:
+            added = history.ingest(api, args.ingestHistory or None)
+        except GitLabApiError as e:
+            sys.exit(f"{Bcolors.FAIL}[Error] " + str(e) + f"{Bcolors.ENDC}")
+        print("Recorded jobs of " + str(added) + " pipelines")
+        printJobStats(history.topFlaky(10))
+        history.close()
+        return
+    batch = None
+    if child is not None:
+        targetJobs = list(child[CHILDMETA]["targets"])
+        repeatNum = child[CHILDMETA]["repeat"]
+    elif args.batch:
+        # several target sets from a manifest, all resolved against one parsed config
+        batch = readBatchManifest(args.batch, repeatNum)
+        for name, setJobs, setRepeat in batch:
+            targetJobs.extend(setJobs)
+    elif args.jobs:
         # manual input jobs
-        jobs = args.jobs
-        jobs = jobs.replace("'", "")
-        targetJobs = re.split(",(?![^[]*\])", jobs)
+        targetJobs = splitJobsArgument(args.jobs)
+    elif args.flaky:
+        history = openJobHistory(dirToYaml)
+        targetJobs, suggestedRepeat = pickFlakyTargets(history, args.flaky)
+        history.close()
+        if repeatNum == 0:
+            repeatNum = suggestedRepeat
     else:
         # get job based on last pipeline
         failedFrom = args.failedFrom
-        validateGlab()
+        if api.name == "glab":
+            validateGlab()
         curbranch = gitGetBranch()
         if failedFrom == "HEAD":
             failedFrom = curbranch
@@ -621,38 +3108,135 @@ def gitlabCiHelper(dirToYaml):
                     print(
                         f"{Bcolors.WARNING} Invalid input, answer y/yes, n/no{Bcolors.ENDC}"
                     )
-        targetJobs = getFailedListFromGlab(failedFrom)
+        targetJobs = getFailedListFromGlab(failedFrom, api, durations)
 
     if len(targetJobs) == 0:
         sys.exit(
             f"{Bcolors.FAIL}[Input Error] There is no target job to generate{Bcolors.ENDC}"
         )
 
+    if (
+        not args.root
+        and batch is None
+        and not args.noDaemon
+        and not args.plan
+        and not args.estimate
+        and not args.emitChild
+        and child is None
+    ):
+        # a running daemon has the config parsed already
+        reply = requestFromDaemon(
+            socketPath, {"dir": dirToYaml, "targets": targetJobs, "repeat": repeatNum}
+        )
+        if reply is not None and "parseError" in reply:
+            # the files changed to something the daemon cannot parse, a local run reports it
+            if debug:
+                print("Daemon could not parse the config: " + reply["parseError"])
+            reply = None
+        if reply is not None:
+            if debug:
+                print("Resolved by daemon: " + socketPath)
+            print(reply["output"], end="")
+            if "error" in reply:
+                sys.exit(reply["error"])
+            contents = [(fn, content.encode(UTF_8)) for fn, content in reply["contents"]]
+            pushMinimumConfig(
+                contents, reply["yamlFiles"], targetJobs, dirToYaml, api, args
+            )
+            return
+
     # get all jobs from file
-    yamlFiles = getListOfYamlFiles(dirToYaml)
-    jobs = getAllConfig(yamlFiles, dirToYaml)
-    # get find job title
-    miniJobsNames = set()
-    targetsDic = {}
+    fileIndex = {}
+    cache = None
+    if not args.noCache:
+        cache = ConfigCache(dirToYaml)
+    if args.root:
+        # follow include: from the root file, only files defining needed jobs are loaded
+        resolver = IncludeResolver(
+            dirToYaml, os.path.basename(args.root), args.mirror, cache
+        )
+        jobs, yamlFiles, fileIndex = resolver.loadFor(
+            [splitArgument(target.strip())[0] for target in targetJobs]
+        )
+        for missing in resolver.missingIncludes:
+            print(
+                f"{Bcolors.WARNING}[Warning] Included file not found: "
+                + missing
+                + f"{Bcolors.ENDC}"
+            )
+        cacheFiles = resolver.cacheKeys()
+        if cache is not None:
+            cache.prune([resolver.fileKey(path) for path in resolver.order])
+        if debug:
+            print("Loaded CI files: ")
+            print(cacheFiles)
+    elif args.compact:
+        yamlFiles = getListOfYamlFiles(dirToYaml)
+        fileIndex = CompactConfig(dirToYaml, cache)
+        jobs = fileIndex.load(yamlFiles, args.parseWorkers)
+        cacheFiles = yamlFiles
+    else:
+        yamlFiles = getListOfYamlFiles(dirToYaml)
+        jobs = getAllConfig(yamlFiles, dirToYaml, fileIndex, cache, args.parseWorkers)
+        cacheFiles = yamlFiles
+    if args.compact and args.root:
+        print(
+            f"{Bcolors.WARNING}[Warning] --compact is ignored with --root, the include resolver keeps the files it loads"
+            + f"{Bcolors.ENDC}"
+        )
+    graph = JobGraph(
+        jobs, fileIndex.records if isinstance(fileIndex, CompactConfig) else None
+    )
+    if cache is not None:
+        graph.seedClosures(cache.getClosures(cacheFiles))
+        if debug:
+            print(
+                "Config cache: "
+                + str(cache.hits)
+                + " files reused, "
+                + str(cache.misses)
+                + " parsed"
+            )
+    reportGraphProblems(graph, debug)
     if debug:
         print("Input Jobs: ")
         print(targetJobs)
 
-    targetJobTitles = []
-    for target in targetJobs:
-        # split job names
-        target = target.strip()
-        targetName, subjob = splitArgument(target)
-        # used for message
-        targetJobTitles.append(targetName + ": " + subjob)
+    # find not removable job and their dependencies
+    unRemoveableJobs = getUnRemoveableJobs(jobs, graph)
+    if args.root:
+        # include: is kept per file (pruned by IncludeResolver) and not part of the merged jobs
+        unRemoveableJobs.add(INCLUDE)
 
-        validateTargetJobs(targetName, subjob, jobs)
-        # get organized job:subjobs map
-        if targetName not in targetsDic:
-            targetsDic[targetName] = set()
-        targetsDic[targetName].add(subjob)
-        # get minimum required jobs
-        miniJobsNames = miniJobsNames.union(getDependencies(targetName, jobs))
+    if debug:
+        print("required UnRemoveableJobs and related dependencies: ")
+        print(unRemoveableJobs)
+
+    if batch is not None:
+        runBatch(
+            batch,
+            jobs,
+            graph,
+            unRemoveableJobs,
+            dirToYaml,
+            yamlFiles,
+            fileIndex,
+            api,
+            args,
+            durations,
+        )
+        if cache is not None:
+            cache.storeClosures(cacheFiles, graph.memoizedClosures())
+            cache.save()
+        return
+
+    # get find job title
+    targetsDic, targetJobTitles = getTargetsDic(targetJobs, jobs)
+
+    # get minimum required jobs
+    miniJobsNames = set()
+    for targetName in targetsDic:
+        miniJobsNames.update(graph.closure(targetName))
 
     print(
         "This program will generate Gitlab configuration files for these target jobs:"
@@ -663,93 +3247,80 @@ def gitlabCiHelper(dirToYaml):
         print("Those jobs are necessary for the target jobs above: ")
         print(miniJobsNames)
 
-    # find not removable job and their dependencies
-    unRemoveableJobs = set()
-    for j in jobs:
-        if not isRemoveableJob(jobs[j], j):
-            unRemoveableJobs = unRemoveableJobs.union(getDependencies(j, jobs))
-
-    if debug:
-        print("required UnRemoveableJobs and related dependencies: ")
-        print(unRemoveableJobs)
-
     miniJobsNames = miniJobsNames.union(unRemoveableJobs)
-
-    # get the target with clean matrix
-    cleanedJobs = cleanMatrix(jobs, targetsDic)
-    # before make change stash change before
-    curCommit = getCurCommit()
-    popStash = gitStash(debug)
-    try:
-        # replace with selectswriteback
-        selectWriteBack(
-            dirToYaml, miniJobsNames, cleanedJobs, yamlFiles, list(targetsDic.keys()), repeatNum
+    reportPruningRisks(jobs, miniJobsNames, targetsDic)
+    if cache is not None:
+        cache.storeClosures(cacheFiles, graph.memoizedClosures())
+        cache.save()
+
+    # get the target with clean matrix, the parsed jobs stay as they are
+    cleanedJobs = cleanMatrix(dict(jobs), targetsDic)
+    if args.emitChild or child is not None:
+        expected = renderChildPipeline(
+            dirToYaml,
+            miniJobsNames,
+            cleanedJobs,
+            yamlFiles,
+            targetsDic,
+            targetJobs,
+            repeatNum,
+            fileIndex,
+            bool(args.root),
         )
-        # push to gitlab
-        gitAdd(dirToYaml, debug)
-        gitCommit(targetJobs, debug, args.noVerify)
-        gitPush(debug)
-    except Exception:
-        print(
-            f"{Bcolors.FAIL}"
-            + "Unexpected error happend! And cannot identify it (try re-enter nix-shell to have dependents update): \n"
-            + f"{Bcolors.ENDC}"
-        )
-        traceback.print_exc()
-    finally:
-        try:
-            if debug:
-                print(
-                    f"{Bcolors.WARNING}"
-                    + "Recovering ci config file and stashed work ...\n"
-                    + f"{Bcolors.ENDC}"
-                )
-            resetBack(popStash, curCommit, debug)
-        except:
-            stashMsg = ""
-            if popStash:
-                stashMsg = " and apply/pop stash."
+        if args.estimate:
+            printEstimate(jobs, cleanedJobs, miniJobsNames, targetsDic, repeatNum, durations)
+        if args.emitChild:
+            emitChildPipeline(args.emitChild, expected)
+            return
+        if child[CHILDMETA].get("config") != expected[CHILDMETA]["config"]:
             print(
-                f"{Bcolors.FAIL}"
-                + "[Error] error happend during recover, please make sure reset commit back to "
-                + curCommit
-                + stashMsg
+                f"{Bcolors.WARNING}[Warning] The config changed since "
+                + args.verifyChild
+                + " was written"
                 + f"{Bcolors.ENDC}"
             )
-    curBranch = gitGetBranch()
-    printPipelineURL(curBranch)
+        problems = verifyChildPipeline(child, expected, getRepoRoot(dirToYaml), args.mirror)
+        for problem in problems:
+            print(f"{Bcolors.FAIL}  " + problem + f"{Bcolors.ENDC}")
+        if problems:
+            sys.exit(
+                f"{Bcolors.FAIL}[Verify Error] "
+                + args.verifyChild
+                + " does not match the config: "
+                + str(len(problems))
+                + " problems"
+                + f"{Bcolors.ENDC}"
+            )
+        print(
+            f"{Bcolors.OKGREEN}"
+            + args.verifyChild
+            + " matches the config"
+            + f"{Bcolors.ENDC}"
+        )
+        return
+    contents = renderWriteBack(
+        dirToYaml,
+        miniJobsNames,
+        cleanedJobs,
+        yamlFiles,
+        list(targetsDic.keys()),
+        repeatNum,
+        fileIndex,
+    )
+    if args.estimate:
+        printEstimate(jobs, cleanedJobs, miniJobsNames, targetsDic, repeatNum, durations)
+    if args.plan:
+        printPlan(targetsDic, miniJobsNames, cleanedJobs, repeatNum, dirToYaml, contents)
+        return
+    pushMinimumConfig(contents, yamlFiles, targetJobs, dirToYaml, api, args)
 
 
-#  unit test for some functions
-class TestScriptFunctions(unittest.TestCase):
-    def testAddrepeat(self):
-        PipeDumper.add_multi_representer(Tagged, represent_tagged)
-        PipeLoader.add_multi_constructor("!", construct_undefined)
-        dirToYaml = os.getcwd() + "/tests/"
-        yamlFiles = getListOfYamlFiles(dirToYaml)
-        # get minimum jobs
-        jobs = getAllConfig(yamlFiles, dirToYaml)
-        addRepeat(jobs, "testExample:b", 4)
-        self.assertEqual(
-            jobs["testExample:b"]["parallel"],
-            {"matrix": [{"REPEAT": [0, 1, 2, 3]}]},
-        )
-        addRepeat(jobs, "testExample:c", 4)
-        self.assertEqual(
-            jobs["testExample:c"]["parallel"],
-            {
-                "matrix": [
-                    {
-                        "TESTFILE": [
-                            "f1",
-                            "f2",
-                            "f3",
-                            "f4",
-                        ],
-                        "REPEAT": [0, 1, 2, 3],
-                    }
-                ]
-            },
-        )
-        addRepeat(jobs, "testExample:a", 4)
-        self.assertEqual(jobs["testExample:a"]["parallel"], 4)
+def main():
+    gitlabCiHelper(os.getcwd() + "/gitlab/")
+
+
+if __name__ == "__main__":
+    # run the importable module (cached bytecode, one Tagged class for pickles and the daemon), not this __main__ copy
+    from gitlab_ci_helper import main
+
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Local history of job results across pipelines, used to pick flaky jobs as repeat targets
+# JobHistory keeps every finished job attempt (retried ones too) in SQLite, ingested from the GitLab API
+# incrementally by pipeline id: only pipelines newer than the newest stored one are listed, unfinished ones are checked again later
+import collections
+import math
+import re
+import sqlite3
+
+from gitlab_api import GitLabApiError
+
+SCHEMAVERSION = 1
+INGESTLIMIT = 200  # pipelines listed per ingest when the history is empty or far behind
+INGESTWORKERS = 4  # pipelines whose jobs are fetched concurrently
+RECENTPIPELINES = 50  # only jobs that ran in the newest n pipelines are picked, older ones may be gone from the config
+CONFIDENCE = 0.95  # chance of seeing at least one failure with the suggested repeat number
+MAXREPEAT = 50
+FINISHED = {"success", "failed", "canceled", "skipped", "manual"}
+OUTCOMES = ("success", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pipelines (
+    id INTEGER PRIMARY KEY,
+    ref TEXT,
+    sha TEXT,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    pipeline_id INTEGER NOT NULL,
+    sha TEXT,
+    name TEXT NOT NULL,
+    cell TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS pipelines_status ON pipelines (status, id);
+CREATE INDEX IF NOT EXISTS jobs_pipeline ON jobs (pipeline_id);
+CREATE INDEX IF NOT EXISTS jobs_cell_sha ON jobs (name, cell, sha, status);
+"""
+
+# JobStats: results of one job/matrix cell, commits counts distinct commits, flakyCommits those with both a failed and a passed attempt
+JobStats = collections.namedtuple(
+    "JobStats", ["name", "cell", "runs", "failures", "commits", "flakyCommits"]
+)
+
+
+def failureRate(stats):
+    return stats.failures / stats.runs if stats.runs else 0.0
+
+
+# flakiness: share of commits on which the job both failed and passed (a retry or another pipeline of the same commit)
+def flakiness(stats):
+    return stats.flakyCommits / stats.commits if stats.commits else 0.0
+
+
+# splitJobName: GitLab job name -> (job, matrix cell), 'job: [a, b]' -> ('job', 'a, b'), 'job 1/4' -> ('job', '')
+def splitJobName(name):
+    m = re.match(r"^(.*?):\s*\[(.*)\]$", name)
+    if m is not None:
+        return m.group(1), ", ".join(v.strip() for v in m.group(2).split(","))
+    m = re.match(r"^(.*) \d+/\d+$", name)
+    if m is not None:
+        return m.group(1), ""
+    return name, ""
+
+
+# formatTarget: job and cell as a -j target
+def formatTarget(name, cell):
+    return name + ":[" + cell + "]" if cell else name
+
+
+# suggestRepeat: runs needed to see the failure at least once with the given confidence, for a failure rate per run
+def suggestRepeat(rate, confidence=CONFIDENCE, maxRepeat=MAXREPEAT):
+    if rate <= 0:
+        return maxRepeat
+    if rate >= 1:
+        return 1
+    return max(1, min(maxRepeat, math.ceil(math.log(1 - confidence) / math.log(1 - rate))))
+
+
+class JobHistory:
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, SCHEMAVERSION):
+            # written by another version, the history can be ingested again
+            self.db.executescript("DROP TABLE IF EXISTS jobs; DROP TABLE IF EXISTS pipelines;")
+        self.db.executescript(SCHEMA)
+        self.db.execute("PRAGMA user_version = " + str(SCHEMAVERSION))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    # ingest: store finished pipelines newer than the stored history and re-check stored unfinished ones
+    # INPUT: api backend, ref to restrict to (None for every ref), most pipelines to list
+    # OUTPUT: number of pipelines whose jobs were stored
+    def ingest(self, api, ref=None, limit=INGESTLIMIT):
+        newest = self.db.execute("SELECT MAX(id) FROM pipelines").fetchone()[0] or 0
+        pending = [
+            row[0]
+            for row in self.db.execute(
+                "SELECT id FROM pipelines WHERE status NOT IN ("
+                + ",".join("?" * len(FINISHED))
+                + ")",
+                sorted(FINISHED),
+            )
+        ]
+        pipelines = []
+        page = 1
+        while len(pipelines) < limit:
+            params = {"per_page": min(100, limit), "page": page}
+            if ref:
+                params["ref"] = ref
+            listed = api.getPipelines(**params)
+            pipelines.extend(p for p in listed if p["id"] > newest)
+            if len(listed) < params["per_page"] or listed[-1]["id"] <= newest:
+                break
+            page += 1
+        pipelines = pipelines[:limit]
+        gone = []
+        for pipelineId in pending:
+            try:
+                pipelines.append(api.getPipeline(pipelineId))
+            except GitLabApiError:
+                # deleted meanwhile
+                gone.append((pipelineId,))
+        finished = [p for p in pipelines if p["status"] in FINISHED]
+        jobLists = self._fetchJobs(api, [p["id"] for p in finished])
+        with self.db:
+            self.db.executemany("DELETE FROM pipelines WHERE id = ?", gone)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO pipelines (id, ref, sha, status) VALUES (?, ?, ?, ?)",
+                [(p["id"], p.get("ref"), p.get("sha"), p["status"]) for p in pipelines],
+            )
+            for pipeline, jobs in zip(finished, jobLists):
+                self.addJobs(pipeline, jobs)
+        return len(finished)
+
+    def _fetchJobs(self, api, pipelineIds):
+        if len(pipelineIds) <= 1:
+            return [api.getPipelineJobs(i, includeRetried=True) for i in pipelineIds]
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=INGESTWORKERS) as pool:
+            return list(
+                pool.map(lambda i: api.getPipelineJobs(i, includeRetried=True), pipelineIds)
+            )
+
+    # addJobs: store the job attempts of one pipeline, a job id is stored once
+    def addJobs(self, pipeline, jobs):
+        rows = []
+        for job in jobs:
+            name, cell = splitJobName(job["name"])
+            rows.append(
+                (
+                    job["id"],
+                    pipeline["id"],
+                    pipeline.get("sha"),
+                    name,
+                    cell,
+                    job["status"],
+                    job.get("duration"),
+                )
+            )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO jobs (id, pipeline_id, sha, name, cell, status, duration)"
+            + " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    # stats: failure rate and flakiness inputs per job/matrix cell, of one job when name is given
+    # only passed and failed attempts count, the (name, cell, sha, status) index covers the grouping
+    def stats(self, name=None, minCommits=1, recent=None):
+        where = "status IN (?, ?)"
+        params = list(OUTCOMES)
+        if name is not None:
+            where += " AND name = ?"
+            params.append(name)
+        if recent:
+            where += (
+                " AND name IN (SELECT DISTINCT name FROM jobs WHERE pipeline_id >="
+                + " (SELECT MIN(id) FROM (SELECT id FROM pipelines ORDER BY id DESC LIMIT ?)))"
+            )
+            params.append(recent)
+        params.append(minCommits)
+        rows = self.db.execute(
+            "SELECT name, cell, SUM(runs), SUM(failed), COUNT(*), SUM(failed > 0 AND runs > failed)"
+            + " FROM (SELECT name, cell, sha, COUNT(*) AS runs, SUM(status = 'failed') AS failed"
+            + " FROM jobs WHERE "
+            + where
+            + " GROUP BY name, cell, sha)"
+            + " GROUP BY name, cell HAVING COUNT(*) >= ?",
+            params,
+        )
+        return [JobStats(*row) for row in rows]
+
+    # topFlaky: the n flakiest jobs/cells that ran recently, ties broken by failure rate
+    def topFlaky(self, n, minCommits=1, recent=RECENTPIPELINES):
+        flaky = [s for s in self.stats(minCommits=minCommits, recent=recent) if s.flakyCommits]
+        flaky.sort(key=lambda s: (-flakiness(s), -failureRate(s), s.name, s.cell))
+        return flaky[:n]
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Follow the target jobs of a pushed pipeline: every job created for a target (matrix cells, REPEAT values, shards)
+# has its log streamed with ranged requests from the last received byte, only the last lines of each log are kept,
+# and failed jobs are grouped by a normalized error signature
+import collections
+import re
+import sys
+import time
+
+from gitlab_api import TRACECHUNK, UTF_8
+from job_history import splitJobName
+
+FOLLOWINTERVAL = 5  # seconds between polls of the pipeline jobs
+FOLLOWWORKERS = 8  # logs fetched concurrently
+TAILLINES = 100  # last lines kept per log
+MAXLINE = 4096  # longest line kept, longer ones keep their end
+DONE = {"success", "failed", "canceled", "skipped", "manual"}
+SHARD = re.compile(r"-shard-\d+$")
+ANSI = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+SECTION = re.compile(r"section_(start|end):\d+:[^\r\n]*?\r")
+ERRORLINE = re.compile(
+    r"error|exception|fail|fatal|assert|panic|traceback|segmentation fault|timed? ?out", re.I
+)
+# lines the runner adds to every failed job
+RUNNERLINE = re.compile(
+    r"^(ERROR: Job failed|Cleaning up|Uploading artifacts|Running after_script|WARNING: )"
+)
+SIGNATUREPATTERNS = [
+    (re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:?\d{2})?"), "<time>"),
+    (re.compile(r"0x[0-9a-fA-F]+|\b[0-9a-f]{7,64}\b"), "<hex>"),
+    (re.compile(r"/tmp/\S+"), "<tmp>"),
+    (re.compile(r"\d+(\.\d+)?"), "<n>"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+# cleanLine: log line as shown, without section markers, colors and overwritten progress output
+def cleanLine(line):
+    line = ANSI.sub("", SECTION.sub("", line))
+    return line.rstrip("\r").split("\r")[-1].strip()
+
+
+# errorSignature: line with times, ids, temp paths and numbers replaced, so repeats failing the same way match
+def errorSignature(line):
+    for pattern, replacement in SIGNATUREPATTERNS:
+        line = pattern.sub(replacement, line)
+    return line.strip()
+
+
+# findErrorLine: last line of a log tail that looks like the error, else the last line the job printed
+def findErrorLine(lines):
+    lines = [cleanLine(line) for line in lines]
+    lines = [line for line in lines if line and not RUNNERLINE.match(line)]
+    for line in reversed(lines):
+        if ERRORLINE.search(line):
+            return line
+    return lines[-1] if lines else ""
+
+
+# LogTail: read position and last lines of one job log, memory stays bounded however long the log is
+class LogTail:
+    def __init__(self, maxLines=TAILLINES):
+        self.offset = 0
+        self.lines = collections.deque(maxlen=maxLines)
+        self.partial = b""
+        self.done = False
+
+    def feed(self, data):
+        self.offset += len(data)
+        parts = (self.partial + data).split(b"\n")
+        self.partial = parts.pop()[-MAXLINE:]
+        for line in parts[-self.lines.maxlen :]:
+            self.lines.append(line[-MAXLINE:].decode(UTF_8, "replace"))
+
+    def tail(self):
+        if self.partial:
+            return list(self.lines) + [self.partial.decode(UTF_8, "replace")]
+        return list(self.lines)
+
+
+# PipelineFollower: poll the jobs of one pipeline, stream the logs of the target jobs and keep a pass/fail summary
+class PipelineFollower:
+    def __init__(self, api, pipelineId, targets, out=None):
+        self.api = api
+        self.pipelineId = pipelineId
+        self.targets = set(targets)
+        self.out = out or sys.stdout
+        self.jobs = {}
+        self.tails = {}
+        self.failures = {}
+        self.lastSummary = None
+        self.start = time.monotonic()
+
+    # targetOf: target a pipeline job was created for, None for the other jobs
+    def targetOf(self, jobName):
+        name = SHARD.sub("", splitJobName(jobName)[0])
+        return name if name in self.targets else None
+
+    # poll: one round of job states and new log bytes
+    # OUTPUT: True when every target job is done, or when the pipeline is done without any target job
+    #         (a wrong name, or every target skipped by rules:)
+    def poll(self):
+        jobs = {}
+        for job in self.api.getPipelineJobs(self.pipelineId):
+            if self.targetOf(job["name"]) is not None:
+                jobs[job["id"]] = job
+        # retried jobs get a new id, the old attempt is dropped
+        self.jobs = jobs
+        self.tails = {i: self.tails.get(i) or LogTail() for i in jobs}
+        active = [
+            i
+            for i in jobs
+            if not self.tails[i].done
+            and (jobs[i]["status"] == "running" or jobs[i]["status"] in DONE)
+        ]
+        if len(active) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=FOLLOWWORKERS) as pool:
+                list(pool.map(self.fetch, active))
+        else:
+            for i in active:
+                self.fetch(i)
+        for i in active:
+            if jobs[i]["status"] in DONE:
+                self.finish(i)
+        self.printSummary()
+        if not jobs:
+            status = self.api.getPipeline(self.pipelineId).get("status")
+            if status in DONE:
+                print("Pipeline " + status + " without any target job", file=self.out)
+                return True
+            return False
+        return all(job["status"] in DONE for job in jobs.values())
+
+    # fetch: log bytes after the last received one, in chunks of at most TRACECHUNK
+    def fetch(self, jobId):
+        tail = self.tails[jobId]
+        while True:
+            data = self.api.getJobTrace(jobId, tail.offset, TRACECHUNK)
+            tail.feed(data)
+            if len(data) < TRACECHUNK:
+                return
+
+    # finish: the log of a done job is complete, keep only the error of a failed one
+    def finish(self, jobId):
+        tail = self.tails[jobId]
+        tail.done = True
+        if self.jobs[jobId]["status"] == "failed":
+            line = findErrorLine(tail.tail())
+            self.failures[jobId] = (errorSignature(line), line)
+        tail.lines.clear()
+        tail.partial = b""
+
+    # summary: target -> {"passed", "failed", "running", "pending"} counts over its jobs
+    def summary(self):
+        result = {}
+        for job in self.jobs.values():
+            counts = result.setdefault(
+                self.targetOf(job["name"]),
+                {"passed": 0, "failed": 0, "running": 0, "pending": 0},
+            )
+            if job["status"] == "success":
+                counts["passed"] += 1
+            elif job["status"] == "failed":
+                counts["failed"] += 1
+            elif job["status"] == "running":
+                counts["running"] += 1
+            else:
+                counts["pending"] += 1
+        return result
+
+    def printSummary(self):
+        summary = self.summary()
+        if summary == self.lastSummary:
+            return
+        self.lastSummary = summary
+        parts = []
+        for target in sorted(summary):
+            counts = summary[target]
+            parts.append(
+                target
+                + ": "
+                + str(counts["passed"])
+                + "/"
+                + str(sum(counts.values()))
+                + " passed, "
+                + str(counts["failed"])
+                + " failed, "
+                + str(counts["running"])
+                + " running"
+            )
+        elapsed = int(time.monotonic() - self.start)
+        print("[" + str(elapsed) + "s] " + "; ".join(parts), file=self.out)
+
+    # failureGroups: [(signature, example line, [job names])], most frequent first
+    def failureGroups(self):
+        groups = {}
+        for jobId in self.failures:
+            signature, line = self.failures[jobId]
+            group = groups.setdefault(signature, (line, []))
+            name = self.jobs[jobId]["name"] if jobId in self.jobs else str(jobId)
+            group[1].append(name)
+        return sorted(
+            ((s, groups[s][0], sorted(groups[s][1])) for s in groups),
+            key=lambda g: (-len(g[2]), g[0]),
+        )
+
+    def printFailures(self):
+        for signature, line, names in self.failureGroups():
+            print(str(len(names)) + "x " + (line or "(no output)"), file=self.out)
+            shown = names[:5] + (["..."] if len(names) > 5 else [])
+            print("    " + ", ".join(shown), file=self.out)
+
+    # follow: poll until every target job is done
+    def follow(self, interval=FOLLOWINTERVAL, sleepFn=time.sleep):
+        while not self.poll():
+            sleepFn(interval)
+        return self.summary()
@@ -1,6 +1,12 @@
 import unittest
 from gitlab_ci_helper import gitlabCiHelper
-from gitlab_ci_helper import TestScriptFunctions
+from tests.test_gitlab_ci_helper import TestScriptFunctions
+from tests.test_gitlab_api import TestGitLabApi
+from tests.test_benchmark import TestBenchmark
+from tests.test_config_daemon import TestConfigDaemon
+from tests.test_job_history import TestJobHistory
+from tests.test_log_follow import TestLogFollow
+from tests.test_phase_timer import TestPhaseTimer
 
 
 if __name__ == "__main__":
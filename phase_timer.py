@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Phase timing for gitlab_ci_helper: spans around parsing, dependency search, write-back, git/glab commands,
+# GitLab API requests and the pipeline wait, exported as JSON or Chrome trace events (chrome://tracing, Perfetto)
+# TRACER is disabled unless --timings or --trace is given, a span then only costs one attribute check
+import contextlib
+import functools
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+NULLSPAN = contextlib.nullcontext()
+
+
+# Tracer: finished spans as (name, category, start, duration, thread, args), times in seconds from enable()
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.spans = []
+        self.origin = time.perf_counter()
+
+    def add(self, name, category, start, args=None):
+        self.spans.append(
+            (
+                name,
+                category,
+                start - self.origin,
+                time.perf_counter() - start,
+                threading.get_ident(),
+                args or {},
+            )
+        )
+
+    @contextlib.contextmanager
+    def _span(self, name, category, args):
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, category, start, args)
+
+    # span: `with TRACER.span("phase"):` times the block, args end up in the trace event
+    def span(self, name, category="phase", **args):
+        if not self.enabled:
+            return NULLSPAN
+        return self._span(name, category, args)
+
+    # summary: [(name, category, calls, total seconds, max seconds)], largest total first
+    def summary(self):
+        rows = {}
+        for name, category, start, duration, thread, args in self.spans:
+            row = rows.setdefault((name, category), [0, 0.0, 0.0])
+            row[0] += 1
+            row[1] += duration
+            row[2] = max(row[2], duration)
+        return sorted(
+            ((key[0], key[1], row[0], row[1], row[2]) for key, row in rows.items()),
+            key=lambda r: -r[3],
+        )
+
+    def wall(self):
+        return time.perf_counter() - self.origin
+
+    def printSummary(self):
+        wall = self.wall()
+        print("%-40s %-10s %6s %10s %10s %6s" % ("span", "category", "calls", "total ms", "max ms", "wall"))
+        for name, category, calls, total, longest in self.summary():
+            print(
+                "%-40s %-10s %6d %10.1f %10.1f %5.0f%%"
+                % (name[:40], category, calls, total * 1000, longest * 1000, total / wall * 100)
+            )
+        print("%-40s %-10s %6s %10.1f" % ("wall time", "", "", wall * 1000))
+
+    # toJson: every span and the summary, times in seconds
+    def toJson(self):
+        return {
+            "wall": self.wall(),
+            "spans": [
+                {
+                    "name": name,
+                    "category": category,
+                    "start": start,
+                    "duration": duration,
+                    "thread": thread,
+                    "args": args,
+                }
+                for name, category, start, duration, thread, args in self.spans
+            ],
+            "summary": [
+                {"name": r[0], "category": r[1], "calls": r[2], "total": r[3], "max": r[4]}
+                for r in self.summary()
+            ],
+        }
+
+    # toChromeTrace: complete ("X") trace events in microseconds, spans of one thread nest by time
+    def toChromeTrace(self):
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": round(start * 1e6, 1),
+                    "dur": round(duration * 1e6, 1),
+                    "pid": pid,
+                    "tid": thread,
+                    "args": args,
+                }
+                for name, category, start, duration, thread, args in self.spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    # write: export to path, traceFormat "chrome" or "json"
+    def write(self, path, traceFormat="chrome"):
+        data = self.toChromeTrace() if traceFormat == "chrome" else self.toJson()
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1, default=str)
+
+
+TRACER = Tracer()
+
+
+# timed: decorator recording every call of a function as a span
+def timed(name=None, category="phase"):
+    def decorate(fn):
+        spanName = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return fn(*args, **kwargs)
+            with TRACER._span(spanName, category, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+# runCommand: subprocess.run recorded as a span named after the command and its sub command ("git push", "glab api")
+def runCommand(command, **kwargs):
+    if not TRACER.enabled:
+        return subprocess.run(command, **kwargs)
+    words = shlex.split(command) if isinstance(command, str) else [str(w) for w in command]
+    start = time.perf_counter()
+    args = {"command": " ".join(words)[:200]}
+    try:
+        result = subprocess.run(command, **kwargs)
+        args["returncode"] = result.returncode
+        return result
+    finally:
+        TRACER.add(" ".join(words[:2]), "subprocess", start, args)
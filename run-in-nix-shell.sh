@@ -1,5 +1,14 @@
 #!/usr/bin/env bash
 
+# fast path: nix-shell takes seconds to start, skip it when this python already has the dependencies and glab
+# (the API backend and token lookup) is on the PATH too
+# (set GITLAB_CI_HELPER_NIX=1 to always go through nix-shell). `-m` runs the module from its cached bytecode
+DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+if [[ -z $GITLAB_CI_HELPER_NIX ]] && command -v glab >/dev/null && python3 -c "import yaml" 2>/dev/null
+then
+      PYTHONPATH="${DIR}${PYTHONPATH:+:$PYTHONPATH}" exec python3 -m gitlab_ci_helper "$@"
+fi
+
 if [[ -z $IN_NIX_SHELL  && -z $NIX_STORE && $HOST != *"/nix/store/"* && $PATH != *"/nix/store/"* ]]
 then
       # wrap argument with "" avoid problem about space in argument, eg. itest:end-to-end 1/4
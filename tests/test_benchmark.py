@@ -0,0 +1,35 @@
+import json
+import unittest
+
+from benchmark import benchmarkPhases, generateConfig
+from gitlab_ci_helper import getDependencies
+
+
+#  unit test for the generator and the harness
+class TestBenchmark(unittest.TestCase):
+    def testGenerateConfig(self):
+        files = generateConfig(50, numFiles=4, extendsDepth=4, fanIn=3, layers=5)
+        jobs = {}
+        for fn in files:
+            jobs.update(files[fn])
+        self.assertEqual(len([j for j in jobs if j.startswith("test:job-")]), 50)
+        self.assertEqual(jobs[".tpl-0-3"]["extends"], ".tpl-0-2")
+        self.assertEqual(len(getDependencies("test:job-49", jobs)) > 5, True)
+        self.assertEqual(jobs["test:job-0"]["script"][0].tag, "!reference")
+        self.assertEqual(len(jobs["test:job-0"]["parallel"]["matrix"][0]["PACKAGE"]), 8)
+
+    def testBenchmarkPhases(self):
+        results = benchmarkPhases(30, 1, {"numFiles": 3})
+        self.assertEqual(
+            [r["phase"] for r in results],
+            [
+                "getAllConfig",
+                "getDependencies",
+                "JobGraph",
+                "JobGraph.resolve",
+                "cleanMatrix",
+                "selectWriteBack",
+                "fullResolution",
+            ],
+        )
+        json.dumps(results)
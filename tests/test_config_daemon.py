@@ -0,0 +1,90 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import yaml
+
+from config_daemon import ConfigWatcher, DaemonServer, requestFromDaemon
+from gitlab_ci_helper import PipeLoader
+
+
+#  unit test for the daemon: incremental refresh, rendering over the socket, parse errors
+class TestConfigDaemon(unittest.TestCase):
+    def testDaemon(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dirToYaml = tmp + "/"
+            with open(dirToYaml + "a.yml", "w") as f:
+                f.write("job:a:\n  script: [a]\njob:b:\n  needs: [job:a]\n  script: [b]\n")
+            with open(dirToYaml + "b.yml", "w") as f:
+                f.write("job:c:\n  script: [c]\n")
+            watcher = ConfigWatcher(dirToYaml)
+            watcher.refresh()
+            server = DaemonServer(tmp + "/d.sock", watcher)
+            thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+            thread.start()
+            try:
+                request = {"dir": dirToYaml, "targets": ["job:b"], "repeat": 2}
+                reply = requestFromDaemon(tmp + "/d.sock", request)
+                self.assertIn("job:b", reply["output"])
+                self.assertEqual(sorted(reply["yamlFiles"]), ["a.yml", "b.yml"])
+                written = yaml.load(dict(reply["contents"])["a.yml"], Loader=PipeLoader)
+                self.assertEqual(list(written), ["job:a", "job:b"])
+                self.assertEqual(written["job:b"]["parallel"], {"matrix": [{"REPEAT": [0, 1]}]})
+                # the daemon's parsed config is not changed by rendering
+                self.assertNotIn("parallel", watcher.jobs["job:b"])
+                # only the edited file is parsed again (replaced at once, the daemon polls meanwhile)
+                parsed = watcher.parsed
+                with open(tmp + "/b.tmp", "w") as f:
+                    f.write("job:c:\n  needs: [job:b]\n  script: [c]\n")
+                os.replace(tmp + "/b.tmp", dirToYaml + "b.yml")
+                reply = requestFromDaemon(tmp + "/d.sock", dict(request, targets=["job:c"]))
+                self.assertEqual(watcher.parsed, parsed + 1)
+                # every job of a.yml is kept as it is, the file is not rendered
+                self.assertNotIn("a.yml", dict(reply["contents"]))
+                written = yaml.load(dict(reply["contents"])["b.yml"], Loader=PipeLoader)
+                self.assertEqual(written["job:c"]["needs"], ["job:b"])
+                reply = requestFromDaemon(tmp + "/d.sock", dict(request, targets=["job:x"]))
+                self.assertIn("job:x", reply["error"])
+                # a syntax error neither stops the daemon nor replaces the last good config
+                with open(tmp + "/b.tmp", "w") as f:
+                    f.write("job:c:\n  script: [c\n")
+                os.replace(tmp + "/b.tmp", dirToYaml + "b.yml")
+                reply = requestFromDaemon(tmp + "/d.sock", dict(request, targets=["job:c"]))
+                self.assertIn("parseError", reply)
+                self.assertNotIn("contents", reply)
+                self.assertEqual(watcher.jobs["job:c"]["needs"], ["job:b"])
+                time.sleep(0.2)
+                self.assertTrue(thread.is_alive())
+                # the broken file is parsed again once it is fixed
+                with open(tmp + "/b.tmp", "w") as f:
+                    f.write("job:c:\n  script: [fixed]\n")
+                os.replace(tmp + "/b.tmp", dirToYaml + "b.yml")
+                reply = requestFromDaemon(tmp + "/d.sock", dict(request, targets=["job:c"]))
+                self.assertNotIn("parseError", reply)
+                self.assertEqual(watcher.jobs["job:c"]["script"], ["fixed"])
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+            self.assertIsNone(requestFromDaemon(tmp + "/d.sock", request))
+
+    def testDaemonColdOSError(self):
+        import gitlab_ci_helper
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(tmp + "/a.yml", "w") as f:
+                f.write("job:a:\n  script: [a]\n")
+            watcher = ConfigWatcher(tmp + "/")
+            # yaml is imported lazily, a file gone between stat and read must not need it loaded already
+            with mock.patch.dict(gitlab_ci_helper.__dict__):
+                for name in ["yaml", "PipeDumper"]:
+                    gitlab_ci_helper.__dict__.pop(name, None)
+                with mock.patch("config_daemon.parseFiles", side_effect=FileNotFoundError(tmp + "/a.yml")):
+                    self.assertEqual(watcher.refresh(), set())
+            self.assertIn("a.yml", watcher.error)
+            self.assertEqual(watcher.stamps, {})
+            self.assertIn("job:a", watcher.refresh())
+            self.assertIsNone(watcher.error)
@@ -0,0 +1,153 @@
+import json
+import socket
+import unittest
+import urllib.parse
+from unittest import mock
+
+from gitlab_api import (
+    UTF_8,
+    GitLabApiError,
+    GlabBackend,
+    RestBackend,
+    parseRemoteUrl,
+    waitForPipeline,
+)
+
+
+#  unit test for the REST client against a local stand-in server
+class TestGitLabApi(unittest.TestCase):
+    def setUp(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        requests = self.requests = []
+        jobs = [{"id": i, "name": "job-" + str(i), "status": "failed"} for i in range(250)]
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, data, headers=None):
+                body = json.dumps(data).encode(UTF_8)
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                for key in headers or {}:
+                    self.send_header(key, headers[key])
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                requests.append((url.path, query, self.headers["PRIVATE-TOKEN"]))
+                if url.path.endswith("/drop"):
+                    # the connection is closed without an answer
+                    self.close_connection = True
+                elif url.path.endswith("/pipelines"):
+                    self.reply([{"id": 7, "status": "failed", "web_url": "http://x/7"}])
+                elif url.path.endswith("/pipelines/7/jobs"):
+                    page = int(query["page"])
+                    perPage = int(query["per_page"])
+                    self.reply(
+                        jobs[(page - 1) * perPage : page * perPage],
+                        {"X-Total-Pages": str((len(jobs) + perPage - 1) // perPage)},
+                    )
+                elif url.path.endswith("/merge_requests"):
+                    self.reply([])
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                body = json.loads(self.rfile.read(length))
+                requests.append((self.path, body, self.headers["PRIVATE-TOKEN"]))
+                if self.path.endswith("/drop"):
+                    self.close_connection = True
+                    return
+                self.reply({"id": 8, "ref": body["ref"], "web_url": "http://x/8"})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        self.api = RestBackend(
+            "127.0.0.1:" + str(self.server.server_address[1]),
+            "secret",
+            "group/project",
+            https=False,
+        )
+
+    def tearDown(self):
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testPipelineState(self):
+        state = self.api.getPipelineState("my-branch")
+        self.assertEqual(state["pipeline"]["id"], 7)
+        self.assertEqual(len(state["jobs"]), 250)
+        self.assertEqual(state["mergeRequests"], [])
+        paths = [r[0] for r in self.requests]
+        self.assertIn("/api/v4/projects/group%2Fproject/pipelines", paths)
+        self.assertEqual(paths.count("/api/v4/projects/group%2Fproject/pipelines/7/jobs"), 3)
+        self.assertTrue(all(r[2] == "secret" for r in self.requests))
+        # connections are reused, not one per request
+        self.assertLess(self.api.connectionsOpened, len(self.requests))
+
+    def testCreatePipeline(self):
+        pipeline = self.api.createPipeline("my-branch")
+        self.assertEqual(pipeline["id"], 8)
+        self.assertEqual(self.requests[-1][1], {"ref": "my-branch"})
+
+    def testNetworkErrors(self):
+        # a dropped GET is tried again, a dropped POST is not: the server may have created the pipeline
+        with self.assertRaises(GitLabApiError):
+            self.api.get("drop")
+        self.assertEqual([r[0] for r in self.requests], ["/api/v4/drop"] * 2)
+        with self.assertRaises(GitLabApiError):
+            self.api.post("drop", {"ref": "my-branch"})
+        self.assertEqual(len(self.requests), 3)
+        failure = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        with mock.patch("http.client.HTTPConnection.request", side_effect=failure):
+            with self.assertRaises(GitLabApiError) as e:
+                self.api.getPipeline(7)
+        self.assertIn("Name or service not known", str(e.exception))
+        with mock.patch("gitlab_api.runCommand", side_effect=FileNotFoundError("glab")):
+            with self.assertRaises(GitLabApiError):
+                GlabBackend().getAll("projects/:id/pipelines")
+
+    def testParseRemoteUrl(self):
+        self.assertEqual(
+            parseRemoteUrl("git@gitlab.com:group/sub/project.git"),
+            ("gitlab.com", "group/sub/project"),
+        )
+        self.assertEqual(
+            parseRemoteUrl("https://user@gitlab.example.com/group/project"),
+            ("gitlab.example.com", "group/project"),
+        )
+
+    def testWaitForPipeline(self):
+        class Stub:
+            calls = []
+
+            def getPipelines(self, **params):
+                self.calls.append(params)
+                if len(self.calls) < 4:
+                    return []
+                return [{"id": 9, "sha": params["sha"], "web_url": "http://x/9"}]
+
+        delays = []
+        stub = Stub()
+        pipeline = waitForPipeline(stub, "abc123", "br", sleepFn=delays.append)
+        self.assertEqual(pipeline["id"], 9)
+        self.assertEqual(delays, [0.5, 1, 2])
+        self.assertEqual(stub.calls[0], {"sha": "abc123", "per_page": 1, "ref": "br"})
+
+        class Never:
+            def getPipelines(self, **params):
+                return []
+
+        with self.assertRaises(GitLabApiError):
+            waitForPipeline(Never(), "abc123", timeout=0.05, delay=0.01)
@@ -0,0 +1,899 @@
+import contextlib
+import copy
+import io
+import os
+import pickle
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from gitlab_ci_helper import (
+    CompactConfig,
+    ConfigCache,
+    DurationCache,
+    ExtendsResolver,
+    IncludeResolver,
+    JobGraph,
+    MAXPARALLEL,
+    PipeDumper,
+    PipeLoader,
+    PurePipeLoader,
+    Tagged,
+    UTF_8,
+    addRepeat,
+    cleanMatrix,
+    countJobInstances,
+    estimatePipeline,
+    getAllConfig,
+    getHeadChanges,
+    getDependencies,
+    getListOfYamlFiles,
+    getTargetsDic,
+    parseContents,
+    getUnRemoveableJobs,
+    printEstimate,
+    gitlabCiHelper,
+    gitCommitTree,
+    planRepeat,
+    readBatchManifest,
+    reportPruningRisks,
+    renderTargetSet,
+    runBatch,
+    renderWriteBack,
+    rewireNeeds,
+    scanTopLevelKeys,
+    scanTopLevelSpans,
+    selectWriteBack,
+    splitArgument,
+)
+
+
+# runOffline: run the script on dirToYaml with the arguments (after --no-cache) and return what it printed
+# no git and no GitLab: any subprocess or connection fails the test
+def runOffline(dirToYaml, argv, out=None):
+    out = out or io.StringIO()
+    with mock.patch("sys.argv", ["gitlab_ci_helper.py", "--no-cache"] + argv), mock.patch(
+        "subprocess.run", side_effect=AssertionError("subprocess called")
+    ), mock.patch("socket.socket", side_effect=AssertionError("socket used")):
+        with contextlib.redirect_stdout(out):
+            gitlabCiHelper(dirToYaml)
+    return out.getvalue()
+
+
+#  unit test for some functions
+class TestScriptFunctions(unittest.TestCase):
+    def testAddrepeat(self):
+        dirToYaml = os.getcwd() + "/tests/"
+        yamlFiles = getListOfYamlFiles(dirToYaml)
+        # get minimum jobs
+        jobs = getAllConfig(yamlFiles, dirToYaml)
+        addRepeat(jobs, "testExample:b", 4)
+        self.assertEqual(
+            jobs["testExample:b"]["parallel"],
+            {"matrix": [{"REPEAT": [0, 1, 2, 3]}]},
+        )
+        addRepeat(jobs, "testExample:c", 4)
+        self.assertEqual(
+            jobs["testExample:c"]["parallel"],
+            {
+                "matrix": [
+                    {
+                        "TESTFILE": [
+                            "f1",
+                            "f2",
+                            "f3",
+                            "f4",
+                        ],
+                        "REPEAT": [0, 1, 2, 3],
+                    }
+                ]
+            },
+        )
+        addRepeat(jobs, "testExample:a", 4)
+        self.assertEqual(jobs["testExample:a"]["parallel"], 4)
+
+    def testMatrixSubjobs(self):
+        jobs = {
+            "deploy": {
+                "script": ["deploy"],
+                "parallel": {
+                    "matrix": [
+                        {"PROVIDER": "aws", "STACK": ["monitoring", "app1", "app2"]},
+                        {"PROVIDER": ["gcp", "vultr"], "STACK": ["data", 3]},
+                    ]
+                },
+            }
+        }
+        self.assertEqual(splitArgument("deploy: [aws, app1]"), ("deploy", ("aws", "app1")))
+        self.assertEqual(splitArgument("deploy:[app2]"), ("deploy", "app2"))
+        self.assertEqual(splitArgument("deploy 1/2"), ("deploy", ""))
+        targetsDic, titles = getTargetsDic(["deploy: [aws, app1]", "deploy:[data]", "deploy:[vultr]"], jobs)
+        self.assertEqual(targetsDic, {"deploy": {("aws", "app1"), "data", "vultr"}})
+        self.assertEqual(titles[0], "deploy: [aws, app1]")
+        with self.assertRaises(SystemExit):
+            getTargetsDic(["deploy: [gcp, app1]"], jobs)
+        original = jobs["deploy"]
+        cleanMatrix(jobs, targetsDic)
+        self.assertEqual(
+            jobs["deploy"]["parallel"]["matrix"],
+            [
+                {"PROVIDER": ["vultr"], "STACK": ["data"]},
+                {"PROVIDER": ["aws"], "STACK": ["app1"]},
+            ],
+        )
+        # the parsed definition is not modified
+        self.assertEqual(len(original["parallel"]["matrix"][0]["STACK"]), 3)
+        # an empty subjob keeps every subjob
+        jobs["deploy"] = original
+        cleanMatrix(jobs, {"deploy": {"", "app1"}})
+        self.assertIs(jobs["deploy"], original)
+
+    def testRepeatShards(self):
+        dirToYaml = os.getcwd() + "/tests/"
+        yamlFiles = getListOfYamlFiles(dirToYaml)
+        fileIndex = {}
+        jobs = getAllConfig(yamlFiles, dirToYaml, fileIndex)
+        self.assertEqual(countJobInstances(jobs["testExample:c"]), 4)
+        self.assertEqual(planRepeat(jobs["testExample:c"], 50), [(0, 50)])
+        self.assertEqual(planRepeat(jobs["testExample:c"], 120), [(0, 50), (50, 50), (100, 20)])
+        with self.assertRaises(SystemExit):
+            planRepeat({"parallel": 201}, 1)
+        contents = renderWriteBack(
+            dirToYaml,
+            set(jobs),
+            copy.deepcopy(jobs),
+            yamlFiles,
+            ["testExample:a", "testExample:c"],
+            120,
+            fileIndex,
+        )
+        written = yaml.load(contents[0][1], Loader=PipeLoader)
+        # the definition is kept once as a hidden template, the shards only add their parallel sections
+        self.assertEqual(
+            list(written),
+            [
+                "testExample:a",
+                "testExample:b",
+                ".testExample:c",
+                "testExample:c-shard-1",
+                "testExample:c-shard-2",
+                "testExample:c-shard-3",
+            ],
+        )
+        self.assertEqual(written[".testExample:c"], jobs["testExample:c"])
+        self.assertEqual(written["testExample:c-shard-1"]["extends"], ".testExample:c")
+        self.assertNotIn(b"&id", contents[0][1])
+        self.assertEqual(written["testExample:a"]["parallel"], 120)
+        # REPEAT values continue across the shards and every shard stays under the limit
+        repeats = []
+        for i in range(1, 4):
+            shard = written["testExample:c-shard-" + str(i)]
+            self.assertLessEqual(countJobInstances(shard), MAXPARALLEL)
+            repeats.extend(shard["parallel"]["matrix"][0]["REPEAT"])
+        self.assertEqual(repeats, list(range(120)))
+        self.assertEqual(
+            rewireNeeds(
+                {"needs": ["x", {"job": "c", "artifacts": False}], "dependencies": ["c"]},
+                {"c": ["c-shard-1", "c-shard-2"]},
+            ),
+            {
+                "needs": ["x", {"job": "c-shard-1", "artifacts": False}, {"job": "c-shard-2", "artifacts": False}],
+                "dependencies": ["c-shard-1", "c-shard-2"],
+            },
+        )
+        contents = renderWriteBack(dirToYaml, set(jobs), copy.deepcopy(jobs), yamlFiles, ["testExample:a"], 450, fileIndex)
+        written = yaml.load(contents[0][1], Loader=PipeLoader)
+        self.assertEqual(written["testExample:b"]["needs"], ["testExample:a-shard-1", "testExample:a-shard-2", "testExample:a-shard-3"])
+        self.assertEqual(written["testExample:a-shard-3"]["parallel"], 50)
+
+        # jobs extending or referencing a sharded job point to its template
+        with tempfile.TemporaryDirectory() as tmp:
+            dirToYaml = tmp + "/"
+            with open(dirToYaml + "a.yml", "w") as f:
+                f.write(
+                    "unit:\n  parallel: 100\n  script: [u]\n"
+                    "lint:\n  extends: unit\n  script: [l]\n"
+                    "docs:\n  script:\n    - !reference [unit, script]\n"
+                )
+            fileIndex = {}
+            jobs = getAllConfig(["a.yml"], dirToYaml, fileIndex)
+            contents = renderWriteBack(dirToYaml, set(jobs), copy.deepcopy(jobs), ["a.yml"], ["unit"], 3, fileIndex)
+            written = yaml.load(contents[0][1], Loader=PipeLoader)
+            self.assertEqual(list(written), [".unit", "unit-shard-1", "unit-shard-2", "lint", "docs"])
+            self.assertEqual(written["lint"]["extends"], ".unit")
+            self.assertEqual(written["docs"]["script"], [Tagged("!reference", [".unit", "script"])])
+            self.assertEqual(JobGraph(written).missing, {})
+            with open(dirToYaml + "a.yml", "a") as f:
+                f.write(".unit:\n  image: x\n")
+            jobs = getAllConfig(["a.yml"], dirToYaml)
+            with self.assertRaises(SystemExit):
+                renderWriteBack(dirToYaml, set(jobs), copy.deepcopy(jobs), ["a.yml"], ["unit"], 3)
+
+    def testJobGraph(self):
+        jobs = {
+            ".base": {"image": "python"},
+            "build": {"extends": ".base", "script": ["make"]},
+            "left": {"needs": ["build"], "script": ["l"]},
+            "right": {"needs": [{"job": "build", "artifacts": True}], "script": ["r"]},
+            "top": {"needs": ["left", "right"], "dependencies": ["build"], "script": ["t"]},
+            "loop:a": {"needs": ["loop:b"], "script": ["a"]},
+            "loop:b": {"needs": ["loop:a", "ghost"], "script": ["b"]},
+        }
+        graph = JobGraph(jobs)
+        self.assertEqual(getDependencies("top", jobs)[-1], "top")
+        self.assertEqual(
+            sorted(getDependencies("top", jobs)),
+            [".base", "build", "left", "right", "top"],
+        )
+        self.assertEqual(
+            graph.closure("top"), {".base", "build", "left", "right", "top"}
+        )
+        self.assertEqual(graph.reverse["build"], {"left", "right", "top"})
+        self.assertEqual(graph.resolve(["left", "right"]), {".base", "build", "left", "right"})
+        # cycles are reported, not followed forever
+        self.assertEqual([sorted(c) for c in graph.cycles], [["loop:a", "loop:b"]])
+        self.assertEqual(graph.closure("loop:a"), {"loop:a", "loop:b"})
+        self.assertEqual(graph.missing, {"loop:b": ["ghost"]})
+        self.assertEqual(sorted(getDependencies("loop:a", jobs)), ["loop:a", "loop:b"])
+
+    def testJobGraphUpdate(self):
+        jobs = {
+            "a": {"script": ["a"]},
+            "b": {"needs": ["a"]},
+            "c": {"needs": ["b", "d"]},
+            "e": {"script": ["e"]},
+        }
+        graph = JobGraph(jobs)
+        for name in jobs:
+            graph.closure(name)
+        self.assertEqual(graph.missing, {"c": ["d"]})
+        # d appears, b stops needing a, e is removed
+        jobs = dict(jobs, d={"needs": ["a"]}, b={"script": ["b"]})
+        del jobs["e"]
+        stale = graph.update(jobs, {"b", "d", "e"})
+        self.assertEqual(stale, {"b", "c", "e"})
+        fresh = JobGraph(jobs)
+        self.assertEqual(graph.adjacency, fresh.adjacency)
+        self.assertEqual(graph.reverse, fresh.reverse)
+        self.assertEqual(graph.missing, {})
+        for name in jobs:
+            self.assertEqual(graph.closure(name), fresh.closure(name))
+        # a cycle introduced by an update is found
+        jobs["a"] = {"needs": ["c"]}
+        graph.update(jobs, {"a"})
+        self.assertEqual(len(graph.cycles), 1)
+
+    def testJobGraphDeepChain(self):
+        jobs = {"job0": {"script": ["x"]}}
+        for i in range(1, 5000):
+            jobs["job" + str(i)] = {"extends": "job" + str(i - 1)}
+        graph = JobGraph(jobs)
+        self.assertEqual(len(graph.closure("job4999")), 5000)
+        self.assertEqual(len(getDependencies("job4999", jobs)), 5000)
+
+    def testFastLoaderRoundTrip(self):
+        text = (
+            ".base:\n  script:\n  - echo base\n"
+            "job:x:\n  script:\n  - !reference [.base, script]\n  - echo \"ünï\"\n"
+            "  variables: !custom {A: 1}\n"
+        )
+        fast = yaml.load(text, Loader=PipeLoader)
+        pure = yaml.load(text, Loader=PurePipeLoader)
+        self.assertEqual(fast, pure)
+        self.assertEqual(fast["job:x"]["script"][0], Tagged("!reference", [".base", "script"]))
+        dump = lambda data: yaml.dump(
+            data, sort_keys=False, allow_unicode=True, encoding=UTF_8, Dumper=PipeDumper
+        )
+        self.assertEqual(dump(fast), dump(pure))
+        self.assertIn(b"!reference", dump(fast))
+
+    def testSelectWriteBackFromIndex(self):
+        import shutil
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dirToYaml = tmp + "/"
+            shutil.copy(os.getcwd() + "/tests/gitlab-example.yml", dirToYaml)
+            yamlFiles = getListOfYamlFiles(dirToYaml)
+            fileIndex = {}
+            jobs = getAllConfig(yamlFiles, dirToYaml, fileIndex)
+            self.assertEqual(
+                list(fileIndex["gitlab-example.yml"]),
+                ["testExample:a", "testExample:b", "testExample:c"],
+            )
+            # the write back must come from memory, a re-read would fail on this
+            with open(dirToYaml + "gitlab-example.yml", "w") as f:
+                f.write("broken: [")
+            miniJobs = JobGraph(jobs).resolve(["testExample:b"])
+            selectWriteBack(
+                dirToYaml, miniJobs, jobs, yamlFiles, ["testExample:b"], 2, fileIndex
+            )
+            with open(dirToYaml + "gitlab-example.yml", "r") as f:
+                written = yaml.load(f.read(), Loader=PipeLoader)
+            self.assertEqual(list(written), ["testExample:a", "testExample:b"])
+            self.assertEqual(
+                written["testExample:b"]["parallel"], {"matrix": [{"REPEAT": [0, 1]}]}
+            )
+
+    def testConfigCache(self):
+        import shutil
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dirToYaml = tmp + "/ci/"
+            os.mkdir(dirToYaml)
+            shutil.copy(os.getcwd() + "/tests/gitlab-example.yml", dirToYaml)
+            with open(dirToYaml + "other.yml", "w") as f:
+                f.write("other:\n  script: [echo]\n")
+            cold = ConfigCache(dirToYaml, tmp + "/cache")
+            yamlFiles = getListOfYamlFiles(dirToYaml)
+            jobs = getAllConfig(yamlFiles, dirToYaml, cache=cold)
+            graph = JobGraph(jobs)
+            graph.closure("testExample:b")
+            cold.storeClosures(yamlFiles, graph.memoizedClosures())
+            cold.save()
+            self.assertEqual((cold.hits, cold.misses), (0, 2))
+
+            # unchanged files come from the cache, a touched file falls back to its hash
+            os.utime(dirToYaml + "other.yml", ns=(0, 0))
+            warm = ConfigCache(dirToYaml, tmp + "/cache")
+            yamlFiles = getListOfYamlFiles(dirToYaml)
+            self.assertEqual(getAllConfig(yamlFiles, dirToYaml, cache=warm), jobs)
+            self.assertEqual((warm.hits, warm.misses), (2, 0))
+            self.assertEqual(
+                warm.getClosures(yamlFiles)["testExample:b"],
+                {"testExample:a", "testExample:b"},
+            )
+
+            # a changed file is parsed again, closures and removed files are dropped
+            with open(dirToYaml + "other.yml", "w") as f:
+                f.write("other:\n  script: [echo, changed]\n")
+            os.remove(dirToYaml + "gitlab-example.yml")
+            yamlFiles = getListOfYamlFiles(dirToYaml)
+            jobs = getAllConfig(yamlFiles, dirToYaml, cache=warm)
+            self.assertEqual(jobs["other"]["script"], ["echo", "changed"])
+            self.assertEqual(warm.misses, 1)
+            self.assertEqual(list(warm.files), ["other.yml"])
+            self.assertEqual(warm.getClosures(yamlFiles), {})
+
+            # a cache written by another version is dropped as a whole, its closures may follow other edges
+            with open(warm.path, "rb") as f:
+                data = pickle.load(f)
+            data["version"] -= 1
+            with open(warm.path, "wb") as f:
+                pickle.dump(data, f)
+            self.assertEqual(ConfigCache(dirToYaml, tmp + "/cache").files, {})
+
+    def testIncludeResolver(self):
+        import shutil
+
+        repoDir = os.getcwd() + "/tests/include/"
+        resolver = IncludeResolver(repoDir, mirrorDir=repoDir + "mirror")
+        jobs, yamlFiles, fileIndex = resolver.loadFor(["unit:python"])
+        self.assertEqual(yamlFiles, ["ci/build.yml", "ci/test/unit.yaml", ".gitlab-ci.yml"])
+        self.assertIn(".lint-setup", jobs)
+        self.assertIn("stages", jobs)
+        # nothing reachable needs these files, so they are not even parsed
+        self.assertNotIn("deploy:prod", jobs)
+        self.assertNotIn("secret:detection", jobs)
+        self.assertEqual(
+            fileIndex[".gitlab-ci.yml"]["include"],
+            [
+                {"local": "/ci/build.yml"},
+                {"local": "/ci/test/*.yaml"},
+                {"project": "group/shared", "file": "/ci/lint.yml"},
+                {"local": "/ci/build.yml"},
+            ],
+        )
+        self.assertEqual(resolver.order.count(repoDir + "ci/build.yml"), 1)
+        self.assertEqual(resolver.missingIncludes, [])
+
+        jobs, yamlFiles, fileIndex = IncludeResolver(
+            repoDir, mirrorDir=repoDir + "mirror"
+        ).loadAll()
+        self.assertIn("deploy:prod", jobs)
+        self.assertIn("secret:detection", jobs)
+        self.assertEqual(len(fileIndex[".gitlab-ci.yml"]["include"]), 6)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # a glob matching a file which is not needed only keeps the files loaded
+            repoDir = tmp + "/"
+            shutil.copytree(os.getcwd() + "/tests/include", repoDir, dirs_exist_ok=True)
+            with open(repoDir + "ci/test/other.yaml", "w") as f:
+                f.write("unit:other:\n  script: [other]\n")
+            jobs, yamlFiles, fileIndex = IncludeResolver(
+                repoDir, mirrorDir=repoDir + "mirror"
+            ).loadFor(["unit:python"])
+            self.assertNotIn("unit:other", jobs)
+            self.assertEqual(fileIndex[".gitlab-ci.yml"]["include"][1], {"local": "/ci/test/unit.yaml"})
+            self.assertNotIn({"local": "/ci/test/*.yaml"}, fileIndex[".gitlab-ci.yml"]["include"])
+
+    def testScanTopLevelKeys(self):
+        text = '# c\nstages: [a]\n"quoted:job": {}\njob:a: \n  script: x\n---\n'
+        self.assertEqual(scanTopLevelKeys(text), ["stages", "quoted:job", "job:a"])
+        self.assertIsNone(scanTopLevelKeys("<<: *anchor\n"))
+        self.assertEqual(scanTopLevelKeys("stages:\n- a\n-\njob: {}\n"), ["stages", "job"])
+        self.assertIsNone(scanTopLevelKeys("- a\n"))
+        self.assertEqual(
+            getListOfYamlFiles(os.getcwd() + "/tests/include/ci", recursive=True),
+            ["build.yml", "deploy.yml", "test/unit.yaml"],
+        )
+
+    def testGitCommitTree(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run = lambda *args: subprocess.run(
+                ["git", "-C", tmp] + list(args), capture_output=True, check=True
+            ).stdout.decode(UTF_8)
+            run("init", "-q")
+            run("config", "user.email", "ci@example.com")
+            run("config", "user.name", "ci")
+            os.mkdir(tmp + "/ci")
+            with open(tmp + "/ci/a.yml", "w") as f:
+                f.write("job:a:\n  script: [a]\n")
+            with open(tmp + "/keep.txt", "w") as f:
+                f.write("keep\n")
+            run("add", ".")
+            run("commit", "-q", "-m", "init")
+            head = run("rev-parse", "HEAD").strip()
+            # uncommitted work must survive untouched
+            with open(tmp + "/keep.txt", "w") as f:
+                f.write("local change\n")
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                commit = gitCommitTree(
+                    [("ci/a.yml", b"job:a:\n  script: [b]\n")], "mini", False
+                )
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(run("show", commit + ":ci/a.yml"), "job:a:\n  script: [b]\n")
+            self.assertEqual(run("show", commit + ":keep.txt"), "keep\n")
+            self.assertEqual(run("rev-parse", commit + "^").strip(), head)
+            self.assertEqual(run("rev-parse", "HEAD").strip(), head)
+            self.assertEqual(run("status", "--porcelain"), " M keep.txt\n")
+            with open(tmp + "/ci/a.yml") as f:
+                self.assertEqual(f.read(), "job:a:\n  script: [a]\n")
+
+    def testGetHeadChanges(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            run = lambda *args: subprocess.run(
+                ["git", "-C", tmp] + list(args), capture_output=True, check=True
+            ).stdout.decode(UTF_8)
+            run("init", "-q")
+            os.mkdir(tmp + "/ci")
+            for fn in ["a.yml", "b.yml", "c.yml"]:
+                with open(tmp + "/ci/" + fn, "w") as f:
+                    f.write("job:" + fn + ":\n  script: [x]\n")
+            run("add", ".")
+            run("-c", "user.email=ci@example.com", "-c", "user.name=ci", "commit", "-q", "-m", "init")
+            # edited, staged and untracked files differ from HEAD, a file left alone does not
+            with open(tmp + "/ci/a.yml", "a") as f:
+                f.write("# edited\n")
+            with open(tmp + "/ci/c.yml", "a") as f:
+                f.write("# staged\n")
+            run("add", "ci/c.yml")
+            with open(tmp + "/ci/d.yml", "w") as f:
+                f.write("job:d:\n  script: [d]\n")
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                changes = getHeadChanges(tmp + "/ci/", ["a.yml", "b.yml", "c.yml", "d.yml"])
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(sorted(fn for fn, content in changes), ["a.yml", "c.yml", "d.yml"])
+            self.assertIn(("a.yml", b"job:a.yml:\n  script: [x]\n# edited\n"), changes)
+
+    def testBatchTargetSets(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(tmp + "/batch.yml", "w") as f:
+                f.write(
+                    "flaky-c:\n  jobs: 'testExample:c:[f2, f3]'\n  repeat: 3\n"
+                    "team-b: testExample:b, testExample:a\n"
+                )
+            batch = readBatchManifest(tmp + "/batch.yml", 1)
+        self.assertEqual(
+            batch,
+            [
+                ("flaky-c", ["testExample:c:[f2, f3]"], 3),
+                ("team-b", ["testExample:b", " testExample:a"], 1),
+            ],
+        )
+        dirToYaml = os.getcwd() + "/tests/"
+        yamlFiles = getListOfYamlFiles(dirToYaml)
+        fileIndex = {}
+        jobs = getAllConfig(yamlFiles, dirToYaml, fileIndex)
+        graph = JobGraph(jobs)
+        unRemoveableJobs = getUnRemoveableJobs(jobs, graph)
+        rendered = []
+        for name, setJobs, setRepeat in batch:
+            targetsDic, titles = getTargetsDic(setJobs, jobs)
+            contents = renderTargetSet(
+                targetsDic, setRepeat, jobs, graph, unRemoveableJobs, dirToYaml, yamlFiles, fileIndex
+            )
+            rendered.append(yaml.load(contents[0][1], Loader=PipeLoader))
+        self.assertEqual(list(rendered[0]), ["testExample:c"])
+        self.assertEqual(
+            rendered[0]["testExample:c"]["parallel"],
+            {"matrix": [{"TESTFILE": ["f2", "f3"], "REPEAT": [0, 1, 2]}]},
+        )
+        self.assertEqual(list(rendered[1]), ["testExample:a", "testExample:b"])
+        self.assertEqual(rendered[1]["testExample:a"]["parallel"], 1)
+        # the shared parsed config is left untouched
+        self.assertEqual(jobs["testExample:c"]["parallel"]["matrix"][0]["TESTFILE"], ["f1", "f2", "f3", "f4"])
+        self.assertEqual(jobs["testExample:b"], {"needs": ["testExample:a"], "script": ['echo "test-b"']})
+
+    def testBatchCommitsLocalWork(self):
+        import argparse
+
+        with tempfile.TemporaryDirectory() as tmp:
+            run = lambda *args: subprocess.run(
+                ["git", "-C", tmp] + list(args), capture_output=True, check=True
+            ).stdout.decode(UTF_8)
+            run("init", "-q", "-b", "main")
+            run("config", "user.email", "ci@example.com")
+            run("config", "user.name", "ci")
+            os.mkdir(tmp + "/ci")
+            with open(tmp + "/ci/a.yml", "w") as f:
+                f.write("stages: [test]\n")
+            with open(tmp + "/ci/b.yml", "w") as f:
+                f.write("job:a:\n  stage: test\n  script: [a]\njob:b:\n  stage: test\n  script: [b]\n")
+            run("add", ".")
+            run("commit", "-q", "-m", "init")
+            # a.yml is kept whole by the minimum config, its local edit has to be pushed all the same
+            with open(tmp + "/ci/a.yml", "w") as f:
+                f.write("stages: [test, deploy]\n")
+            dirToYaml = tmp + "/ci/"
+            yamlFiles = getListOfYamlFiles(dirToYaml)
+            fileIndex = {}
+            jobs = getAllConfig(yamlFiles, dirToYaml, fileIndex)
+            graph = JobGraph(jobs)
+            args = argparse.Namespace(
+                plan=False, estimate=False, debug=False, pushBranch="mini", waitTimeout=0
+            )
+            pushed = []
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                with mock.patch(
+                    "gitlab_ci_helper.gitPushBatch", side_effect=lambda commits, *rest: pushed.extend(commits) or []
+                ), contextlib.redirect_stdout(io.StringIO()):
+                    runBatch(
+                        [("only-a", ["job:a"], 1)],
+                        jobs,
+                        graph,
+                        getUnRemoveableJobs(jobs, graph),
+                        dirToYaml,
+                        yamlFiles,
+                        fileIndex,
+                        None,
+                        args,
+                    )
+            finally:
+                os.chdir(cwd)
+            commit, branch = pushed[0]
+            self.assertEqual(branch, "mini-only-a")
+            self.assertEqual(run("show", commit + ":ci/a.yml"), "stages: [test, deploy]\n")
+            self.assertNotIn("job:b", run("show", commit + ":ci/b.yml"))
+
+    def testPlan(self):
+        dirToYaml = os.getcwd() + "/tests/"
+        with open(dirToYaml + "gitlab-example.yml") as f:
+            before = f.read()
+        output = runOffline(dirToYaml, ["--plan", "-r", "150", "-j", "testExample:c:[f2, f3], testExample:b"])
+        self.assertIn("testExample:a x1", output)
+        self.assertIn("    - TESTFILE: [f2, f3]", output)
+        self.assertIn("testExample:c: 150 repeats x 2 jobs -> testExample:c-shard-1, testExample:c-shard-2", output)
+        self.assertIn("Estimated job count\x1b[0m: 451", output)
+        self.assertIn("--- a/gitlab-example.yml\n+++ b/gitlab-example.yml\n", output)
+        self.assertIn("+testExample:c-shard-2:\n", output)
+        with open(dirToYaml + "gitlab-example.yml") as f:
+            self.assertEqual(f.read(), before)
+
+    def testPlanHistoryOptions(self):
+        # --plan uses the durations recorded before, it does not record them in the same run
+        argv = ["--plan", "-j", "testExample:b", "--durations-from", "main"]
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            with self.assertRaises(SystemExit) as e:
+                runOffline(os.getcwd() + "/tests/", argv)
+        self.assertEqual(e.exception.code, 2)
+        self.assertIn("cannot be combined with --plan", err.getvalue())
+
+    def testEstimatePipeline(self):
+        jobs = {
+            "stages": ["build", "test", "deploy"],
+            ".tpl": {"stage": "build"},
+            "compile": {"extends": ".tpl", "script": ["make"]},
+            "lint": {"stage": "build", "script": ["lint"]},
+            "unit": {"stage": "test", "needs": ["compile"], "script": ["unit"]},
+            "itest": {"stage": "test", "script": ["itest"], "parallel": 4},
+            "deploy": {"stage": "deploy", "needs": ["unit", {"job": "docs", "optional": True}], "script": ["d"]},
+        }
+        counts = {"compile": 1, "lint": 1, "unit": 1, "itest": 4, "deploy": 1}
+        durations = {"compile": 60.0, "lint": 300.0, "unit": 30.0, "itest": 100.0, "deploy": 10.0}
+        result = estimatePipeline(jobs, counts, durations)
+        # itest waits for the whole build stage (lint), deploy only for unit
+        self.assertEqual(result["wall"], 400.0)
+        self.assertEqual(result["path"], ["lint", "itest"])
+        self.assertEqual(result["runner"], 60 + 300 + 30 + 400 + 10)
+        result = estimatePipeline(jobs, {"compile": 1, "unit": 1, "deploy": 1}, durations)
+        self.assertEqual(result["wall"], 100.0)
+        self.assertEqual(result["path"], ["compile", "unit", "deploy"])
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DurationCache("tests/", tmp)
+            cache.record(
+                [
+                    {"id": 1, "name": "unit: [a]", "duration": 10.0},
+                    {"id": 2, "name": "unit: [b]", "duration": 30.0},
+                    {"id": 3, "name": "unit: [c]", "duration": 20.0},
+                    {"id": 4, "name": "lint", "duration": None},
+                ]
+            )
+            cache.record([{"id": 3, "name": "unit: [c]", "duration": 20.0}])
+            cache.save()
+            cache = DurationCache("tests/", tmp)
+            self.assertEqual(cache.get("unit"), 20.0)
+            self.assertIsNone(cache.get("lint"))
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                full, mini = printEstimate(
+                    jobs, jobs, {"compile", "unit", ".tpl", "stages"}, {"unit": {""}}, 3, cache
+                )
+            self.assertEqual(mini["path"], ["compile", "unit"])
+            self.assertEqual(mini["runner"], 20.0 + 3 * 20.0)
+            self.assertIn("compile\x1b[0m is needed on the critical path, 0.3 min of the wait", out.getvalue())
+            self.assertIn("history for 1/5 jobs", out.getvalue())
+
+    def testStageAwarePruning(self):
+        jobs = yaml.load(
+            "stages: [build, test]\n"
+            "default:\n  before_script: !reference [.setup, script]\n"
+            ".setup:\n  script: [setup]\n"
+            ".unused:\n  script: [x]\n"
+            ".lib:\n  script: [lib]\n"
+            "trigger-docs:\n  trigger: group/docs\n"
+            "compile:\n  stage: build\n  script: [make]\n  when: manual\n"
+            "lint:\n  stage: build\n  script: [lint]\n  only: [main]\n"
+            "docs:\n  stage: build\n  script: [docs]\n"
+            "unit:\n  stage: test\n  needs: [compile, lint, {job: docs, optional: true}]\n"
+            "  script: [!reference [.lib, script], unit]\n",
+            Loader=PipeLoader,
+        )
+        graph = JobGraph(jobs)
+        self.assertEqual(getUnRemoveableJobs(jobs, graph), {"stages", "default", ".setup"})
+        # !reference is an edge, optional needs are not
+        self.assertEqual(graph.closure("unit"), {"unit", "compile", "lint", ".lib"})
+        miniJobsNames = graph.closure("unit") | getUnRemoveableJobs(jobs, graph)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            reportPruningRisks(jobs, miniJobsNames, {"unit": {""}})
+        self.assertIn("compile is manual", out.getvalue())
+        self.assertIn("lint has rules/only/except", out.getvalue())
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            reportPruningRisks(
+                {"setup": {"stage": ".pre", "script": ["s"]}}, {"setup"}, {"setup": {""}}
+            )
+        self.assertIn("Only .pre/.post jobs are left", out.getvalue())
+
+    def testExtendsResolver(self):
+        jobs = yaml.load(
+            ".base:\n  image: python\n  variables: {A: base, B: base}\n  script: [base]\n"
+            "  parallel:\n    matrix:\n      - {OS: [linux, mac]}\n      - {OS: win, ARCH: [x86, arm]}\n"
+            ".lint:\n  variables: {B: lint}\n  script: [lint]\n  tags: [small]\n"
+            "test:\n  extends: [.base, .lint]\n  variables: {C: test}\n  tags: null\n",
+            Loader=PipeLoader,
+        )
+        parsed = copy.deepcopy(jobs)
+        resolver = ExtendsResolver(jobs)
+        test = resolver.effective("test")
+        # hashes merge, lists are replaced, the last template wins, null removes the key
+        self.assertEqual(test["variables"], {"A": "base", "B": "lint", "C": "test"})
+        self.assertEqual(test["script"], ["lint"])
+        self.assertNotIn("tags", test)
+        self.assertNotIn("extends", test)
+        # copy-on-write: unchanged values are shared with the template
+        self.assertIs(test["parallel"], jobs[".base"]["parallel"])
+
+        # matrix inherited from a template: subjobs are validated, pruned and repeated on the effective matrix
+        targetsDic, titles = getTargetsDic(["test:[mac]", "test:[win, arm]"], jobs)
+        cleaned = cleanMatrix(dict(jobs), targetsDic)
+        self.assertEqual(
+            cleaned["test"]["parallel"]["matrix"],
+            [{"OS": ["mac"]}, {"OS": ["win"], "ARCH": ["arm"]}],
+        )
+        contents = renderWriteBack(
+            "", set(jobs), cleaned, ["ci.yml"], ["test"], 3, {"ci.yml": jobs}
+        )
+        written = yaml.load(contents[0][1], Loader=PipeLoader)
+        self.assertEqual(written["test"]["extends"], [".base", ".lint"])
+        for m in written["test"]["parallel"]["matrix"]:
+            self.assertEqual(m["REPEAT"], [0, 1, 2])
+        self.assertEqual(written[".base"], jobs[".base"])
+        self.assertEqual(jobs, parsed)
+
+        # long chains merge every template once
+        chain = {".t0": {"variables": {"L0": "0"}, "parallel": 2}}
+        for i in range(1, 500):
+            chain[".t" + str(i)] = {"extends": ".t" + str(i - 1), "variables": {"L" + str(i): str(i)}}
+        chain["job"] = {"extends": ".t499", "script": ["x"]}
+        resolver = ExtendsResolver(chain)
+        self.assertEqual(len(resolver.effective("job")["variables"]), 500)
+        self.assertEqual(resolver.effective("job")["parallel"], 2)
+        self.assertEqual(len(resolver.effective(".t250")["variables"]), 251)
+
+    def testParallelParse(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dirToYaml = tmp + "/"
+            for i in range(6):
+                with open(dirToYaml + "ci-" + str(i) + ".yml", "w") as f:
+                    f.write(
+                        "shared:\n  script: [from-" + str(i) + "]\n"
+                        "job-" + str(i) + ":\n  script: [!reference [.tpl, script], x]\n"
+                    )
+            yamlFiles = sorted(getListOfYamlFiles(dirToYaml))
+            serial = getAllConfig(list(yamlFiles), dirToYaml, workers=1)
+            # no size threshold, so the process pool is used
+            with mock.patch("gitlab_ci_helper.PARSEPARALLELBYTES", 0):
+                fileIndex = {}
+                parallel = getAllConfig(list(yamlFiles), dirToYaml, fileIndex, workers=2)
+                contents = [b"a: 1", b"b: !reference [x, y]"]
+                self.assertEqual(parseContents(contents, 2), [{"a": 1}, {"b": Tagged("!reference", ["x", "y"])}])
+        self.assertEqual(parallel, serial)
+        # the last file defining a key wins, like the serial merge
+        self.assertEqual(parallel["shared"]["script"], ["from-5"])
+        self.assertIsInstance(parallel["job-0"]["script"][0], Tagged)
+        self.assertEqual(list(fileIndex), yamlFiles)
+
+    def testCompactConfig(self):
+        files = {
+            "ci-0.yml": "variables:\n  GLOBAL: x\n"
+            ".tpl:\n  parallel:\n    matrix:\n      - ARCH: [a, b, c]\n  script: [make]\n"
+            "unit:\n  extends: .tpl\n  stage: test\n  needs: [build]\n"
+            "  script: [!reference [.setup, script], make test]\n  artifacts: {paths: [out]}\n",
+            "ci-1.yml": ".setup:\n  script: [echo setup]\nbuild:\n  stage: build\n  script: [make]\n",
+            "ci-2.yml": "other:\n  script: [echo other]\n",
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            dirToYaml = tmp + "/"
+            for fn in files:
+                with open(dirToYaml + fn, "w") as f:
+                    f.write(files[fn])
+            yamlFiles = sorted(getListOfYamlFiles(dirToYaml))
+            fileIndex = {}
+            jobs = getAllConfig(list(yamlFiles), dirToYaml, fileIndex)
+            compact = CompactConfig(dirToYaml)
+            compactJobs = compact.load(list(yamlFiles), 1)
+            # only the graph part of a job is kept, its dependencies still include the !reference in its script
+            self.assertEqual(compactJobs["unit"], {"extends": ".tpl", "stage": "test", "needs": ["build"]})
+            self.assertEqual(compactJobs["variables"], {"GLOBAL": "x"})
+            self.assertEqual(compact.records["unit"].deps, ("build", ".tpl", ".setup"))
+            self.assertFalse(hasattr(compact.records["unit"], "__dict__"))
+            self.assertEqual(compact.fileKeys["ci-1.yml"], [".setup", "build"])
+
+            graph = JobGraph(compactJobs, compact.records)
+            self.assertEqual(graph.adjacency, JobGraph(jobs).adjacency)
+            targetsDic, titles = getTargetsDic(["unit:[b]"], jobs)
+            miniJobs = graph.closure("unit") | getUnRemoveableJobs(compactJobs, graph)
+            expected = renderWriteBack(
+                dirToYaml, miniJobs, cleanMatrix(dict(jobs), targetsDic), yamlFiles, ["unit"], 2, fileIndex
+            )
+            # ci-2.yml holds no kept job, it is not parsed again
+            with open(dirToYaml + "ci-2.yml", "w") as f:
+                f.write("broken: [")
+            contents = renderWriteBack(
+                dirToYaml, miniJobs, cleanMatrix(dict(compactJobs), targetsDic), yamlFiles, ["unit"], 2, compact
+            )
+        self.assertEqual(contents, expected)
+        written = yaml.load(contents[0][1], Loader=PipeLoader)
+        self.assertEqual(written["unit"]["artifacts"], {"paths": ["out"]})
+        self.assertEqual(written["unit"]["parallel"], {"matrix": [{"ARCH": ["b"], "REPEAT": [0, 1]}]})
+
+    def testSpliceWriteBack(self):
+        files = {
+            "a.yml": "# header comment\n"
+            ".base: &base\n  image: python  # pinned\n"
+            "job:a:\n  extends: .base\n  <<: *base\n  script: [a]\n\n"
+            "job:b:\n  needs: [job:a]\n  script: [b]\n"
+            "job:x:\n  script: [x]\n",
+            # job:d is copied but uses the anchor of .tpl, which is dropped
+            "c.yml": ".tpl: &tpl\n  image: x\njob:c:\n  needs: [job:d]\n  script: [c]\njob:d:\n  <<: *tpl\n  script: [d]\n",
+            "u.yml": "# kept as it is\nstages: [build, test]\n",
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            dirToYaml = tmp + "/"
+            for fn in files:
+                with open(dirToYaml + fn, "w") as f:
+                    f.write(files[fn])
+            yamlFiles = sorted(getListOfYamlFiles(dirToYaml))
+            fileIndex = {}
+            jobs = getAllConfig(yamlFiles, dirToYaml, fileIndex)
+            graph = JobGraph(jobs)
+            targetsDic, titles = getTargetsDic(["job:b", "job:c"], jobs)
+            miniJobs = graph.resolve(targetsDic) | getUnRemoveableJobs(jobs, graph)
+            contents = dict(
+                renderWriteBack(dirToYaml, miniJobs, cleanMatrix(dict(jobs), targetsDic), yamlFiles, list(targetsDic), 2, fileIndex)
+            )
+        # unchanged blocks keep their text, comments and anchors, the repeated job is dumped again, job:x is dropped
+        self.assertTrue(contents["a.yml"].startswith(files["a.yml"].split("job:b")[0].encode()))
+        self.assertEqual(
+            yaml.load(contents["a.yml"], Loader=PipeLoader)["job:b"]["parallel"], {"matrix": [{"REPEAT": [0, 1]}]}
+        )
+        self.assertNotIn(b"job:x", contents["a.yml"])
+        # the anchor would be lost, so the file is dumped as a whole
+        self.assertNotIn(b"*tpl", contents["c.yml"])
+        written = yaml.load(contents["c.yml"], Loader=PipeLoader)
+        self.assertEqual(list(written), ["job:c", "job:d"])
+        self.assertEqual(written["job:d"]["image"], "x")
+        # nothing changes in u.yml, it is not written
+        self.assertNotIn("u.yml", contents)
+        self.assertEqual(scanTopLevelSpans(b"a:\n  b: 1\n# c\nd: 2"), [("a", 0, 14), ("d", 14, 18)])
+
+    def testChildPipeline(self):
+        dirToYaml = os.getcwd() + "/tests/"
+        run = lambda argv, out=None: runOffline(dirToYaml, argv, out)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + "/child.yml"
+            # with --root, the included files (mirrored ones too) are merged into the file
+            repoDir = dirToYaml + "include/"
+            include = ["--root", repoDir + ".gitlab-ci.yml", "--mirror", repoDir + "mirror"]
+            run(include + ["-j", "unit:python", "--emit-child", path])
+            with open(path) as f:
+                child = yaml.load(f.read(), Loader=PipeLoader)
+            self.assertNotIn("include", child)
+            self.assertIn(".lint-setup", child)
+            self.assertIn("matches the config", run(include + ["--verify-child", path]))
+
+            run(["-r", "2", "-j", "testExample:b, testExample:c:[f1]", "--emit-child", path])
+            with open(path) as f:
+                child = yaml.load(f.read(), Loader=PipeLoader)
+            self.assertEqual(list(child), [".gitlab-ci-helper", "testExample:a", "testExample:b", "testExample:c"])
+            self.assertEqual(child[".gitlab-ci-helper"]["targets"], ["testExample:b", "testExample:c:[f1]"])
+            self.assertEqual(
+                child["testExample:c"]["parallel"], {"matrix": [{"TESTFILE": ["f1"], "REPEAT": [0, 1]}]}
+            )
+            self.assertIn("matches the config", run(["--verify-child", path]))
+
+            # a job removed and another edited by hand
+            del child["testExample:a"]
+            child["testExample:c"]["script"] = ["echo changed"]
+            with open(path, "wb") as f:
+                f.write(yaml.dump(child, Dumper=PipeDumper, sort_keys=False, encoding=UTF_8))
+            out = io.StringIO()
+            with self.assertRaises(SystemExit) as e:
+                run(["--verify-child", path], out)
+        self.assertIn("3 problems", str(e.exception))
+        self.assertIn("testExample:a is missing", out.getvalue())
+        self.assertIn("testExample:b points to testExample:a, not in the file or its includes", out.getvalue())
+        self.assertIn("testExample:c differs from the config", out.getvalue())
+
+    def testChildPipelineHistoryOptions(self):
+        # recording history needs GitLab, the child pipeline options never build the API client
+        for argv in [["--verify-child", "child.yml", "--durations-from", "main"], ["--emit-child", "c.yml", "-j", "a", "--ingest-history"]]:
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                with self.assertRaises(SystemExit) as e:
+                    runOffline(os.getcwd() + "/tests/", argv)
+            self.assertEqual(e.exception.code, 2)
+            self.assertIn("cannot be combined", err.getvalue())
+
+    def testChildPipelineLocalInclude(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # the template lives outside the config directory, only the include: entry brings it in
+            os.makedirs(tmp + "/.git")
+            os.makedirs(tmp + "/gitlab")
+            with open(tmp + "/templates.yml", "w") as f:
+                f.write(".tpl:\n  script:\n    - echo tpl\n")
+            with open(tmp + "/gitlab/ci.yml", "w") as f:
+                f.write("include:\n  - local: /templates.yml\nunit:\n  extends: .tpl\n")
+            path = tmp + "/child.yml"
+            run = lambda argv: runOffline(tmp + "/gitlab/", argv)
+
+            run(["-j", "unit", "--emit-child", path])
+            with open(path) as f:
+                child = yaml.load(f.read(), Loader=PipeLoader)
+            self.assertEqual(child["include"], [{"local": "/templates.yml"}])
+            self.assertEqual(child["unit"], {"extends": ".tpl"})
+            self.assertIn("matches the config", run(["--verify-child", path]))
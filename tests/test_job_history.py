@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+
+from job_history import (
+    JobHistory,
+    failureRate,
+    flakiness,
+    splitJobName,
+    suggestRepeat,
+)
+
+
+# FakeApi: pipelines and their jobs (retried attempts included) as the GitLab API lists them
+class FakeApi:
+    def __init__(self):
+        self.pipelines = {}
+        self.jobs = {}
+        self.jobRequests = []
+
+    def addPipeline(self, pipelineId, sha, status, jobs):
+        self.pipelines[pipelineId] = {
+            "id": pipelineId,
+            "ref": "main",
+            "sha": sha,
+            "status": status,
+        }
+        self.jobs[pipelineId] = [
+            {"id": pipelineId * 100 + i, "name": name, "status": jobStatus, "duration": 10}
+            for i, (name, jobStatus) in enumerate(jobs)
+        ]
+
+    def getPipelines(self, **params):
+        ids = sorted(self.pipelines, reverse=True)
+        start = (params["page"] - 1) * params["per_page"]
+        return [self.pipelines[i] for i in ids[start : start + params["per_page"]]]
+
+    def getPipeline(self, pipelineId):
+        return self.pipelines[pipelineId]
+
+    def getPipelineJobs(self, pipelineId, includeRetried=False):
+        self.jobRequests.append(pipelineId)
+        return self.jobs[pipelineId]
+
+
+#  unit test for the job history
+class TestJobHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.history = JobHistory(os.path.join(self.tmp.name, "history.sqlite"))
+
+    def tearDown(self):
+        self.history.close()
+        self.tmp.cleanup()
+
+    def testSplitJobName(self):
+        self.assertEqual(splitJobName("test: [a, b]"), ("test", "a, b"))
+        self.assertEqual(splitJobName("test:[a]"), ("test", "a"))
+        self.assertEqual(splitJobName("build 2/4"), ("build", ""))
+        self.assertEqual(splitJobName("lint:python"), ("lint:python", ""))
+
+    def testSuggestRepeat(self):
+        self.assertEqual(suggestRepeat(1.0), 1)
+        self.assertEqual(suggestRepeat(0.5), 5)
+        self.assertEqual(suggestRepeat(0.01), 50)
+
+    def testIncrementalIngestAndFlakyRanking(self):
+        api = FakeApi()
+        # unit: [a] failed, was retried and passed on commit s1
+        api.addPipeline(
+            1,
+            "s1",
+            "success",
+            [("unit: [a]", "failed"), ("unit: [a]", "success"), ("unit: [b]", "success"), ("lint", "failed")],
+        )
+        api.addPipeline(2, "s2", "running", [])
+        self.assertEqual(self.history.ingest(api), 1)
+        self.assertEqual(api.jobRequests, [1])
+
+        # pipeline 2 finished meanwhile, it is checked again, only the new pipeline 3 is listed
+        api.addPipeline(2, "s2", "failed", [("unit: [a]", "failed"), ("lint", "failed")])
+        api.addPipeline(3, "s2", "success", [("unit: [a]", "success"), ("lint", "failed")])
+        self.assertEqual(self.history.ingest(api), 2)
+        self.assertEqual(sorted(api.jobRequests[1:]), [2, 3])
+        self.assertEqual(self.history.ingest(api), 0)
+
+        stats = {(s.name, s.cell): s for s in self.history.stats()}
+        self.assertEqual(stats[("unit", "a")].runs, 4)
+        self.assertEqual(failureRate(stats[("unit", "a")]), 0.5)
+        self.assertEqual(flakiness(stats[("unit", "a")]), 1.0)
+        self.assertEqual(flakiness(stats[("lint", "")]), 0.0)
+        self.assertEqual(failureRate(stats[("lint", "")]), 1.0)
+        self.assertEqual([s.name for s in self.history.stats(name="lint")], ["lint"])
+        self.assertEqual(
+            [(s.name, s.cell) for s in self.history.topFlaky(5)], [("unit", "a")]
+        )
@@ -0,0 +1,158 @@
+import io
+import json
+import re
+import unittest
+import urllib.parse
+
+from gitlab_api import UTF_8, RestBackend
+from log_follow import (
+    TAILLINES,
+    LogTail,
+    PipelineFollower,
+    errorSignature,
+    findErrorLine,
+)
+
+
+#  unit test for following target jobs against a local stand-in server with growing logs
+class TestLogFollow(unittest.TestCase):
+    def setUp(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.round = 0
+        self.sent = {}
+        self.ranges = []
+        big = b"".join(b"progress line " + str(i).encode() + b"\n" for i in range(40000))
+        # job id -> (name, [(status, log so far) per round])
+        self.timeline = {
+            1: ("unit: [a, 0]", [
+                ("running", b"\x1b[0Ksection_start:1:step\r\x1b[0Kstarting\nchecking "),
+                ("failed", b"\x1b[0Ksection_start:1:step\r\x1b[0Kstarting\nchecking value\n"
+                 + b"AssertionError: expected 3 got 4 at 2024-01-01T10:00:00Z\n"
+                 + b"ERROR: Job failed: exit code 1\n"),
+            ]),
+            2: ("unit: [a, 1]", [
+                ("pending", b""),
+                ("failed", b"AssertionError: expected 15 got 16 at 2024-01-02T11:00:00Z\n"
+                 + b"Cleaning up project directory\n"),
+            ]),
+            3: ("unit-shard-2: [a, 2]", [("running", big[:1000]), ("success", big)]),
+            4: ("lint", [("failed", b"lint error\n"), ("failed", b"lint error\n")]),
+        }
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                for key in headers or {}:
+                    self.send_header(key, headers[key])
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                step = min(test.round, 1)
+                if url.path.endswith("/pipelines/7/jobs"):
+                    jobs = [
+                        {"id": i, "name": test.timeline[i][0], "status": test.timeline[i][1][step][0]}
+                        for i in test.timeline
+                    ]
+                    self.reply(200, json.dumps(jobs).encode(UTF_8), {"X-Total-Pages": "1"})
+                    return
+                m = re.search(r"/jobs/(\d+)/trace$", url.path)
+                jobId = int(m.group(1))
+                log = test.timeline[jobId][1][step][1]
+                first, last = re.match(r"bytes=(\d+)-(\d+)", self.headers["Range"]).groups()
+                test.ranges.append((jobId, int(first)))
+                if int(first) >= len(log):
+                    self.reply(416, b"")
+                    return
+                chunk = log[int(first) : int(last) + 1]
+                test.sent[jobId] = test.sent.get(jobId, 0) + len(chunk)
+                self.reply(206, chunk)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        self.api = RestBackend(
+            "127.0.0.1:" + str(self.server.server_address[1]),
+            "secret",
+            "group/project",
+            https=False,
+        )
+
+    def tearDown(self):
+        self.api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testFollowPipeline(self):
+        out = io.StringIO()
+        follower = PipelineFollower(self.api, 7, ["unit"], out)
+
+        def nextRound(seconds):
+            self.round += 1
+
+        summary = follower.follow(interval=0, sleepFn=nextRound)
+        self.assertEqual(summary, {"unit": {"passed": 1, "failed": 2, "running": 0, "pending": 0}})
+        # every log byte was sent once, the other jobs' logs were not fetched
+        for jobId in [1, 2, 3]:
+            self.assertEqual(self.sent[jobId], len(self.timeline[jobId][1][1][1]))
+        self.assertNotIn(4, [jobId for jobId, offset in self.ranges])
+        self.assertIn((3, 1000), self.ranges)
+        # both repeats failed on the same assertion
+        groups = follower.failureGroups()
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(groups[0][2], ["unit: [a, 0]", "unit: [a, 1]"])
+        self.assertTrue(groups[0][1].startswith("AssertionError: expected 3 got 4"))
+        self.assertIn("unit: 0/3 passed, 0 failed, 2 running", out.getvalue())
+        self.assertIn("unit: 1/3 passed, 2 failed, 0 running", out.getvalue())
+        # done logs are not kept
+        self.assertEqual(sum(len(t.lines) for t in follower.tails.values()), 0)
+
+    def testFollowWithoutTargetJobs(self):
+        class Stub:
+            polls = 0
+
+            def getPipelineJobs(self, pipelineId):
+                return [{"id": 4, "name": "lint", "status": "failed"}]
+
+            def getPipeline(self, pipelineId):
+                self.polls += 1
+                return {"id": pipelineId, "status": "running" if self.polls < 3 else "failed"}
+
+        # no job is ever created for the target, following ends with the pipeline
+        out = io.StringIO()
+        delays = []
+        stub = Stub()
+        follower = PipelineFollower(stub, 7, ["unit"], out)
+        self.assertEqual(follower.follow(interval=1, sleepFn=delays.append), {})
+        self.assertEqual(delays, [1, 1])
+        self.assertIn("Pipeline failed without any target job", out.getvalue())
+
+    def testLogTailIsBounded(self):
+        tail = LogTail()
+        data = b"".join(b"line " + str(i).encode() + b"\n" for i in range(10000))
+        for pos in range(0, len(data), 777):
+            tail.feed(data[pos : pos + 777])
+        self.assertEqual(tail.offset, len(data))
+        self.assertEqual(len(tail.tail()), TAILLINES)
+        self.assertEqual(tail.tail()[-1], "line 9999")
+
+    def testErrorSignature(self):
+        self.assertEqual(
+            errorSignature("Timeout after 30.5s in /tmp/build-1234/x at 0xdeadbeef"),
+            "Timeout after <n>s in <tmp> at <hex>",
+        )
+        self.assertEqual(
+            findErrorLine(["ok", "FAILED test_a - KeyError", "ERROR: Job failed: exit code 1"]),
+            "FAILED test_a - KeyError",
+        )
@@ -0,0 +1,62 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from phase_timer import TRACER, runCommand, timed
+
+
+@timed("square")
+def square(x):
+    return x * x
+
+
+#  unit test for the phase timer
+class TestPhaseTimer(unittest.TestCase):
+    def tearDown(self):
+        TRACER.enabled = False
+        TRACER.spans = []
+
+    def testDisabled(self):
+        self.assertEqual(square(3), 9)
+        with TRACER.span("nothing"):
+            pass
+        self.assertEqual(TRACER.spans, [])
+
+    def testSpansAndExport(self):
+        TRACER.enable()
+        with TRACER.span("outer", "phase", files=2):
+            square(2)
+            square(3)
+        result = runCommand([sys.executable, "-c", "pass"], capture_output=True)
+        self.assertEqual(result.returncode, 0)
+        summary = {row[0]: row for row in TRACER.summary()}
+        self.assertEqual(summary["square"][2], 2)
+        self.assertEqual(summary["outer"][1], "phase")
+        self.assertEqual(summary[sys.executable + " -c"][1], "subprocess")
+
+        events = TRACER.toChromeTrace()["traceEvents"]
+        outer = [e for e in events if e["name"] == "outer"][0]
+        inner = [e for e in events if e["name"] == "square"]
+        self.assertEqual(outer["args"], {"files": 2})
+        self.assertEqual(outer["ph"], "X")
+        # nested spans lie inside the outer one
+        for e in inner:
+            self.assertGreaterEqual(e["ts"], outer["ts"])
+            self.assertLessEqual(e["ts"] + e["dur"], outer["ts"] + outer["dur"] + 1)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            TRACER.write(path, "json")
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual(len(data["spans"]), 4)
+        self.assertEqual(sorted(s["calls"] for s in data["summary"]), [1, 1, 2])
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            TRACER.printSummary()
+        self.assertIn("square", out.getvalue())
+        self.assertIn("wall time", out.getvalue())